@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cold start of the charm's hooks.
+
+Juju runs every hook in a new process, so the cost of importing the charm is
+paid by each of them. The import of src/charm.py is timed with python
+-X importtime, listing what its direct imports cost. Each hook is then run
+in a new process against an ops.testing.Harness with synthetic loadbalancer
+relations, timing the import of the charm and the hook. Compiled templates
+are kept between the runs of a hook, as on a unit, so the first run of a
+rendering hook compiles the template. Results are written as JSON.
+
+    tox -e bench-coldstart -- --output coldstart.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+CHARM_DIR = Path(__file__).resolve().parent.parent
+HOOKS = ('update-status', 'config-changed')
+
+
+def _env():
+    env = dict(os.environ)
+    paths = [str(CHARM_DIR / 'lib'), str(CHARM_DIR / 'src')]
+    if env.get('PYTHONPATH'):
+        paths.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(paths)
+    return env
+
+
+def _parse_importtime(output):
+    """Parse python -X importtime output.
+
+    :returns: List of (depth, module, self us, cumulative us)
+    :rtype: List[Tuple[int, str, int, int]]
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports.append(
+            (depth, name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def measure_import(repeat, top):
+    """Time the import of the charm.
+
+    :returns: Cumulative import time and the costliest direct imports
+    :rtype: Dict
+    """
+    timings = []
+    direct = {}
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import charm'],
+            cwd=str(CHARM_DIR),
+            env=_env(),
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True).stderr
+        imports = _parse_importtime(output)
+        charm_idx, charm_us = next(
+            (idx, cumulative)
+            for idx, (depth, name, _, cumulative) in enumerate(imports)
+            if depth == 0 and name == 'charm')
+        timings.append(charm_us / 1000)
+        # Modules are listed after the modules they import.
+        start = charm_idx
+        while start > 0 and imports[start - 1][0] > 0:
+            start -= 1
+        for depth, name, _, cumulative in imports[start:charm_idx]:
+            if depth == 1:
+                direct.setdefault(name, []).append(cumulative / 1000)
+    costliest = sorted(
+        ((name, statistics.median(values)) for name, values in direct.items()),
+        key=lambda item: item[1],
+        reverse=True)[:top]
+    return {
+        'min-ms': round(min(timings), 3),
+        'median-ms': round(statistics.median(timings), 3),
+        'direct-imports-ms': {
+            name: round(value, 3) for name, value in costliest}}
+
+
+def run_hook(hook, service_count, member_count, cache_dir):
+    """Run a single hook in this process, which must not have run another.
+
+    :returns: Results of the run
+    :rtype: Dict
+    """
+    start = time.perf_counter()
+    import charm
+    import_ms = (time.perf_counter() - start) * 1000
+    # Imports the ops testing framework.
+    import scale
+    from mock import MagicMock, patch
+
+    harness = scale.get_harness(len(scale.BINDINGS))
+    harness.set_leader(True)
+    harness.disable_hooks()
+    scale.add_service_relations(harness, service_count, member_count)
+    harness.enable_hooks()
+    harness.begin()
+    ch_host = MagicMock()
+    ch_host.restart_on_change.side_effect = lambda *a, **kw: lambda f: f
+    # The config is rendered but neither written, checked nor reloaded. The
+    # sysctl profile is written to a scratch directory and not applied.
+    with tempfile.TemporaryDirectory() as scratch_dir, \
+            patch.object(charm, 'ch_host', ch_host), \
+            patch.object(charm, 'subprocess'), \
+            patch.object(charm.ch_sysctl, 'check_call'), \
+            patch.object(charm.OpenstackLoadbalancerCharm, 'SYSCTL_CONF',
+                         Path(scratch_dir) / 'sysctl.conf'), \
+            patch.object(charm.OpenstackLoadbalancerCharm, 'TEMPLATE_CACHE',
+                         Path(cache_dir)):
+        event = getattr(harness.charm.on, hook.replace('-', '_'))
+        start = time.perf_counter()
+        event.emit()
+        # ops commits the framework at the end of the hook, which applies
+        # pending loadbalancer requests.
+        harness.framework.commit()
+        hook_ms = (time.perf_counter() - start) * 1000
+    return {
+        'import-ms': round(import_ms, 3),
+        'hook-ms': round(hook_ms, 3)}
+
+
+def measure_hook(hook, service_count, member_count, repeat, cache_dir):
+    """Time a hook, each run in a new process.
+
+    :returns: Results of the hook
+    :rtype: Dict
+    """
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, __file__,
+             '--run-hook', hook,
+             '--services', str(service_count),
+             '--members', str(member_count),
+             '--template-cache', cache_dir],
+            cwd=str(CHARM_DIR),
+            env=_env(),
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    results = {'hook': hook, 'first-hook-ms': runs[0]['hook-ms']}
+    for key in ('import-ms', 'hook-ms'):
+        values = [run[key] for run in runs]
+        results[key] = {
+            'min-ms': round(min(values), 3),
+            'median-ms': round(statistics.median(values), 3)}
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--hooks', type=lambda value: value.split(','),
+        default=list(HOOKS),
+        help='Comma separated hooks, any of {}'.format(', '.join(HOOKS)))
+    parser.add_argument(
+        '--services', type=int, default=10,
+        help='Number of services')
+    parser.add_argument(
+        '--members', type=int, default=3,
+        help='Number of members per service')
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Number of times the import and each hook are run')
+    parser.add_argument(
+        '--top', type=int, default=10,
+        help='Number of direct imports of the charm listed')
+    parser.add_argument(
+        '--output', default='-',
+        help='File to write results to, - for stdout')
+    parser.add_argument('--run-hook', help=argparse.SUPPRESS)
+    parser.add_argument('--template-cache', help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+    if args.run_hook:
+        print(json.dumps(run_hook(
+            args.run_hook,
+            args.services,
+            args.members,
+            args.template_cache)))
+        return
+    for hook in args.hooks:
+        if hook not in HOOKS:
+            parser.error('unknown hook {}'.format(hook))
+    charm_import = measure_import(args.repeat, args.top)
+    print('import={}'.format(charm_import['median-ms']), file=sys.stderr)
+    hooks = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for hook in args.hooks:
+            result = measure_hook(
+                hook,
+                args.services,
+                args.members,
+                args.repeat,
+                cache_dir)
+            print(
+                'hook={hook} first={first} hook={median}'.format(
+                    hook=hook,
+                    first=result['first-hook-ms'],
+                    median=result['hook-ms']['median-ms']),
+                file=sys.stderr)
+            hooks.append(result)
+    results = {
+        'python': platform.python_version(),
+        'services': args.services,
+        'members': args.members,
+        'import': charm_import,
+        'hooks': hooks}
+    output = json.dumps(results, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        Path(args.output).write_text(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the data plane of the rendered haproxy config.
+
+templates/haproxy.cfg is rendered from synthetic endpoint data for each
+mode, then a local haproxy runs it in front of local stand-in HTTP
+backends. A local client drives load through it. Requests per second,
+connection rate and latency percentiles are reported for each mode as
+JSON. Everything listens on 127.0.0.1, so no network access is needed. The
+benchmark is skipped when no haproxy binary is found, and the TLS modes are
+skipped when no openssl binary is found.
+
+The client is written in Python and is likely to saturate before haproxy
+does. Compare modes and template changes with each other rather than
+reading the numbers as haproxy capacity.
+
+    tox -e bench-dataplane -- --duration 10 --output dataplane.json
+"""
+
+import argparse
+import http.client
+import http.server
+import json
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import jinja2
+
+CHARM_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(CHARM_DIR / 'src'))
+
+import haproxy_runtime
+import host_tuning
+import lb_model
+
+SERVICE = 'bench_api'
+# Modes benchmarked: endpoint options, whether TLS is terminated and
+# whether the client keeps connections alive.
+MODES = {
+    'tcp': ({'mode': 'tcp'}, False, False),
+    'tcp-keepalive': ({'mode': 'tcp'}, False, True),
+    'http': ({'mode': 'http', 'http_reuse': 'never'}, False, False),
+    'http-reuse': ({'mode': 'http', 'http_reuse': 'always'}, False, True),
+    'tcp-tls': ({'mode': 'tcp'}, True, False),
+    'http-tls': ({'mode': 'http', 'http_reuse': 'always'}, True, False),
+    'http-tls-keepalive': (
+        {'mode': 'http', 'http_reuse': 'always'}, True, True),
+}
+# Lines of the global section which need root or a packaged install.
+UNPRIVILEGED_DROP = ('chroot', 'user', 'group', 'daemon', 'log', 'stats')
+BODY = b'ok\n'
+
+
+class _BackendHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately, do not let Nagle's
+        # algorithm hold back the body.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_backends(count):
+    """Start stand-in HTTP backends on free local ports.
+
+    :returns: The servers
+    :rtype: List[http.server.ThreadingHTTPServer]
+    """
+    servers = []
+    for _ in range(count):
+        server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            _BackendHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_certificate(tmpdir):
+    """Create a self signed certificate bundle, None without openssl."""
+    if not shutil.which('openssl'):
+        return None
+    cert = Path(tmpdir) / 'cert.pem'
+    key = Path(tmpdir) / 'key.pem'
+    subprocess.check_call(
+        [
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-subj', '/CN=localhost', '-days', '1',
+            '-keyout', str(key), '-out', str(cert)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    bundle = Path(tmpdir) / 'bundle.pem'
+    bundle.write_bytes(cert.read_bytes() + key.read_bytes())
+    return bundle
+
+
+def render_config(options, backends, port, certificate):
+    """Render the charm template for a single service.
+
+    :returns: The haproxy config
+    :rtype: str
+    """
+    endpoints = {
+        SERVICE: dict(
+            options,
+            frontend_port=port,
+            # Stand-in backends serve plain http.
+            backend_tls='false',
+            check_method='tcp',
+            members=[
+                {
+                    'unit_name': 'bench_{}'.format(idx),
+                    'backend_ip': '127.0.0.1',
+                    'backend_port': backend.server_address[1]}
+                for idx, backend in enumerate(backends)])}
+    tls = None
+    if certificate:
+        tls = lb_model.TLSSettings(
+            certificate=str(certificate),
+            certificate_digest='',
+            cachesize=host_tuning.compute_ssl_cachesize(4096),
+            lifetime=300,
+            ciphers='ECDHE-ECDSA-AES128-GCM-SHA256:'
+                    'ECDHE-RSA-AES128-GCM-SHA256',
+            ciphersuites='TLS_AES_128_GCM_SHA256',
+            min_version='TLSv1.2')
+    model = lb_model.build_model(
+        endpoints,
+        [],
+        sizing=host_tuning.compute_sizing(
+            host_tuning.get_cpus(),
+            host_tuning.get_memory(),
+            1,
+            maxconn=4096),
+        timeouts=lb_model.Timeouts(connect=5000, client=50000, server=50000),
+        tls=tls)
+    servers = haproxy_runtime.allocate_model_servers(model)
+    templates = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(CHARM_DIR / 'templates')))
+    config = templates.get_template('haproxy.cfg').render(
+        {'model': model, 'servers': servers})
+    # Run unprivileged, without logging, in the foreground.
+    lines = []
+    section = None
+    for line in config.splitlines():
+        if line and not line.startswith(' '):
+            section = line.split()[0]
+        if section == 'global' and line.split()[:1] and (
+                line.split()[0] in UNPRIVILEGED_DROP):
+            continue
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+def _wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('haproxy did not listen on {}'.format(port))
+
+
+def drive_load(port, tls, keepalive, duration, concurrency):
+    """Send requests from concurrent clients until duration has passed.
+
+    :returns: Latencies in seconds and number of connections opened
+    :rtype: Tuple[List[float], int]
+    """
+    context = None
+    if tls:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    deadline = time.monotonic() + duration
+    latencies = []
+    connections = [0]
+    lock = threading.Lock()
+
+    def _connect():
+        with lock:
+            connections[0] += 1
+        if tls:
+            return http.client.HTTPSConnection(
+                '127.0.0.1', port, context=context, timeout=10)
+        return http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+
+    def _client():
+        own = []
+        conn = None
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            if conn is None:
+                conn = _connect()
+            headers = {} if keepalive else {'Connection': 'close'}
+            try:
+                conn.request('GET', '/', headers=headers)
+                conn.getresponse().read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = None
+                continue
+            own.append(time.perf_counter() - start)
+            if not keepalive:
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+        with lock:
+            latencies.extend(own)
+
+    threads = [
+        threading.Thread(target=_client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, connections[0]
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return round(values[idx] * 1000, 3)
+
+
+def run_mode(haproxy, name, backends, certificate, tmpdir, args):
+    """Benchmark a single mode.
+
+    :returns: Results of the mode
+    :rtype: Dict
+    """
+    options, tls, keepalive = MODES[name]
+    port = _free_port()
+    config = Path(tmpdir) / '{}.cfg'.format(name)
+    config.write_text(render_config(
+        options,
+        backends,
+        port,
+        certificate if tls else None))
+    subprocess.check_call([haproxy, '-c', '-q', '-f', str(config)])
+    process = subprocess.Popen(
+        [haproxy, '-db', '-f', str(config)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        _wait_for_port(port)
+        # Let the health checks mark the backends up.
+        time.sleep(1)
+        latencies, connections = drive_load(
+            port, tls, keepalive, args.duration, args.concurrency)
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        'mode': name,
+        'requests': len(latencies),
+        'requests-per-s': round(len(latencies) / args.duration, 1),
+        'connections-per-s': round(connections / args.duration, 1),
+        'latency-ms': {
+            'p50': _percentile(latencies, 50),
+            'p90': _percentile(latencies, 90),
+            'p99': _percentile(latencies, 99)}}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--modes', type=lambda v: v.split(','), default=list(MODES),
+        help='Comma separated modes, from {}'.format(', '.join(MODES)))
+    parser.add_argument(
+        '--duration', type=float, default=5,
+        help='Seconds to drive load for per mode')
+    parser.add_argument(
+        '--concurrency', type=int, default=8,
+        help='Number of concurrent clients')
+    parser.add_argument(
+        '--backends', type=int, default=2,
+        help='Number of stand-in backends')
+    parser.add_argument(
+        '--haproxy', default=shutil.which('haproxy'),
+        help='Path of the haproxy binary')
+    parser.add_argument(
+        '--output', default='-',
+        help='File to write results to, - for stdout')
+    args = parser.parse_args(args)
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error('unknown modes: {}'.format(', '.join(sorted(unknown))))
+    if not args.haproxy:
+        print('haproxy not found, skipping data plane benchmark',
+              file=sys.stderr)
+        return
+    version = subprocess.check_output(
+        [args.haproxy, '-v'], universal_newlines=True).splitlines()[0]
+    backends = start_backends(args.backends)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        certificate = make_certificate(tmpdir)
+        for name in args.modes:
+            if MODES[name][1] and certificate is None:
+                print('openssl not found, skipping {}'.format(name),
+                      file=sys.stderr)
+                continue
+            result = run_mode(
+                args.haproxy, name, backends, certificate, tmpdir, args)
+            print(
+                '{mode}: {requests-per-s} req/s {connections-per-s} conn/s '
+                'p99 {p99}ms'.format(p99=result['latency-ms']['p99'],
+                                     **result),
+                file=sys.stderr)
+            results.append(result)
+    for backend in backends:
+        backend.shutdown()
+    output = json.dumps(
+        {
+            'haproxy': version,
+            'duration': args.duration,
+            'concurrency': args.concurrency,
+            'backends': args.backends,
+            'modes': results},
+        indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        Path(args.output).write_text(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
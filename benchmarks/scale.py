@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how the charm's hook work scales with loadbalancer relations.
+
+Synthetic loadbalancer relations are added to an ops.testing.Harness, one
+relation per service, for every combination of service, member and binding
+counts. For each case the endpoint parsing, model building, template
+rendering, relation data serialization, advertising and a full apply are
+timed, and the peak memory of the full apply is measured. Results are
+written as JSON.
+
+    tox -e bench-scale -- --output scale.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import jinja2
+import yaml
+from mock import MagicMock, patch
+
+CHARM_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(CHARM_DIR / 'lib'))
+sys.path.append(str(CHARM_DIR / 'src'))
+
+import ops
+from ops import framework, model
+from ops._private.harness import _TestingModelBackend
+from ops.jujucontext import _JujuContext
+from ops.testing import Harness
+
+import charm
+import haproxy_runtime
+
+BINDINGS = ('public', 'admin', 'internal')
+
+
+def _network(idx):
+    return {
+        'bind-addresses': [{
+            'interface-name': 'eth{}'.format(idx),
+            'addresses': [{
+                'cidr': '10.{}.0.0/16'.format(idx),
+                'value': '10.{}.0.10'.format(idx)}]}],
+        'ingress-addresses': ['10.{}.0.10'.format(idx)],
+        'egress-subnets': ['10.{}.0.0/16'.format(idx)]}
+
+
+class _BenchmarkModelBackend(_TestingModelBackend):
+
+    def network_get(self, endpoint_name, relation_id=None):
+        return _network(BINDINGS.index(endpoint_name) + 1)
+
+
+def get_harness(binding_count):
+    """Harness of the charm with the first binding_count bindings."""
+    meta = yaml.safe_load((CHARM_DIR / 'metadata.yaml').read_text())
+    meta['extra-bindings'] = {
+        binding: None for binding in BINDINGS[:binding_count]}
+    os.environ['JUJU_VERSION'] = '0.0.0'
+    harness = Harness(
+        charm.OpenstackLoadbalancerCharm,
+        meta=yaml.safe_dump(meta),
+        actions=(CHARM_DIR / 'actions.yaml').read_text(),
+        config=(CHARM_DIR / 'config.yaml').read_text())
+    # Harness does not implement network_get.
+    harness._backend = _BenchmarkModelBackend(
+        harness._unit_name,
+        harness._meta,
+        harness._get_config(None),
+        _JujuContext.from_dict(os.environ))
+    harness._model = model.Model(harness._meta, harness._backend)
+    harness._framework = framework.Framework(
+        ':memory:',
+        harness._charm_dir,
+        harness._meta,
+        harness._model)
+    harness.update_config({
+        'vip': ' '.join(
+            '10.{}.0.100'.format(idx)
+            for idx in range(1, binding_count + 1)),
+        # The metrics binding is not part of the benchmark.
+        'metrics-port': 0,
+        'lb-coalesce-window': 0})
+    return harness
+
+
+def add_service_relations(harness, service_count, member_count):
+    """Add one loadbalancer relation per service with its members.
+
+    :returns: Bytes of relation data added
+    :rtype: int
+    """
+    size = 0
+    for service_idx in range(service_count):
+        app = 'service{}'.format(service_idx)
+        service_name = '{}-api'.format(app)
+        rel_id = harness.add_relation('loadbalancer', app)
+        app_data = {
+            'endpoints': json.dumps([{
+                'service-name': service_name,
+                'frontend-port': 10000 + service_idx,
+                'check-type': 'http'}])}
+        harness.update_relation_data(rel_id, app, app_data)
+        size += len(app_data['endpoints'])
+        for member_idx in range(member_count):
+            unit = '{}/{}'.format(app, member_idx)
+            harness.add_relation_unit(rel_id, unit)
+            unit_data = {
+                'endpoints': json.dumps([{
+                    'service-name': service_name,
+                    'backend-port': 10000 + service_idx,
+                    'backend-ip': '172.16.{}.{}'.format(
+                        member_idx // 250, member_idx % 250 + 1)}])}
+            harness.update_relation_data(rel_id, unit, unit_data)
+            size += len(unit_data['endpoints'])
+    return size
+
+
+def _timed(func, repeat):
+    """Time func, returning its last result and timings in milliseconds."""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, {
+        'min-ms': round(min(timings), 3),
+        'median-ms': round(statistics.median(timings), 3)}
+
+
+def run_case(service_count, member_count, binding_count, repeat):
+    """Benchmark a single case.
+
+    :returns: Results of the case
+    :rtype: Dict
+    """
+    harness = get_harness(binding_count)
+    harness.set_leader(True)
+    harness.disable_hooks()
+    relation_bytes = add_service_relations(
+        harness,
+        service_count,
+        member_count)
+    harness.enable_hooks()
+    harness.begin()
+    lb_charm = harness.charm
+    rendered = {}
+
+    def _render(source, target, context, **kwargs):
+        rendered[target] = templates.get_template(source).render(context)
+        return rendered[target]
+
+    templates = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(str(CHARM_DIR / 'templates')))
+    results = {
+        'services': service_count,
+        'members': member_count,
+        'bindings': binding_count,
+        'relation-bytes': relation_bytes,
+        'timings': {}}
+    timings = results['timings']
+
+    def _parse():
+        return lb_charm.adapters.loadbalancer.endpoints
+
+    def _advertise():
+        lb_charm._stored.lb_advertised = json.dumps({})
+        lb_charm._send_loadbalancer_response()
+
+    def _apply():
+        lb_charm._stored.haproxy_layout = json.dumps(None)
+        lb_charm._stored.haproxy_model_digest = None
+        lb_charm._process_lb_requests(None)
+        lb_charm._apply_lb_requests(None)
+
+    ch_host = MagicMock()
+    ch_host.restart_on_change.side_effect = lambda *a, **kw: lambda f: f
+    # Neither haproxy -c nor sysctl is run.
+    with patch.object(charm, 'ch_host', ch_host), \
+            patch.object(charm, 'ch_sysctl'), \
+            patch.object(charm, 'subprocess'), \
+            patch.object(charm.ch_templating, 'render', side_effect=_render):
+        _, timings['parse-endpoints'] = _timed(_parse, repeat)
+        loadbalancer_model, timings['build-model'] = _timed(
+            lb_charm._get_loadbalancer_model,
+            repeat)
+        servers = haproxy_runtime.allocate_model_servers(loadbalancer_model)
+        _, timings['render-template'] = _timed(
+            lambda: lb_charm._render_haproxy_config(
+                loadbalancer_model, servers),
+            repeat)
+        responses = lb_charm._get_loadbalancer_responses()
+        _, timings['serialize-responses'] = _timed(
+            lambda: json.dumps(responses),
+            repeat)
+        _, timings['send-loadbalancer-response'] = _timed(_advertise, repeat)
+        _, timings['apply'] = _timed(_apply, repeat)
+        tracemalloc.start()
+        _apply()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    results['apply-peak-memory-kb'] = peak // 1024
+    results['config-bytes'] = sum(len(c) for c in rendered.values())
+    return results
+
+
+def _counts(value):
+    return [int(count) for count in value.split(',')]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--services', type=_counts, default=[1, 10, 50, 200],
+        help='Comma separated numbers of services')
+    parser.add_argument(
+        '--members', type=_counts, default=[1, 10, 50],
+        help='Comma separated numbers of members per service')
+    parser.add_argument(
+        '--bindings', type=_counts, default=[1, 3],
+        help='Comma separated numbers of bindings, at most 3')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Number of times each step is timed')
+    parser.add_argument(
+        '--output', default='-',
+        help='File to write results to, - for stdout')
+    args = parser.parse_args(args)
+    cases = []
+    for services, members, bindings in itertools.product(
+            args.services, args.members, args.bindings):
+        if not 1 <= bindings <= len(BINDINGS):
+            parser.error('bindings must be between 1 and 3')
+        case = run_case(services, members, bindings, args.repeat)
+        print(
+            'services={services} members={members} bindings={bindings} '
+            'apply={apply} peak={peak}kB'.format(
+                apply=case['timings']['apply']['median-ms'],
+                peak=case['apply-peak-memory-kb'],
+                **case),
+            file=sys.stderr)
+        cases.append(case)
+    results = {
+        'python': platform.python_version(),
+        'ops': ops.__version__,
+        'cases': cases}
+    output = json.dumps(results, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        Path(args.output).write_text(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,17 +4,32 @@
 #
 # Learn more at: https://juju.is/docs/sdk
 
-import ipaddress
+import base64
+import binascii
+import dataclasses
+import hashlib
+import json
 import logging
 import os
+import socket
 import interface_openstack_loadbalancer.loadbalancer as ops_lb_interface
 import interface_hacluster.ops_ha_interface as ops_ha_interface
 import subprocess
+import time
 from pathlib import Path
 
+import yaml
+
 import charmhelpers.core.host as ch_host
+import charmhelpers.core.sysctl as ch_sysctl
 import charmhelpers.core.templating as ch_templating
 
+import haproxy_runtime
+import host_tuning
+import lb_model
+import template_cache
+import vip_placement
+
 import ops_openstack.adapters
 from ops.framework import StoredState
 from ops.main import main
@@ -23,6 +38,15 @@ from ops.model import ActiveStatus
 import ops_openstack.core
 logger = logging.getLogger(__name__)
 
+# Keys of an endpoint request handled by the loadbalancer interface.
+INTERFACE_ENDPOINT_KEYS = (
+    'service-name',
+    'frontend-port',
+    'backend-port',
+    'backend-ip',
+    'check-type',
+)
+
 
 def reload_service(service_name) -> None:
     """Reload service.
@@ -33,6 +57,51 @@ def reload_service(service_name) -> None:
     subprocess.check_call(['systemctl', 'reload', service_name])
 
 
+def _load_endpoint_requests(databag):
+    try:
+        return json.loads(databag.get('endpoints') or '[]')
+    except ValueError:
+        logging.warning(
+            "Ignoring invalid endpoints: %s", databag.get('endpoints'))
+        return []
+
+
+def get_endpoint_options(relations):
+    """Options requested for endpoints on top of what the interface handles.
+
+    Keys of an endpoint request in the application data apply to the
+    endpoint and keys in the unit data apply to that member.
+
+    :param relations: loadbalancer relations
+    :type relations: List[ops.model.Relation]
+    :returns: Dict of service name -> {'options': {}, 'members': {}}
+    :rtype: Dict[str, Dict[str, Dict]]
+    """
+    def _options(request):
+        return {
+            key.replace('-', '_'): value
+            for key, value in request.items()
+            if key not in INTERFACE_ENDPOINT_KEYS}
+
+    options = {}
+    for relation in relations:
+        if relation.app:
+            for request in _load_endpoint_requests(
+                    relation.data[relation.app]):
+                service = options.setdefault(
+                    request.get('service-name'),
+                    {'options': {}, 'members': {}})
+                service['options'].update(_options(request))
+        for unit in relation.units:
+            for request in _load_endpoint_requests(relation.data[unit]):
+                service = options.setdefault(
+                    request.get('service-name'),
+                    {'options': {}, 'members': {}})
+                service['members'][unit.name.replace('/', '_')] = _options(
+                    request)
+    return options
+
+
 class LoadbalancerAdapter(
         ops_openstack.adapters.OpenStackOperRelationAdapter):
     """Adapter for Loadbalanceer interface."""
@@ -41,13 +110,26 @@ class LoadbalancerAdapter(
     def endpoints(self):
         """List of registered endpoints.
 
+        Options requested for an endpoint or member which the interface
+        does not handle are merged in.
+
         :returns: List of endpoint dicts
         :rtype: str
         """
         endpoint_data = self.relation.get_loadbalancer_requests()['endpoints']
-        _endpoints = {
-            service.replace("-", "_"): config
-            for service, config in endpoint_data.items()}
+        endpoint_options = get_endpoint_options(
+            self.relation.model.relations['loadbalancer'])
+        _endpoints = {}
+        for service, config in endpoint_data.items():
+            requested = endpoint_options.get(
+                service,
+                {'options': {}, 'members': {}})
+            config = dict(requested['options'], **config)
+            config['members'] = [
+                dict(requested['members'].get(member['unit_name'], {}),
+                     **member)
+                for member in config.get('members', [])]
+            _endpoints[service.replace("-", "_")] = config
         return _endpoints
 
 
@@ -65,12 +147,21 @@ class OpenstackLoadbalancerCharm(ops_openstack.core.OSBaseCharm):
 
     PACKAGES = ['haproxy']
     HAPROXY_CONF = Path('/etc/haproxy/haproxy.cfg')
+    HAPROXY_CERT = Path('/etc/haproxy/certs/openstack-loadbalancer.pem')
+    SYSCTL_CONF = Path('/etc/sysctl.d/50-openstack-loadbalancer.conf')
+    TEMPLATE_CACHE = Path('/var/cache/openstack-loadbalancer/templates')
     HAPROXY_SERVICE = 'haproxy'
+    # Binding the metrics frontend listens on, no VIPs are placed on it.
+    METRICS_BINDING = 'metrics'
     RESTART_MAP = {
-        str(HAPROXY_CONF): [HAPROXY_SERVICE]}
+        str(HAPROXY_CONF): [HAPROXY_SERVICE],
+        str(HAPROXY_CERT): [HAPROXY_SERVICE]}
     RFUNCS = {
         HAPROXY_SERVICE: reload_service}
 
+    # Hooks which leave loadbalancer events of earlier hooks pending.
+    NO_APPLY_HOOKS = ('hooks/install', 'hooks/stop', 'hooks/remove')
+
     _stored = StoredState()
 
     def __init__(self, *args):
@@ -85,43 +176,199 @@ class OpenstackLoadbalancerCharm(ops_openstack.core.OSBaseCharm):
             self.api_eps.on.lb_requested,
             self._process_lb_requests)
         self.framework.observe(self.ha.on.ha_ready, self._configure_hacluster)
+        self.framework.observe(
+            self.on.cluster_relation_joined,
+            self._on_cluster_relation_joined)
+        self.framework.observe(
+            self.on.cluster_relation_changed,
+            self._configure_hacluster)
+        self.framework.observe(
+            self.on.cluster_relation_departed,
+            self._configure_hacluster)
+        self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
+        self.framework.observe(
+            self.on.leader_elected,
+            self._on_leader_elected)
+        self.framework.observe(
+            self.framework.on.pre_commit,
+            self._apply_lb_requests)
+        self.framework.observe(
+            self.framework.on.pre_commit,
+            self._update_status_message)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(
+            self.on.show_sizing_action,
+            self._on_show_sizing_action)
+        self.framework.observe(
+            self.on.show_stats_action,
+            self._on_show_stats_action)
+        self.framework.observe(
+            self.on.show_clients_action,
+            self._on_show_clients_action)
+        self.framework.observe(
+            self.on.show_logs_action,
+            self._on_show_logs_action)
+        self.framework.observe(
+            self.on.prometheus_target_relation_joined,
+            self._publish_metrics_target)
         self.unit.status = ActiveStatus()
         self._stored.is_started = True
+        # Frontend layout and server slots of the running haproxy, stored as
+        # json. A layout of None forces a full render and reload.
+        self._stored.set_default(haproxy_layout=json.dumps(None))
+        self._stored.set_default(haproxy_servers=json.dumps({}))
+        # Digest of the loadbalancer model haproxy was last configured from.
+        self._stored.set_default(haproxy_model_digest=None)
+        # Loadbalancer events seen since haproxy was last configured.
+        self._stored.set_default(lb_pending_events=0)
+        self._stored.set_default(lb_pending_since=None)
+        self._stored.set_default(lb_last_folded_events=0)
+        # Loadbalancer events seen in this dispatch.
+        self._lb_dispatch_events = 0
+        # Frontends last advertised on each loadbalancer relation.
+        self._stored.set_default(lb_advertised=json.dumps({}))
+        # Sizing haproxy was last rendered with.
+        self._stored.set_default(haproxy_sizing=json.dumps(None))
+        # VIPs of each binding, reset when config or networks may change.
+        self._stored.set_default(vip_space_index=json.dumps(None))
+        # Pacemaker constraints added to spread the VIPs.
+        self._stored.set_default(ha_vip_constraints=json.dumps([]))
+        # Reloads of haproxy done by the charm, how long the last one took
+        # and old workers still finishing their sessions.
+        self._stored.set_default(haproxy_reloads=0)
+        self._stored.set_default(haproxy_last_reload=json.dumps(None))
+        self._stored.set_default(haproxy_old_workers=0)
+        # Whether haproxy -c rejected the last rendered config.
+        self._stored.set_default(haproxy_config_rejected=False)
+        # Whether it was installed without haproxy -c checking it.
+        self._stored.set_default(haproxy_config_unchecked=False)
+        # Kernel settings last applied, and those the kernel did not take.
+        self._stored.set_default(sysctl_profile=json.dumps(None))
+        self._stored.set_default(sysctl_unapplied=json.dumps([]))
 
     def _get_binding_subnet_map(self):
         bindings = {}
         for binding_name in self.meta.extra_bindings.keys():
+            if binding_name == self.METRICS_BINDING:
+                continue
             network = self.model.get_binding(binding_name).network
             bindings[binding_name] = [i.subnet for i in network.interfaces]
         return bindings
 
     @property
     def vips(self):
-        return self.config.get('vip').split()
+        return (self.config.get('vip') or '').split()
+
+    def _get_space_vip_index(self):
+        """Index of the VIPs of each binding, cached across hooks.
+
+        :returns: See vip_placement.build_space_index, with the subnets of
+                  all bindings under 'subnets'
+        :rtype: Dict
+        """
+        index = json.loads(self._stored.vip_space_index)
+        if index is None:
+            binding_subnets = {
+                binding: [str(subnet) for subnet in subnets]
+                for binding, subnets in self._get_binding_subnet_map().items()}
+            index = vip_placement.build_space_index(
+                binding_subnets,
+                self.vips)
+            # Members are ranked against the same subnets.
+            index['subnets'] = sorted({
+                subnet
+                for subnets in binding_subnets.values()
+                for subnet in subnets})
+            for vip in index['unmatched']:
+                logging.warning("VIP %s is not in any bound space", vip)
+            for vip in index['ambiguous']:
+                logging.warning("VIP %s is in more than one space", vip)
+            self._stored.vip_space_index = json.dumps(index)
+        return index
 
     def _get_space_vip_mapping(self):
-        bindings = {}
-        for binding_name, subnets in self._get_binding_subnet_map().items():
-            bindings[binding_name] = [
-                vip
-                for subnet in subnets
-                for vip in self.vips
-                if ipaddress.ip_address(vip) in subnet]
-        return bindings
+        return self._get_space_vip_index()['bindings']
+
+    def _get_loadbalancer_responses(self, model=None):
+        """Frontends to advertise, keyed on service name and binding.
 
-    def _send_loadbalancer_response(self):
-        # May do tls termination in future
-        protocol = 'http'
+        :param model: Loadbalancer model haproxy is configured from, built
+                      if not given
+        :type model: Optional[lb_model.LoadbalancerModel]
+        :returns: Nested dict of service -> binding -> frontend details
+        :rtype: Dict[str, Dict[str, Dict]]
+        """
+        if model is None:
+            model = self._get_loadbalancer_model()
+        tls_services = [
+            frontend.service
+            for frontend in model.frontends
+            if frontend.tls]
+        eps = self.api_eps.get_loadbalancer_requests()['endpoints']
+        responses = {}
         for binding, vips in self._get_space_vip_mapping().items():
-            eps = self.api_eps.get_loadbalancer_requests()['endpoints']
             for name, data in eps.items():
-                self.api_eps.loadbalancer_ready(
-                    name,
-                    binding,
-                    vips,
-                    data['frontend_port'],  # Requested port is honoured atm
-                    protocol)
-        self.api_eps.advertise_loadbalancers()
+                protocol = 'http'
+                if name.replace('-', '_') in tls_services:
+                    protocol = 'https'
+                # Requested port is honoured atm
+                responses.setdefault(name, {})[binding] = {
+                    'ip': vips,
+                    'port': data['frontend_port'],
+                    'protocol': protocol}
+        return responses
+
+    def _send_loadbalancer_response(self, model=None):
+        if not self.unit.is_leader():
+            # Only the leader advertises, and keeps track of what it did.
+            logging.debug("Not the leader, not advertising endpoints")
+            return
+        responses = self._get_loadbalancer_responses(model)
+        # Keyed on relation id, a relation removed and added again has not
+        # been told about any endpoint.
+        advertised = json.loads(self._stored.lb_advertised)
+        relation_ids = [
+            str(relation.id)
+            for relation in self.model.relations['loadbalancer']]
+        outdated = [
+            relation_id for relation_id in relation_ids
+            if advertised.get(relation_id) != responses]
+        if not outdated:
+            logging.debug("Loadbalancer endpoints unchanged, not advertising")
+        else:
+            changed, removed = set(), set()
+            for relation_id in outdated:
+                previous = advertised.get(relation_id, {})
+                changed.update(
+                    (name, binding)
+                    for name, bindings in responses.items()
+                    for binding, frontend in bindings.items()
+                    if previous.get(name, {}).get(binding) != frontend)
+                removed.update(
+                    (name, binding)
+                    for name, bindings in previous.items()
+                    for binding in bindings
+                    if binding not in responses.get(name, {}))
+            logging.info(
+                "Advertising loadbalancer endpoints on relations %s, "
+                "changed: %s removed: %s",
+                outdated, sorted(changed), sorted(removed))
+            # advertise_loadbalancers publishes the complete set of frontends
+            # of each relation so every current endpoint is registered, the
+            # relation data only changes for the endpoints which did.
+            for name, bindings in responses.items():
+                for binding, frontend in bindings.items():
+                    self.api_eps.loadbalancer_ready(
+                        name,
+                        binding,
+                        frontend['ip'],
+                        frontend['port'],
+                        frontend['protocol'])
+            self.api_eps.advertise_loadbalancers()
+        # Relations which are gone are dropped.
+        self._stored.lb_advertised = json.dumps({
+            relation_id: responses for relation_id in relation_ids})
 
     def _configure_hacluster(self, _):
         vip_config = self.config.get('vip')
@@ -132,22 +379,852 @@ class OpenstackLoadbalancerCharm(ops_openstack.core.OSBaseCharm):
             self.ha.add_vip(self.model.app.name, vip)
         self.ha.add_init_service(self.model.app.name, 'haproxy')
         self.ha.bind_resources()
+        self._place_vips()
+
+    def _on_cluster_relation_joined(self, event):
+        event.relation.data[self.unit]['hostname'] = socket.gethostname()
+
+    def _get_cluster_hostnames(self):
+        """Hostnames, and so pacemaker node names, of the units."""
+        hostnames = [socket.gethostname()]
+        relation = self.model.get_relation('cluster')
+        if relation:
+            for unit in relation.units:
+                hostname = relation.data[unit].get('hostname')
+                if hostname:
+                    hostnames.append(hostname)
+        return hostnames
+
+    def _place_vips(self):
+        """Add or remove the constraints spreading VIPs over the units.
+
+        interface_hacluster puts all VIPs into one group so they run on a
+        single unit. With vip-distribution set to spread the group is
+        dropped and each VIP prefers a different unit instead.
+        """
+        app_name = self.model.app.name
+        spread = self.config.get('vip-distribution') == 'spread'
+        colocations, locations = {}, {}
+        if spread:
+            colocations, locations = vip_placement.plan_constraints(
+                app_name,
+                self.vips,
+                self._get_cluster_hostnames(),
+                # Clone interface_hacluster runs the haproxy service in.
+                'cl_res_{}_haproxy'.format(app_name.replace('-', '_')))
+        constraints = sorted(list(colocations) + list(locations))
+        stale = set(json.loads(self._stored.ha_vip_constraints))
+        stale -= set(constraints)
+        vip_resources = set(
+            vip_placement.vip_resource_name(app_name, vip)
+            for vip in self.vips)
+        for relation in self.model.relations['ha']:
+            data = relation.data[self.unit]
+            groups = json.loads(data.get('json_groups') or '{}')
+            delete = json.loads(data.get('json_delete_resources') or '[]')
+            delete = [name for name in delete if name not in constraints]
+            vip_groups = [
+                name for name, members in groups.items()
+                if members and set(members.split()) <= vip_resources]
+            for name in vip_groups:
+                if spread:
+                    del groups[name]
+                    if name not in delete:
+                        delete.append(name)
+                elif name in delete:
+                    delete.remove(name)
+            delete.extend(sorted(stale - set(delete)))
+            data['json_groups'] = json.dumps(groups, sort_keys=True)
+            data['json_delete_resources'] = json.dumps(delete)
+            for key, values in (('json_colocations', colocations),
+                                ('json_locations', locations)):
+                existing = json.loads(data.get(key) or '{}')
+                for name in stale:
+                    existing.pop(name, None)
+                existing.update(values)
+                data[key] = json.dumps(existing, sort_keys=True)
+        self._stored.ha_vip_constraints = json.dumps(constraints)
+
+    def _get_loadbalancer_model(self):
+        """Build the model haproxy is configured from.
+
+        :returns: The loadbalancer model
+        :rtype: lb_model.LoadbalancerModel
+        """
+        endpoints = self.adapters.loadbalancer.endpoints
+        sizing = self._get_haproxy_sizing(len(endpoints))
+        return lb_model.build_model(
+            endpoints,
+            self.vips,
+            spare_slots=self.config.get('backend-spare-slots') or 0,
+            sizing=sizing,
+            defaults=self._get_endpoint_defaults(),
+            timeouts=self._get_haproxy_timeouts(),
+            tls=self._get_tls_settings(sizing),
+            metrics=self._get_metrics(),
+            log_settings=self._get_log_settings(),
+            locality=self._get_locality(endpoints),
+            hard_stop_after=self.config.get(
+                'haproxy-hard-stop-after') or None,
+            spread_checks=min(
+                max(self.config.get('haproxy-spread-checks') or 0, 0),
+                50))
+
+    def _get_locality(self, endpoints):
+        """Subnets and availability zone members are ranked against.
+
+        :param endpoints: Endpoints requested on the loadbalancer relations
+        :type endpoints: Dict[str, Dict]
+        :returns: None if no endpoint ranks its members
+        :rtype: Optional[lb_model.Locality]
+        """
+        policies = {self.config.get('locality')} | {
+            endpoint.get('locality') for endpoint in endpoints.values()}
+        if not policies & {'backup', 'weight'}:
+            return None
+        return lb_model.Locality(
+            subnets=tuple(self._get_space_vip_index()['subnets']),
+            zone=os.environ.get('JUJU_AVAILABILITY_ZONE') or None)
+
+    def _get_log_settings(self):
+        target = self.config.get('haproxy-log-target')
+        server = self.config.get('haproxy-log-server') or None
+        if target not in lb_model.LOG_TARGETS:
+            logger.warning("Ignoring invalid haproxy-log-target: %s", target)
+            target = 'local'
+        if target == 'udp' and not server:
+            logger.warning(
+                "haproxy-log-server is not set, logging to the local socket")
+            target = 'local'
+        return lb_model.LogSettings(
+            target=target,
+            server=server if target == 'udp' else None,
+            sample=max(self.config.get('haproxy-log-sample') or 1, 1),
+            health_checks=self.config.get('haproxy-log-health-checks'),
+            ring_size=max(
+                self.config.get('haproxy-log-ring-size') or 0, 64) * 1024)
+
+    def _get_metrics(self):
+        port = self.config.get('metrics-port')
+        if not port:
+            return None
+        binding = self.model.get_binding(self.METRICS_BINDING)
+        return lb_model.Metrics(
+            address=str(binding.network.bind_address),
+            port=port)
+
+    def _publish_metrics_target(self, event=None):
+        """Tell Prometheus where to scrape haproxy metrics from."""
+        metrics = self._get_metrics()
+        target = {}
+        if metrics:
+            binding = self.model.get_binding(self.METRICS_BINDING)
+            target = {
+                'hostname': str(binding.network.ingress_address),
+                'port': str(metrics.port),
+                'metrics_path': metrics.path}
+        for relation in self.model.relations['prometheus-target']:
+            data = relation.data[self.unit]
+            for key in ('hostname', 'port', 'metrics_path'):
+                if key not in target:
+                    data.pop(key, None)
+                elif data.get(key) != target[key]:
+                    data[key] = target[key]
+
+    def _decode_certificate_options(self):
+        """Decode the base64 encoded certificate options.
+
+        :returns: Decoded value of each option set, None for those which are
+                  not valid base64
+        :rtype: Dict[str, Optional[bytes]]
+        """
+        decoded = {}
+        for option in ('ssl_cert', 'ssl_ca', 'ssl_key'):
+            value = self.config.get(option)
+            if not value:
+                continue
+            try:
+                decoded[option] = base64.b64decode(
+                    ''.join(value.split()),
+                    validate=True)
+            except (binascii.Error, ValueError):
+                decoded[option] = None
+        return decoded
+
+    def _get_certificate_bundle(self):
+        """PEM bundle of certificate, CA chain and key haproxy serves.
+
+        :returns: The bundle or None if no valid certificate is configured
+        :rtype: Optional[bytes]
+        """
+        decoded = self._decode_certificate_options()
+        invalid = [
+            option for option, value in decoded.items() if value is None]
+        if invalid:
+            logger.error(
+                "Not terminating TLS, not valid base64: %s", ' '.join(invalid))
+            return None
+        if not (decoded.get('ssl_cert') and decoded.get('ssl_key')):
+            return None
+        # Certificate, CA chain then key.
+        return b''.join(value.strip() + b'\n' for value in decoded.values())
+
+    def _get_tls_settings(self, sizing):
+        bundle = self._get_certificate_bundle()
+        if bundle is None:
+            return None
+        return lb_model.TLSSettings(
+            certificate=str(self.HAPROXY_CERT),
+            certificate_digest=hashlib.sha256(bundle).hexdigest(),
+            cachesize=host_tuning.compute_ssl_cachesize(
+                sizing.maxconn,
+                self.config.get('ssl-cache-size') or 0),
+            lifetime=self.config.get('ssl-session-lifetime'),
+            ciphers=self.config.get('ssl-ciphers'),
+            ciphersuites=self.config.get('ssl-ciphersuites'),
+            min_version=self.config.get('ssl-min-version'))
+
+    def _get_haproxy_timeouts(self):
+        return lb_model.Timeouts(**{
+            name: self.config.get(
+                'haproxy-{}-timeout'.format(name.replace('_', '-'))) or None
+            for name in (
+                lb_model.FRONTEND_TIMEOUTS + lb_model.BACKEND_TIMEOUTS)})
+
+    def _get_endpoint_defaults(self):
+        """Charm config defaults for options of endpoint requests."""
+        return {
+            'mode': self.config.get('haproxy-mode'),
+            'http_reuse': self.config.get('haproxy-http-reuse'),
+            'balance': self.config.get('haproxy-balance'),
+            'hash_type': self.config.get('haproxy-hash-type'),
+            'weight': self.config.get('haproxy-server-weight') or None,
+            'maxconn': self.config.get('haproxy-server-maxconn') or None,
+            'maxqueue': self.config.get('haproxy-server-maxqueue') or None,
+            'slowstart': self.config.get('haproxy-slowstart') or None,
+            'cache': self.config.get('haproxy-cache'),
+            'cache_size': self.config.get('haproxy-cache-size'),
+            'cache_max_object_size': self.config.get(
+                'haproxy-cache-max-object-size') or None,
+            'cache_max_age': self.config.get('haproxy-cache-max-age'),
+            'cache_paths': self.config.get('haproxy-cache-paths') or '',
+            'log_level': self.config.get('haproxy-log-level') or None,
+            'locality': self.config.get('locality'),
+            'locality_remote_weight': self.config.get(
+                'locality-remote-weight'),
+            'locality_min_local': self.config.get('locality-min-local'),
+            'rate_limit_period': self.config.get('haproxy-rate-limit-period'),
+            'rate_limit_action': self.config.get('haproxy-rate-limit-action'),
+            **{
+                'rate_limit_{}'.format(name): self.config.get(
+                    'haproxy-rate-limit-{}'.format(
+                        name.replace('_', '-'))) or None
+                for name in lb_model.RATE_LIMITS},
+            **{
+                name: self.config.get(
+                    'haproxy-check-{}'.format(name)) or None
+                for name in lb_model.CHECK_TIMINGS}}
+
+    def _get_haproxy_sizing(self, frontend_count):
+        return host_tuning.compute_sizing(
+            host_tuning.get_cpus(),
+            host_tuning.get_memory(),
+            frontend_count,
+            nbthread=self.config.get('haproxy-nbthread') or 0,
+            cpu_pinning=self.config.get('haproxy-cpu-pinning'),
+            maxconn=self.config.get('haproxy-maxconn') or 0,
+            frontend_maxconn=self.config.get('haproxy-frontend-maxconn') or 0,
+            bufsize=self.config.get('haproxy-bufsize') or 0,
+            maxrewrite=self.config.get('haproxy-maxrewrite') or 0)
+
+    def _write_certificate(self, path):
+        """Write the certificate bundle, removing it without one.
+
+        :param path: Path of the bundle
+        :type path: str
+        """
+        bundle = self._get_certificate_bundle()
+        if bundle is None:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        ch_host.mkdir(os.path.dirname(path), perms=0o700)
+        ch_host.write_file(path, bundle, perms=0o600)
+
+    def _check_haproxy_config(self, path):
+        """Check a config with haproxy -c.
+
+        :param path: Path of the config
+        :type path: str
+        :returns: Whether haproxy accepts the config, None if haproxy is not
+                  installed to check it
+        :rtype: Optional[bool]
+        """
+        try:
+            subprocess.check_output(
+                ['haproxy', '-c', '-q', '-f', path],
+                stderr=subprocess.STDOUT,
+                universal_newlines=True)
+        except FileNotFoundError:
+            logging.warning("haproxy not installed, not checking %s", path)
+            return None
+        except subprocess.CalledProcessError as e:
+            logging.error("haproxy rejected %s: %s", path, e.output)
+            return False
+        return True
+
+    def _render_template(self, model, servers):
+        context = {
+            'model': model,
+            'servers': servers}
+        return ch_templating.render(
+            os.path.basename(self.HAPROXY_CONF),
+            None,
+            context,
+            template_loader=template_cache.CachingLoader(
+                str(self.charm_dir / 'templates'),
+                self.TEMPLATE_CACHE)).encode('UTF-8')
+
+    def _render_haproxy_config(self, model, servers):
+        """Render the haproxy config, installing it if haproxy accepts it.
+
+        The candidate config is checked against a candidate certificate, the
+        certificate and config haproxy runs are only written once accepted.
+        Without haproxy to check it the config is installed unchecked, which
+        the unit status reports.
+
+        :returns: Whether the config was installed
+        :rtype: bool
+        """
+        config = self._render_template(model, servers)
+        candidate = '{}.new'.format(self.HAPROXY_CONF)
+        candidate_cert = '{}.new'.format(self.HAPROXY_CERT)
+        candidate_config = config
+        try:
+            if model.tls:
+                self._write_certificate(candidate_cert)
+                candidate_config = self._render_template(
+                    dataclasses.replace(
+                        model,
+                        tls=dataclasses.replace(
+                            model.tls,
+                            certificate=candidate_cert)),
+                    servers)
+            ch_host.write_file(candidate, candidate_config)
+            checked = self._check_haproxy_config(candidate)
+        finally:
+            # The candidate certificate is a copy of the key.
+            for path in (candidate, candidate_cert):
+                if os.path.exists(path):
+                    os.unlink(path)
+        valid = checked is not False
+        self._stored.haproxy_config_rejected = not valid
+        self._stored.haproxy_config_unchecked = checked is None
+        if valid:
+            self._write_certificate(str(self.HAPROXY_CERT))
+            ch_host.write_file(str(self.HAPROXY_CONF), config)
+        return valid
+
+    def _reload_haproxy(self, service_name):
+        """Reload haproxy, counting and timing reloads."""
+        start = time.monotonic()
+        reload_service(service_name)
+        self._stored.haproxy_reloads += 1
+        self._stored.haproxy_last_reload = json.dumps({
+            'time': time.time(),
+            'duration': round(time.monotonic() - start, 3)})
+        self._count_old_workers()
+
+    def _plan_live_update(self, api, model, servers):
+        """Plan member changes through the haproxy runtime API.
+
+        Nothing is changed in the running haproxy, the calls are made once
+        the config with the updated server slots is accepted.
+
+        :param api: Client of the running haproxy
+        :type api: haproxy_runtime.HAProxyRuntimeAPI
+        :param model: Loadbalancer model to configure
+        :type model: lb_model.LoadbalancerModel
+        :param servers: Server slots of the running haproxy
+        :type servers: Dict[str, List[Dict]]
+        :returns: The updated server slots and the runtime API calls making
+                  them, or None if a reload is needed.
+        :rtype: Optional[Tuple[Dict[str, List[Dict]], List[Tuple]]]
+        """
+        drain_since = None
+        if self.config.get('drain-timeout'):
+            drain_since = time.time()
+        try:
+            # Drained members free their slots for members joining.
+            servers, calls = self._complete_drains(api, servers)
+            plans = {}
+            for backend in model.backends:
+                plan = haproxy_runtime.plan_server_updates(
+                    servers.get(backend.service, []),
+                    [dataclasses.asdict(m) for m in backend.members],
+                    drain_since=drain_since)
+                if plan is None:
+                    logging.info(
+                        "No free server slots left for %s, reloading",
+                        backend.service)
+                    return None
+                plans[backend] = plan
+            for backend, (_, backend_calls) in plans.items():
+                calls.extend(
+                    (backend.name, method, server, args)
+                    for method, server, args in backend_calls)
+            servers, promotion_calls = self._promote_remote_members(
+                api,
+                model,
+                {
+                    backend.service: new_servers
+                    for backend, (new_servers, _) in plans.items()})
+        except (OSError, haproxy_runtime.HAProxyRuntimeError) as e:
+            logging.warning(
+                "Runtime update of haproxy failed, reloading: %s", e)
+            return None
+        return servers, calls + promotion_calls
+
+    @staticmethod
+    def _call_runtime_api(api, calls):
+        """Make runtime API calls planned for the running haproxy.
+
+        :param api: Client of the running haproxy
+        :type api: haproxy_runtime.HAProxyRuntimeAPI
+        :param calls: (backend, method, server, args) of each call
+        :type calls: List[Tuple]
+        :raises: OSError, haproxy_runtime.HAProxyRuntimeError
+        """
+        for backend, method, server, args in calls:
+            getattr(api, method)(backend, server, *args)
+
+    def _promote_remote_members(self, api, model, servers):
+        """Plan raising the weight of remote members while local ones are down.
+
+        :param api: Client of the running haproxy
+        :type api: haproxy_runtime.HAProxyRuntimeAPI
+        :param model: Loadbalancer model haproxy runs
+        :type model: lb_model.LoadbalancerModel
+        :param servers: Server slots of the running haproxy
+        :type servers: Dict[str, List[Dict]]
+        :returns: The updated server slots and the runtime API calls making
+                  them
+        :rtype: Tuple[Dict[str, List[Dict]], List[Tuple]]
+        :raises: OSError, haproxy_runtime.HAProxyRuntimeError
+        """
+        backends = [
+            backend for backend in model.backends
+            if any(
+                'promoted_weight' in slot or 'promoted' in slot
+                for slot in servers.get(backend.service, []))]
+        if not backends:
+            return servers, []
+        statuses = {}
+        for stat in api.show_stat():
+            statuses.setdefault(stat['pxname'], {})[stat['svname']] = (
+                stat.get('status'))
+        servers = dict(servers)
+        calls = []
+        for backend in backends:
+            slots, backend_calls = haproxy_runtime.plan_promotions(
+                servers[backend.service],
+                statuses.get(backend.name, {}),
+                backend.min_local)
+            calls.extend(
+                (backend.name, method, server, args)
+                for method, server, args in backend_calls)
+            servers[backend.service] = slots
+        return servers, calls
+
+    def _complete_drains(self, api, servers):
+        """Plan putting members which finished draining into maintenance.
+
+        :param api: Client of the running haproxy
+        :type api: haproxy_runtime.HAProxyRuntimeAPI
+        :param servers: Server slots of the running haproxy
+        :type servers: Dict[str, List[Dict]]
+        :returns: The updated server slots and the runtime API calls making
+                  them
+        :rtype: Tuple[Dict[str, List[Dict]], List[Tuple]]
+        :raises: OSError, haproxy_runtime.HAProxyRuntimeError
+        """
+        draining = [
+            service for service, slots in servers.items()
+            if any('draining' in slot for slot in slots)]
+        if not draining:
+            return servers, []
+        sessions = {}
+        for stat in api.show_stat():
+            sessions.setdefault(stat['pxname'], {})[stat['svname']] = int(
+                stat.get('scur') or 0)
+        servers = dict(servers)
+        calls = []
+        for service in draining:
+            backend = '{}_back'.format(service)
+            servers[service], backend_calls = haproxy_runtime.complete_drains(
+                servers[service],
+                sessions.get(backend, {}),
+                time.time(),
+                self.config.get('drain-timeout') or 0)
+            calls.extend(
+                (backend, method, server, args)
+                for method, server, args in backend_calls)
+        return servers, calls
+
+    def _count_old_workers(self):
+        """Count old haproxy workers still finishing their sessions."""
+        master = haproxy_runtime.HAProxyRuntimeAPI(
+            haproxy_runtime.MASTER_SOCKET)
+        try:
+            processes = master.show_proc()
+        except (OSError, haproxy_runtime.HAProxyRuntimeError) as e:
+            logging.warning("Unable to list haproxy processes: %s", e)
+            return
+        self._stored.haproxy_old_workers = sum(
+            1 for process in processes
+            if process['section'] == 'old workers')
+
+    def _on_update_status(self, event):
+        self._count_old_workers()
+        api = haproxy_runtime.HAProxyRuntimeAPI()
+        servers = json.loads(self._stored.haproxy_servers)
+        try:
+            servers, calls = self._complete_drains(api, servers)
+            self._call_runtime_api(api, calls)
+        except (OSError, haproxy_runtime.HAProxyRuntimeError) as e:
+            logging.warning("Unable to complete draining members: %s", e)
+            return
+        self._stored.haproxy_servers = json.dumps(servers)
+        if not any(
+                'promoted_weight' in slot or 'promoted' in slot
+                for slots in servers.values() for slot in slots):
+            return
+        try:
+            servers, calls = self._promote_remote_members(
+                api,
+                self._get_loadbalancer_model(),
+                servers)
+            self._call_runtime_api(api, calls)
+        except (OSError, haproxy_runtime.HAProxyRuntimeError) as e:
+            logging.warning("Unable to promote remote members: %s", e)
+            return
+        self._stored.haproxy_servers = json.dumps(servers)
+
+    def _get_sysctl_overrides(self):
+        overrides = self.config.get('sysctl')
+        if not overrides:
+            return {}
+        try:
+            overrides = yaml.safe_load(overrides)
+        except yaml.YAMLError:
+            overrides = None
+        if not isinstance(overrides, dict):
+            logger.warning(
+                "Ignoring invalid sysctl: %s", self.config.get('sysctl'))
+            return {}
+        return overrides
+
+    def _get_sysctl_profile(self, model):
+        ports = [frontend.port for frontend in model.frontends]
+        if model.metrics:
+            ports.append(model.metrics.port)
+        return host_tuning.compute_sysctl(
+            model.sizing.maxconn,
+            reserved_ports=ports,
+            overrides=self._get_sysctl_overrides())
+
+    def _configure_sysctl(self, model):
+        """Apply the kernel settings haproxy needs, if they changed."""
+        profile = self._get_sysctl_profile(model)
+        if profile == json.loads(self._stored.sysctl_profile):
+            return
+        logging.info("Applying sysctl profile")
+        ch_sysctl.create(profile, str(self.SYSCTL_CONF), ignore=True)
+        unapplied = host_tuning.unapplied_sysctl(profile)
+        if unapplied:
+            logger.warning(
+                "Kernel did not take sysctl settings: %s",
+                ' '.join(unapplied))
+        self._stored.sysctl_profile = json.dumps(profile)
+        self._stored.sysctl_unapplied = json.dumps(unapplied)
 
     def _configure_haproxy(self):
-        @ch_host.restart_on_change(self.RESTART_MAP,
-                                   restart_functions=self.RFUNCS)
-        def _render_configs():
-            for config_file in self.RESTART_MAP.keys():
-                ch_templating.render(
-                    os.path.basename(config_file),
-                    config_file,
-                    self.adapters)
-        logging.info("Rendering config")
-        _render_configs()
+        """Configure haproxy from the loadbalancer model.
+
+        :returns: The loadbalancer model
+        :rtype: lb_model.LoadbalancerModel
+        """
+        model = self._get_loadbalancer_model()
+        self._configure_sysctl(model)
+        digest = model.digest()
+        if digest == self._stored.haproxy_model_digest:
+            logging.info("Loadbalancer model unchanged, skipping render")
+            self._stored.haproxy_config_rejected = False
+            return model
+        layout = model.layout()
+        api = haproxy_runtime.HAProxyRuntimeAPI()
+        live_update = None
+        if layout == json.loads(self._stored.haproxy_layout):
+            live_update = self._plan_live_update(
+                api,
+                model,
+                json.loads(self._stored.haproxy_servers))
+        if live_update is None:
+            servers = haproxy_runtime.allocate_model_servers(model)
+
+            @ch_host.restart_on_change(
+                self.RESTART_MAP,
+                restart_functions={
+                    self.HAPROXY_SERVICE: self._reload_haproxy})
+            def _render_configs():
+                return self._render_haproxy_config(model, servers)
+            logging.info("Rendering config")
+            installed = _render_configs()
+        else:
+            servers, calls = live_update
+            logging.info("Rendering config, members updated live")
+            installed = self._render_haproxy_config(model, servers)
+            if installed:
+                try:
+                    self._call_runtime_api(api, calls)
+                except (OSError, haproxy_runtime.HAProxyRuntimeError) as e:
+                    # The installed config has the updated servers.
+                    logging.warning(
+                        "Runtime update of haproxy failed, reloading: %s", e)
+                    self._reload_haproxy(self.HAPROXY_SERVICE)
+        if not installed:
+            return model
+        self._stored.haproxy_layout = json.dumps(layout)
+        self._stored.haproxy_servers = json.dumps(servers)
+        self._stored.haproxy_model_digest = digest
+        self._stored.haproxy_sizing = json.dumps(
+            dataclasses.asdict(model.sizing))
+        return model
+
+    def _on_config_changed(self, event):
+        # Juju also runs config-changed when the addresses of the machine
+        # change.
+        self._stored.vip_space_index = json.dumps(None)
+        self._process_lb_requests(event)
+        self._publish_metrics_target()
+        if self.model.relations['ha']:
+            self._configure_hacluster(event)
+
+    def _on_upgrade_charm(self, event):
+        self._stored.vip_space_index = json.dumps(None)
+        # The template may have changed so force a full render and reload.
+        self._stored.haproxy_layout = json.dumps(None)
+        self._stored.haproxy_model_digest = None
+        self._stored.sysctl_profile = json.dumps(None)
+        template_cache.precompile(
+            str(self.charm_dir / 'templates'),
+            self.TEMPLATE_CACHE)
+
+    def _on_show_sizing_action(self, event):
+        cpus = host_tuning.get_cpus()
+        memory = host_tuning.get_memory()
+        sizing = self._get_haproxy_sizing(
+            len(self.adapters.loadbalancer.endpoints))
+        results = {
+            'cpus': len(cpus),
+            'memory-mb': memory // 2**20}
+        for key, value in dataclasses.asdict(sizing).items():
+            results[key.replace('_', '-')] = value
+        rendered = json.loads(self._stored.haproxy_sizing)
+        results['rendered'] = rendered == dataclasses.asdict(sizing)
+        profile = json.loads(self._stored.sysctl_profile)
+        if profile:
+            results['sysctl'] = '\n'.join(
+                '{}={}'.format(key, value) for key, value in profile.items())
+        event.set_results(results)
+
+    def _on_show_stats_action(self, event):
+        api = haproxy_runtime.HAProxyRuntimeAPI()
+        window = event.params.get('window') or 0
+        try:
+            previous = None
+            if window:
+                previous = api.show_stat()
+                time.sleep(window)
+            summaries = haproxy_runtime.summarize_stats(
+                api.show_stat(),
+                api.show_servers_state(),
+                previous=previous,
+                window=window)
+            info = api.show_info()
+        except (OSError, haproxy_runtime.HAProxyRuntimeError) as e:
+            event.fail("Unable to read haproxy stats: {}".format(e))
+            return
+        if event.params.get('format') == 'json':
+            stats = json.dumps(summaries, indent=2)
+        else:
+            stats = haproxy_runtime.format_stats_table(summaries)
+        self._count_old_workers()
+        last_reload = json.loads(self._stored.haproxy_last_reload) or {}
+        results = {
+            'version': info.get('Version'),
+            'uptime-sec': info.get('Uptime_sec'),
+            'current-connections': info.get('CurrConns'),
+            'reloads': self._stored.haproxy_reloads,
+            'last-reload-duration-sec': last_reload.get('duration'),
+            'old-workers': self._stored.haproxy_old_workers,
+            'stats': stats}
+        # Zero counters are reported, only what haproxy lacks is left out.
+        event.set_results({
+            key: value for key, value in results.items()
+            if value is not None})
+
+    def _on_show_clients_action(self, event):
+        api = haproxy_runtime.HAProxyRuntimeAPI()
+        try:
+            clients = haproxy_runtime.top_clients(
+                {
+                    table: api.show_table(table)
+                    for table in api.show_tables()},
+                limit=event.params.get('limit'))
+        except (OSError, haproxy_runtime.HAProxyRuntimeError) as e:
+            event.fail("Unable to read haproxy stick tables: {}".format(e))
+            return
+        if event.params.get('format') == 'json':
+            event.set_results({'clients': json.dumps(clients, indent=2)})
+        else:
+            event.set_results({
+                'clients': haproxy_runtime.format_clients_table(clients)})
+
+    def _on_show_logs_action(self, event):
+        if self.config.get('haproxy-log-target') != 'ring':
+            event.fail("Logs are only kept by haproxy with the ring target")
+            return
+        api = haproxy_runtime.HAProxyRuntimeAPI()
+        try:
+            messages = api.show_events(lb_model.LOG_RING)
+        except (OSError, haproxy_runtime.HAProxyRuntimeError) as e:
+            event.fail("Unable to read haproxy logs: {}".format(e))
+            return
+        event.set_results({
+            'logs': '\n'.join(messages[-event.params.get('lines'):])})
+
+    def _get_status_messages(self):
+        """Details of the running haproxy to show in the unit status."""
+        messages = []
+        sizing = json.loads(self._stored.haproxy_sizing)
+        if sizing:
+            messages.append(
+                'nbthread={nbthread} maxconn={maxconn}'.format(**sizing))
+        index = json.loads(self._stored.vip_space_index)
+        if index and (index['unmatched'] or index['ambiguous']):
+            messages.append('VIPs not in exactly one space: {}'.format(
+                ' '.join(index['unmatched'] + index['ambiguous'])))
+        invalid = [
+            option
+            for option, value in self._decode_certificate_options().items()
+            if value is None]
+        if invalid:
+            messages.append('invalid base64 in {}, TLS disabled'.format(
+                ' '.join(invalid)))
+        if self._stored.haproxy_config_rejected:
+            messages.append('haproxy -c rejected the config, see log')
+        if self._stored.haproxy_config_unchecked:
+            messages.append('config not checked, haproxy not installed')
+        if self._stored.haproxy_reloads:
+            messages.append('reloads={} old-workers={}'.format(
+                self._stored.haproxy_reloads,
+                self._stored.haproxy_old_workers))
+        unapplied = json.loads(self._stored.sysctl_unapplied)
+        if unapplied:
+            messages.append('sysctl not applied: {}'.format(
+                ' '.join(unapplied)))
+        draining = sum(
+            1
+            for slots in json.loads(self._stored.haproxy_servers).values()
+            for slot in slots
+            if 'draining' in slot)
+        if draining:
+            messages.append('draining={}'.format(draining))
+        promoted = sorted(
+            service
+            for service, slots in json.loads(
+                self._stored.haproxy_servers).items()
+            if any('promoted' in slot for slot in slots))
+        if promoted:
+            messages.append('remote members promoted: {}'.format(
+                ' '.join(promoted)))
+        return messages
+
+    def _update_status_message(self, event):
+        if not isinstance(self.unit.status, ActiveStatus):
+            return
+        messages = self._get_status_messages()
+        if messages:
+            self.unit.status = ActiveStatus(
+                'Unit is ready ({})'.format(', '.join(messages)))
+
+    def _on_leader_elected(self, event):
+        # Nothing is known to have been advertised by this unit.
+        self._stored.lb_advertised = json.dumps({})
+        self._process_lb_requests(event)
 
     def _process_lb_requests(self, event):
-        self._configure_haproxy()
-        self._send_loadbalancer_response()
+        """Mark the loadbalancer config dirty.
+
+        The work is done once per dispatch by _apply_lb_requests so that a
+        burst of events results in a single render and reload.
+        """
+        self._stored.lb_pending_events += 1
+        self._lb_dispatch_events += 1
+        if self._stored.lb_pending_since is None:
+            self._stored.lb_pending_since = time.time()
+
+    def _applies_held_back_events(self):
+        """Whether this dispatch may apply events of earlier dispatches.
+
+        :rtype: bool
+        """
+        dispatch_path = os.environ.get('JUJU_DISPATCH_PATH', '')
+        if dispatch_path.startswith('actions/'):
+            return False
+        return dispatch_path not in self.NO_APPLY_HOOKS
+
+    def _apply_lb_requests(self, event):
+        """Configure haproxy and publish endpoints for pending events.
+
+        Events are held back while the coalesce window has not passed and
+        every dispatch brings new ones. The first dispatch without a
+        loadbalancer event ends the burst and applies them, unless it is an
+        action or one of NO_APPLY_HOOKS. Events stay pending while haproxy
+        rejects the config.
+        """
+        pending = self._stored.lb_pending_events
+        dispatch_events = self._lb_dispatch_events
+        self._lb_dispatch_events = 0
+        if not pending:
+            return
+        if not dispatch_events and not self._applies_held_back_events():
+            logging.debug(
+                "Not applying %d loadbalancer event(s) in this dispatch",
+                pending)
+            return
+        window = self.config.get('lb-coalesce-window') or 0
+        waited = time.time() - self._stored.lb_pending_since
+        if dispatch_events and waited < window:
+            logging.info(
+                "Holding back %d loadbalancer event(s), %ds of %ds "
+                "coalesce window elapsed", pending, waited, window)
+            return
+        model = self._configure_haproxy()
+        if self._stored.haproxy_config_rejected:
+            # Retried on the next dispatch, the endpoints haproxy serves are
+            # still advertised.
+            logging.warning(
+                "haproxy rejected the config, keeping %d loadbalancer "
+                "event(s) pending", pending)
+            return
+        self._send_loadbalancer_response(model)
+        logging.info(
+            "Applied loadbalancer config, %d event(s) folded", pending)
+        self._stored.lb_last_folded_events = pending
+        self._stored.lb_pending_events = 0
+        self._stored.lb_pending_since = None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,633 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Access to the HAProxy runtime API exposed on the admin stats socket."""
+
+import dataclasses
+import logging
+import socket
+
+logger = logging.getLogger(__name__)
+
+ADMIN_SOCKET = '/run/haproxy/admin.sock'
+# Socket of the master CLI, as passed with -S by the haproxy systemd unit.
+MASTER_SOCKET = '/run/haproxy-master.sock'
+
+# Placeholder address rendered for server slots which have no member.
+SPARE_ADDRESS = '127.0.0.1'
+
+# Prefixes HAProxy uses when it refuses a runtime API command.
+_ERROR_PREFIXES = (
+    'No such',
+    'Require',
+    'Unknown command',
+    'Permission denied',
+    'Invalid',
+    "Can't",
+    'Cannot',
+)
+
+# Columns of the table rendered by format_stats_table, followed by the
+# counters.
+STATS_TABLE_COLUMNS = (
+    'service', 'current-sessions', 'session-rate', 'queue', 'queue-max',
+    'queue-time', 'connect-time', 'response-time', 'servers-up')
+
+# Columns of the table rendered by format_clients_table.
+CLIENTS_TABLE_COLUMNS = (
+    'frontend', 'client', 'conn-cur', 'conn-rate', 'http-req-rate')
+
+
+class HAProxyRuntimeError(Exception):
+    """Raised when HAProxy rejects a runtime API command."""
+
+
+class HAProxyRuntimeAPI:
+    """Client for the HAProxy runtime API on a unix socket."""
+
+    def __init__(self, socket_path=ADMIN_SOCKET, timeout=5.0):
+        """Setup client.
+
+        :param socket_path: Path to the HAProxy admin socket
+        :type socket_path: str
+        :param timeout: Socket timeout in seconds
+        :type timeout: float
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def execute(self, command):
+        """Run a single runtime API command and return the raw response.
+
+        :param command: Runtime API command
+        :type command: str
+        :returns: Response from HAProxy
+        :rtype: str
+        :raises: OSError if the socket is unavailable
+        """
+        logger.debug("HAProxy runtime API: %s", command)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall('{}\n'.format(command).encode())
+            chunks = []
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+        return b''.join(chunks).decode()
+
+    def _execute_checked(self, command):
+        response = self.execute(command)
+        if response.strip().startswith(_ERROR_PREFIXES):
+            raise HAProxyRuntimeError(
+                "'{}' failed: {}".format(command, response.strip()))
+        return response
+
+    def set_server_addr(self, backend, server, address, port):
+        """Point a server slot at a new address and port.
+
+        :param backend: Name of backend
+        :type backend: str
+        :param server: Name of server in backend
+        :type server: str
+        :param address: IP address of server
+        :type address: str
+        :param port: Port of server
+        :type port: int
+        :raises: HAProxyRuntimeError
+        """
+        self._execute_checked(
+            'set server {}/{} addr {} port {}'.format(
+                backend, server, address, port))
+
+    def set_server_state(self, backend, server, state):
+        """Change the administrative state of a server slot.
+
+        :param backend: Name of backend
+        :type backend: str
+        :param server: Name of server in backend
+        :type server: str
+        :param state: One of ready, drain or maint
+        :type state: str
+        :raises: HAProxyRuntimeError
+        """
+        self._execute_checked(
+            'set server {}/{} state {}'.format(backend, server, state))
+
+    def set_server_weight(self, backend, server, weight):
+        """Change the weight of a server.
+
+        :param backend: Name of the backend
+        :type backend: str
+        :param server: Name of the server
+        :type server: str
+        :param weight: The weight
+        :type weight: int
+        :raises: HAProxyRuntimeError
+        """
+        self._execute_checked(
+            'set weight {}/{} {}'.format(backend, server, weight))
+
+    def show_servers_state(self, backend=None):
+        """Return the state of servers as known by HAProxy.
+
+        :param backend: Only return servers from this backend
+        :type backend: Optional[str]
+        :returns: List of server state dicts keyed on HAProxy field names
+        :rtype: List[Dict[str, str]]
+        :raises: HAProxyRuntimeError
+        """
+        command = 'show servers state'
+        if backend:
+            command = '{} {}'.format(command, backend)
+        response = self._execute_checked(command)
+        fields = []
+        servers = []
+        for line in response.splitlines():
+            if line.startswith('# '):
+                fields = line[2:].split()
+            elif fields and line.strip():
+                servers.append(dict(zip(fields, line.split())))
+        return servers
+
+    def show_stat(self):
+        """Return the statistics of frontends, backends and servers.
+
+        :returns: List of stat dicts keyed on HAProxy CSV field names
+        :rtype: List[Dict[str, str]]
+        :raises: HAProxyRuntimeError
+        """
+        response = self._execute_checked('show stat')
+        fields = []
+        stats = []
+        for line in response.splitlines():
+            if line.startswith('# '):
+                fields = line[2:].split(',')
+            elif fields and line.strip():
+                stats.append(dict(zip(fields, line.split(','))))
+        return stats
+
+    def show_events(self, ring):
+        """Return the messages held in a ring buffer, oldest first.
+
+        :param ring: Name of the ring
+        :type ring: str
+        :returns: The messages
+        :rtype: List[str]
+        :raises: HAProxyRuntimeError
+        """
+        response = self._execute_checked('show events {}'.format(ring))
+        return [line for line in response.splitlines() if line.strip()]
+
+    def show_proc(self):
+        """Return the processes of haproxy, through the master CLI.
+
+        Each process has the section of the output it is listed in:
+        master, workers, old workers or programs.
+
+        :returns: List of process dicts
+        :rtype: List[Dict[str, str]]
+        :raises: HAProxyRuntimeError
+        """
+        processes = []
+        section = 'master'
+        for line in self._execute_checked('show proc').splitlines():
+            if line.startswith('#<'):
+                continue
+            if line.startswith('# '):
+                section = line[2:].strip()
+                continue
+            fields = line.split()
+            if len(fields) < 5:
+                continue
+            processes.append({
+                'section': section,
+                'pid': fields[0],
+                'type': fields[1],
+                'reloads': fields[2],
+                'uptime': fields[-2],
+                'version': fields[-1]})
+        return processes
+
+    def show_info(self):
+        """Return process wide information such as version and uptime.
+
+        :returns: Dict of information keyed on HAProxy field names
+        :rtype: Dict[str, str]
+        :raises: HAProxyRuntimeError
+        """
+        info = {}
+        for line in self._execute_checked('show info').splitlines():
+            key, sep, value = line.partition(':')
+            if sep:
+                info[key.strip()] = value.strip()
+        return info
+
+    def show_tables(self):
+        """Return the names of the stick tables.
+
+        :returns: Names of the stick tables
+        :rtype: List[str]
+        :raises: HAProxyRuntimeError
+        """
+        tables = []
+        for line in self._execute_checked('show table').splitlines():
+            if line.startswith('# table: '):
+                tables.append(line[len('# table: '):].split(',')[0])
+        return tables
+
+    def show_table(self, table):
+        """Return the entries of a stick table.
+
+        Counters over a period, such as conn_rate(10000), are keyed without
+        their period.
+
+        :param table: Name of the table
+        :type table: str
+        :returns: List of entry dicts keyed on HAProxy field names
+        :rtype: List[Dict[str, str]]
+        :raises: HAProxyRuntimeError
+        """
+        entries = []
+        response = self._execute_checked('show table {}'.format(table))
+        for line in response.splitlines():
+            if line.startswith('#') or ': ' not in line:
+                continue
+            entry = {}
+            for field in line.split(': ', 1)[1].split():
+                key, sep, value = field.partition('=')
+                if sep:
+                    entry[key.split('(')[0]] = value
+            entries.append(entry)
+        return entries
+
+
+def _stat_int(stat, field):
+    try:
+        return int(stat.get(field) or 0)
+    except ValueError:
+        return 0
+
+
+def _backend_counters(stat):
+    """Cumulative counters of a backend."""
+    return {
+        'sessions': _stat_int(stat, 'stot'),
+        'errors': _stat_int(stat, 'econ') + _stat_int(stat, 'eresp'),
+        'retries': _stat_int(stat, 'wretr'),
+        'cache-lookups': _stat_int(stat, 'cache_lookups'),
+        'cache-hits': _stat_int(stat, 'cache_hits')}
+
+
+def summarize_stats(stats, servers_state, previous=None, window=None):
+    """Summarize the performance of each backend.
+
+    Counters are reported as totals, or as rates per second when the stats
+    of a previous sample taken window seconds earlier are given.
+
+    :param stats: Output of show_stat
+    :type stats: List[Dict[str, str]]
+    :param servers_state: Output of show_servers_state
+    :type servers_state: List[Dict[str, str]]
+    :param previous: Output of show_stat at the start of the window
+    :type previous: Optional[List[Dict[str, str]]]
+    :param window: Seconds between the two samples
+    :type window: Optional[float]
+    :returns: List of backend summaries
+    :rtype: List[Dict]
+    """
+    addresses = {
+        (s['be_name'], s['srv_name']): s['srv_addr'] for s in servers_state}
+    before = {
+        (s['pxname'], s['svname']): s for s in previous or []}
+    summaries = []
+    for stat in stats:
+        if stat['svname'] != 'BACKEND':
+            continue
+        backend = stat['pxname']
+        summary = {
+            'service': backend[:-len('_back')] if backend.endswith(
+                '_back') else backend,
+            'current-sessions': _stat_int(stat, 'scur'),
+            'session-rate': _stat_int(stat, 'rate'),
+            'queue': _stat_int(stat, 'qcur'),
+            'queue-max': _stat_int(stat, 'qmax'),
+            'queue-time': _stat_int(stat, 'qtime'),
+            'connect-time': _stat_int(stat, 'ctime'),
+            'response-time': _stat_int(stat, 'rtime')}
+        counters = _backend_counters(stat)
+        start = before.get((backend, 'BACKEND'))
+        if start is not None and window:
+            start_counters = _backend_counters(start)
+            counters = {
+                '{}-per-s'.format(key): round(
+                    (value - start_counters[key]) / window, 2)
+                for key, value in counters.items()}
+        summary.update(counters)
+        servers = []
+        for server in stats:
+            if server['pxname'] != backend or server['svname'] in (
+                    'BACKEND', 'FRONTEND'):
+                continue
+            address = addresses.get((backend, server['svname']))
+            if address == SPARE_ADDRESS:
+                continue
+            servers.append({
+                'name': server['svname'],
+                'address': address,
+                'status': server.get('status'),
+                'check': server.get('check_status')})
+        summary['servers-up'] = '{}/{}'.format(
+            sum(1 for s in servers if s['status'] == 'UP'),
+            len(servers))
+        summary['servers'] = servers
+        summaries.append(summary)
+    return summaries
+
+
+def format_stats_table(summaries):
+    """Render backend summaries as a plain text table.
+
+    :param summaries: Output of summarize_stats
+    :type summaries: List[Dict]
+    :returns: The table
+    :rtype: str
+    """
+    columns = list(STATS_TABLE_COLUMNS)
+    # Show whichever counters, totals or rates, the summaries carry.
+    if summaries:
+        columns.extend(
+            key for key in summaries[0]
+            if key not in columns and key != 'servers')
+    return _format_table(columns, summaries)
+
+
+def top_clients(tables, limit=10):
+    """Clients tracked by the rate limits of each frontend, busiest first.
+
+    :param tables: Output of show_table keyed on table name
+    :type tables: Dict[str, List[Dict[str, str]]]
+    :param limit: Number of clients listed per frontend
+    :type limit: int
+    :returns: List of client dicts
+    :rtype: List[Dict]
+    """
+    clients = []
+    for table, entries in sorted(tables.items()):
+        frontend = table[:-len('_front')] if table.endswith(
+            '_front') else table
+        counted = [
+            {
+                'frontend': frontend,
+                'client': entry.get('key'),
+                'conn-cur': _stat_int(entry, 'conn_cur'),
+                'conn-rate': _stat_int(entry, 'conn_rate'),
+                'http-req-rate': _stat_int(entry, 'http_req_rate')}
+            for entry in entries]
+        counted.sort(
+            key=lambda c: (c['http-req-rate'], c['conn-rate'], c['conn-cur']),
+            reverse=True)
+        clients.extend(counted[:limit])
+    return clients
+
+
+def format_clients_table(clients):
+    """Render clients as a plain text table.
+
+    :param clients: Output of top_clients
+    :type clients: List[Dict]
+    :returns: The table
+    :rtype: str
+    """
+    return _format_table(CLIENTS_TABLE_COLUMNS, clients)
+
+
+def _format_table(columns, items):
+    rows = [list(columns)] + [
+        [str(item[column]) for column in columns]
+        for item in items]
+    widths = [max(len(value) for value in column) for column in zip(*rows)]
+    return '\n'.join(
+        '  '.join(
+            value.ljust(width) for value, width in zip(row, widths)).rstrip()
+        for row in rows)
+
+
+def allocate_server_slots(members, spare_slots, default_port,
+                          spare_params=None):
+    """Allocate a fresh set of server slots for a backend.
+
+    Each member gets a slot and spare slots are appended so that members
+    can be added later through the runtime API without a reload. A slot
+    keeps the server params it was rendered with.
+
+    :param members: Backend members
+    :type members: List[Dict[str, Union[str, int, Dict]]]
+    :param spare_slots: Number of empty slots to add
+    :type spare_slots: int
+    :param default_port: Port to render for empty slots
+    :type default_port: int
+    :param spare_params: Server params to render for empty slots
+    :type spare_params: Optional[Dict]
+    :returns: List of server slots
+    :rtype: List[Dict[str, Union[str, int, Dict, None]]]
+    """
+    slots = [
+        {
+            'name': 'srv{}'.format(idx),
+            'unit': member['unit_name'],
+            'ip': member['backend_ip'],
+            'port': member['backend_port'],
+            'params': member.get('params', {})}
+        for idx, member in enumerate(members, start=1)]
+    for slot, member in zip(slots, members):
+        _set_promoted_weight(slot, member)
+    for idx in range(len(slots) + 1, len(slots) + spare_slots + 1):
+        slots.append({
+            'name': 'srv{}'.format(idx),
+            'unit': None,
+            'ip': SPARE_ADDRESS,
+            'port': default_port,
+            'params': spare_params or {}})
+    return slots
+
+
+def allocate_model_servers(model):
+    """Allocate a fresh set of server slots for every backend of a model.
+
+    :param model: Loadbalancer model to render
+    :type model: lb_model.LoadbalancerModel
+    :returns: Server slots of each backend, keyed on service
+    :rtype: Dict[str, List[Dict]]
+    """
+    return {
+        backend.service: allocate_server_slots(
+            [dataclasses.asdict(member) for member in backend.members],
+            model.spare_slots,
+            frontend.port,
+            spare_params=dataclasses.asdict(backend.server_defaults))
+        for frontend, backend in model.services()}
+
+
+def _set_promoted_weight(slot, member):
+    if member.get('promoted_weight'):
+        slot['promoted_weight'] = member['promoted_weight']
+    else:
+        slot.pop('promoted_weight', None)
+
+
+def plan_server_updates(slots, members, drain_since=None):
+    """Work out the runtime API calls which move slots to the given members.
+
+    Only addresses and states are changed at runtime, a member whose server
+    params differ from those its slot was rendered with needs a reload.
+
+    Departing members are put into drain, so that they finish the sessions
+    they have but get no new ones, and keep their slot until
+    complete_drains frees it. A draining member which comes back is made
+    ready again.
+
+    :param slots: Current server slots of a backend
+    :type slots: List[Dict[str, Union[str, int, Dict, None]]]
+    :param members: Desired backend members
+    :type members: List[Dict[str, Union[str, int, Dict]]]
+    :param drain_since: Time departing members start draining, None puts
+                        them into maintenance straight away
+    :type drain_since: Optional[float]
+    :returns: The updated slots and a list of (method, server, args) calls
+              or None if the members cannot be placed in the slots.
+    :rtype: Optional[Tuple[List[Dict], List[Tuple[str, str, Tuple]]]]
+    """
+    wanted = {member['unit_name']: member for member in members}
+    new_slots = [dict(slot) for slot in slots]
+    calls = []
+    for slot in new_slots:
+        if slot['unit'] is None:
+            continue
+        member = wanted.pop(slot['unit'], None)
+        if member is None:
+            if drain_since is None:
+                calls.append(('set_server_state', slot['name'], ('maint',)))
+                slot['unit'] = None
+                slot.pop('draining', None)
+            elif 'draining' not in slot:
+                calls.append(('set_server_state', slot['name'], ('drain',)))
+                slot['draining'] = drain_since
+            continue
+        draining = slot.pop('draining', None)
+        if member.get('params', {}) != slot.get('params', {}):
+            return None
+        _set_promoted_weight(slot, member)
+        if (member['backend_ip'], member['backend_port']) != (
+                slot['ip'], slot['port']):
+            slot['ip'] = member['backend_ip']
+            slot['port'] = member['backend_port']
+            calls.append((
+                'set_server_addr',
+                slot['name'],
+                (slot['ip'], slot['port'])))
+        if draining is not None:
+            calls.append(('set_server_state', slot['name'], ('ready',)))
+    free_slots = [slot for slot in new_slots if slot['unit'] is None]
+    for unit_name, member in sorted(wanted.items()):
+        slot = next(
+            (
+                s for s in free_slots
+                if s.get('params', {}) == member.get('params', {})),
+            None)
+        if slot is None:
+            return None
+        free_slots.remove(slot)
+        slot['unit'] = unit_name
+        slot['ip'] = member['backend_ip']
+        slot['port'] = member['backend_port']
+        _set_promoted_weight(slot, member)
+        calls.append((
+            'set_server_addr',
+            slot['name'],
+            (slot['ip'], slot['port'])))
+        calls.append(('set_server_state', slot['name'], ('ready',)))
+    return new_slots, calls
+
+
+def complete_drains(slots, sessions, now, timeout):
+    """Work out the runtime API calls which retire drained members.
+
+    A draining member is put into maintenance, freeing its slot, once it
+    has no sessions left or has been draining for longer than the timeout.
+
+    :param slots: Current server slots of a backend
+    :type slots: List[Dict[str, Union[str, int, Dict, None]]]
+    :param sessions: Current sessions keyed on server name
+    :type sessions: Dict[str, int]
+    :param now: Current time
+    :type now: float
+    :param timeout: Seconds a member may drain for
+    :type timeout: float
+    :returns: The updated slots and a list of (method, server, args) calls
+    :rtype: Tuple[List[Dict], List[Tuple[str, str, Tuple]]]
+    """
+    new_slots = [dict(slot) for slot in slots]
+    calls = []
+    for slot in new_slots:
+        if 'draining' not in slot:
+            continue
+        if sessions.get(slot['name']) and now - slot['draining'] < timeout:
+            continue
+        calls.append(('set_server_state', slot['name'], ('maint',)))
+        slot['unit'] = None
+        del slot['draining']
+    return new_slots, calls
+
+
+def plan_promotions(slots, statuses, min_local):
+    """Work out the runtime API calls which promote remote members.
+
+    Remote members, those with a promoted weight, are raised to it while
+    fewer than min_local of the other members are up, and lowered back
+    to the weight they were rendered with once enough are.
+
+    :param slots: Current server slots of a backend
+    :type slots: List[Dict[str, Union[str, int, Dict, None]]]
+    :param statuses: Status of each server keyed on server name
+    :type statuses: Dict[str, str]
+    :param min_local: Number of local members which need to be up
+    :type min_local: int
+    :returns: The updated slots and a list of (method, server, args) calls
+    :rtype: Tuple[List[Dict], List[Tuple[str, str, Tuple]]]
+    """
+    local_up = sum(
+        1 for slot in slots
+        if slot['unit'] and not slot.get('promoted_weight') and (
+            (statuses.get(slot['name']) or '').startswith('UP')))
+    promote = local_up < min_local
+    new_slots = [dict(slot) for slot in slots]
+    calls = []
+    for slot in new_slots:
+        if promote and slot['unit'] and slot.get('promoted_weight'):
+            if not slot.get('promoted'):
+                calls.append((
+                    'set_server_weight',
+                    slot['name'],
+                    (slot['promoted_weight'],)))
+                slot['promoted'] = True
+        elif slot.get('promoted'):
+            calls.append((
+                'set_server_weight',
+                slot['name'],
+                (slot['params'].get('weight') or 1,)))
+            del slot['promoted']
+    return new_slots, calls
@@ -0,0 +1,252 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Size haproxy for the host it runs on."""
+
+import os
+
+import lb_model
+
+# haproxy defaults for the buffer sizes.
+DEFAULT_BUFSIZE = 16384
+DEFAULT_MAXREWRITE = 1024
+# haproxy is built with support for at most this many threads.
+MAX_THREADS = 64
+# Share of the host memory haproxy connections may use.
+MEMORY_SHARE = 0.5
+# Memory used per connection on top of its two buffers, covering session
+# state and kernel socket buffers.
+CONNECTION_OVERHEAD = 16384
+MIN_MAXCONN = 256
+# Upper bound of the derived connection limit. Each connection takes a file
+# descriptor on the client and on the member side, this stays well below
+# the fs.nr_open default of 1048576 descriptors haproxy may raise its limit
+# to.
+MAX_MAXCONN = 2 * 2**16
+# haproxy default number of TLS sessions cached.
+DEFAULT_SSL_CACHESIZE = 20000
+# Bounds of the accept and SYN backlogs. Older kernels cap somaxconn at
+# 65535.
+MIN_BACKLOG = 4096
+MAX_BACKLOG = 65535
+# Distro default start of the ephemeral port range, and the lowest start
+# the profile uses, above the ports services commonly listen on.
+DEFAULT_LOCAL_PORT_LOW = 32768
+MIN_LOCAL_PORT_LOW = 10000
+MAX_LOCAL_PORT = 65535
+MIN_CONNTRACK_MAX = 262144
+
+PROC_SYS = '/proc/sys'
+
+MEMINFO = '/proc/meminfo'
+CGROUP_MEMORY_LIMITS = (
+    '/sys/fs/cgroup/memory.max',
+    '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+
+
+def get_cpus():
+    """CPUs this unit may run on.
+
+    :returns: Sorted list of CPU ids
+    :rtype: List[int]
+    """
+    return sorted(os.sched_getaffinity(0))
+
+
+def get_memory():
+    """Memory available to this unit, honouring container limits.
+
+    :returns: Memory in bytes
+    :rtype: int
+    """
+    memory = None
+    with open(MEMINFO) as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                memory = int(line.split()[1]) * 1024
+                break
+    for limit_file in CGROUP_MEMORY_LIMITS:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+    return memory
+
+
+def _format_ranges(values, separator):
+    """Format sorted integers, collapsing consecutive ones into ranges."""
+    ranges = []
+    for value in values:
+        if ranges and ranges[-1][1] == value - 1:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+    return separator.join(
+        str(start) if start == end else '{}-{}'.format(start, end)
+        for start, end in ranges)
+
+
+def _format_cpus(cpus):
+    """Format CPU ids as a cpu-map cpu set, collapsing ranges."""
+    return _format_ranges(cpus, ' ')
+
+
+def compute_sizing(cpus, memory, frontend_count, nbthread=0, cpu_pinning=True,
+                   maxconn=0, frontend_maxconn=0, bufsize=0, maxrewrite=0):
+    """Work out thread and connection limits for haproxy.
+
+    Any of the limits can be overridden by passing a non-zero value.
+
+    :param cpus: CPU ids available
+    :type cpus: List[int]
+    :param memory: Memory available in bytes
+    :type memory: int
+    :param frontend_count: Number of frontends rendered
+    :type frontend_count: int
+    :param nbthread: Override of the number of threads
+    :type nbthread: int
+    :param cpu_pinning: Whether to pin threads to CPUs
+    :type cpu_pinning: bool
+    :param maxconn: Override of the global connection limit
+    :type maxconn: int
+    :param frontend_maxconn: Override of the per frontend connection limit
+    :type frontend_maxconn: int
+    :param bufsize: Override of the buffer size
+    :type bufsize: int
+    :param maxrewrite: Override of the space reserved for header rewrites
+    :type maxrewrite: int
+    :returns: The sizing of haproxy
+    :rtype: lb_model.Sizing
+    """
+    nbthread = nbthread or max(1, min(len(cpus), MAX_THREADS))
+    cpu_map = None
+    if cpu_pinning and nbthread > 1 and nbthread <= len(cpus):
+        cpu_map = 'auto:1/1-{} {}'.format(
+            nbthread,
+            _format_cpus(cpus[:nbthread]))
+    bufsize = bufsize or DEFAULT_BUFSIZE
+    maxrewrite = maxrewrite or DEFAULT_MAXREWRITE
+    if not maxconn:
+        # Each connection holds a request and a response buffer.
+        per_connection = 2 * bufsize + CONNECTION_OVERHEAD
+        maxconn = min(
+            max(MIN_MAXCONN, int(memory * MEMORY_SHARE) // per_connection),
+            MAX_MAXCONN)
+    if not frontend_maxconn:
+        # Stop a single busy frontend from starving all the others.
+        frontend_maxconn = maxconn if frontend_count <= 1 else maxconn // 2
+    return lb_model.Sizing(
+        nbthread=nbthread,
+        cpu_map=cpu_map,
+        maxconn=maxconn,
+        frontend_maxconn=frontend_maxconn,
+        bufsize=bufsize,
+        maxrewrite=maxrewrite)
+
+
+def compute_ssl_cachesize(maxconn, cachesize=0):
+    """Number of TLS sessions haproxy caches for resumption.
+
+    The cache holds a session per connection haproxy may have open so that
+    reconnecting clients resume rather than do a full handshake. Each entry
+    takes around 200 bytes of shared memory.
+
+    :param maxconn: Global connection limit
+    :type maxconn: int
+    :param cachesize: Override of the number of sessions cached
+    :type cachesize: int
+    :returns: Number of sessions cached
+    :rtype: int
+    """
+    return cachesize or max(DEFAULT_SSL_CACHESIZE, maxconn)
+
+
+def compute_sysctl(maxconn, reserved_ports=(), overrides=None):
+    """Kernel network settings for haproxy to reach maxconn.
+
+    :param maxconn: Global connection limit
+    :type maxconn: int
+    :param reserved_ports: Ports haproxy listens on, kept out of the
+                           ephemeral port range
+    :type reserved_ports: List[int]
+    :param overrides: Settings replacing the derived ones, a value of None
+                      leaves the key out of the profile
+    :type overrides: Optional[Dict[str, Union[str, int, None]]]
+    :returns: Values keyed on sysctl key
+    :rtype: Dict[str, Union[str, int]]
+    """
+    backlog = min(max(maxconn, MIN_BACKLOG), MAX_BACKLOG)
+    # Each proxied connection takes an ephemeral port towards its member.
+    port_low = max(
+        MIN_LOCAL_PORT_LOW,
+        min(DEFAULT_LOCAL_PORT_LOW, MAX_LOCAL_PORT - maxconn))
+    profile = {
+        'net.core.somaxconn': backlog,
+        'net.ipv4.tcp_max_syn_backlog': backlog,
+        'net.ipv4.ip_local_port_range': '{} {}'.format(
+            port_low,
+            MAX_LOCAL_PORT),
+        'net.ipv4.tcp_tw_reuse': 1,
+        # The client and member sides of a connection are tracked
+        # separately and linger after it is closed.
+        'net.netfilter.nf_conntrack_max': max(
+            MIN_CONNTRACK_MAX,
+            4 * maxconn),
+        # Lets haproxy bind VIPs which are up on another unit.
+        'net.ipv4.ip_nonlocal_bind': 1,
+        'net.ipv6.ip_nonlocal_bind': 1,
+    }
+    if reserved_ports:
+        # Formatted as the kernel reports it.
+        profile['net.ipv4.ip_local_reserved_ports'] = _format_ranges(
+            sorted(set(reserved_ports)),
+            ',')
+    for key, value in (overrides or {}).items():
+        if value is None:
+            profile.pop(key, None)
+        else:
+            profile[key] = value
+    return profile
+
+
+def read_sysctl(key):
+    """Current value of a sysctl key, None if the kernel lacks it.
+
+    :param key: The sysctl key
+    :type key: str
+    :returns: The value with whitespace collapsed
+    :rtype: Optional[str]
+    """
+    path = os.path.join(PROC_SYS, *key.split('.'))
+    try:
+        with open(path) as f:
+            return ' '.join(f.read().split())
+    except OSError:
+        return None
+
+
+def unapplied_sysctl(profile):
+    """Keys of a profile whose value the kernel does not hold.
+
+    :param profile: Output of compute_sysctl
+    :type profile: Dict[str, Union[str, int]]
+    :returns: Sorted keys
+    :rtype: List[str]
+    """
+    return sorted(
+        key for key, value in profile.items()
+        if read_sysctl(key) != ' '.join(str(value).split()))
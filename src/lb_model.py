@@ -0,0 +1,759 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Normalized model of the desired loadbalancer configuration."""
+
+import dataclasses
+import ipaddress
+import hashlib
+import json
+import logging
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MODES = ('tcp', 'http')
+HTTP_REUSE = ('never', 'safe', 'aggressive', 'always')
+BALANCE_ALGORITHMS = ('roundrobin', 'static-rr', 'leastconn', 'first',
+                      'source', 'uri')
+# Algorithms which need the backend to be in http mode.
+HTTP_BALANCE_ALGORITHMS = ('uri',)
+# Algorithms which hash a request property onto a server.
+HASH_BALANCE_ALGORITHMS = ('source', 'uri')
+HASH_TYPES = ('map-based', 'consistent')
+
+# Ways of checking the health of members.
+CHECK_METHODS = ('http', 'tcp', 'agent')
+# Health check intervals in milliseconds and thresholds.
+CHECK_TIMINGS = ('inter', 'fastinter', 'downinter', 'rise', 'fall')
+
+# What happens to clients going over a rate limit.
+RATE_LIMIT_ACTIONS = ('deny', 'tarpit', 'queue')
+# Rate limits tracked per client address.
+RATE_LIMITS = ('conn_rate', 'conn_cur', 'http_req_rate')
+# Number of client addresses tracked per frontend.
+RATE_LIMIT_TABLE_SIZE = 100000
+
+# How members far from this unit are treated: not at all, as backup
+# servers or with a lower weight.
+LOCALITY_POLICIES = ('off', 'backup', 'weight')
+# Ranks of a member by network proximity, closest first.
+RANK_SUBNET = 0
+RANK_ZONE = 1
+RANK_REMOTE = 2
+# Weight of local members when ranking by weight and none is set.
+LOCALITY_WEIGHT = 100
+
+# Where traffic logs are sent: the local syslog socket, a ring buffer in
+# memory or a remote syslog server over UDP.
+LOG_TARGETS = ('local', 'ring', 'udp')
+# Name of the ring buffer logs are kept in by the ring target.
+LOG_RING = 'haproxy-logs'
+# Syslog levels, most severe first.
+LOG_LEVELS = (
+    'emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info', 'debug')
+
+# Timeouts, in milliseconds, applying to frontends and to backends.
+FRONTEND_TIMEOUTS = ('client', 'http_request')
+BACKEND_TIMEOUTS = ('connect', 'server', 'queue', 'tunnel')
+
+# Defaults for the options an endpoint request may carry.
+DEFAULTS = {
+    'mode': 'tcp',
+    'http_reuse': 'safe',
+    'backend_tls': True,
+    'tls_termination': True,
+    'balance': 'roundrobin',
+    'hash_type': 'consistent',
+    'weight': None,
+    'maxconn': None,
+    'maxqueue': None,
+    'check_path': '/',
+    'inter': None,
+    'fastinter': None,
+    'downinter': None,
+    'rise': None,
+    'fall': None,
+    'slowstart': None,
+    'cache': False,
+    'cache_size': 64,
+    'cache_max_object_size': None,
+    'cache_max_age': 60,
+    'cache_paths': '',
+    'rate_limit_conn_rate': None,
+    'rate_limit_conn_cur': None,
+    'rate_limit_http_req_rate': None,
+    'rate_limit_period': 10000,
+    'rate_limit_action': 'deny',
+    'log_level': None,
+    'locality': 'off',
+    'locality_remote_weight': 10,
+    'locality_min_local': 1,
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class Timeouts:
+    """haproxy timeouts in milliseconds, None leaves a timeout unset."""
+
+    connect: Optional[int] = None
+    client: Optional[int] = None
+    server: Optional[int] = None
+    queue: Optional[int] = None
+    http_request: Optional[int] = None
+    tunnel: Optional[int] = None
+
+    def items(self):
+        """Timeouts which are set.
+
+        :returns: List of (haproxy timeout name, value) tuples
+        :rtype: List[Tuple[str, int]]
+        """
+        return [
+            (field.name.replace('_', '-'), getattr(self, field.name))
+            for field in dataclasses.fields(self)
+            if getattr(self, field.name) is not None]
+
+
+@dataclasses.dataclass(frozen=True)
+class ServerParams:
+    """Settings rendered on the server line of a member."""
+
+    weight: Optional[int] = None
+    maxconn: Optional[int] = None
+    maxqueue: Optional[int] = None
+    # Only used when no other member is up.
+    backup: bool = False
+
+
+@dataclasses.dataclass(frozen=True)
+class HealthCheck:
+    """How the health of the members of a backend is checked.
+
+    Intervals are in milliseconds, None leaves the haproxy default.
+    """
+
+    method: str = 'tcp'
+    path: str = '/'
+    agent_port: Optional[int] = None
+    inter: Optional[int] = None
+    fastinter: Optional[int] = None
+    downinter: Optional[int] = None
+    rise: Optional[int] = None
+    fall: Optional[int] = None
+
+    def timings(self):
+        """Intervals and thresholds which are set.
+
+        :returns: List of (haproxy server keyword, value) tuples
+        :rtype: List[Tuple[str, int]]
+        """
+        return [
+            (name, getattr(self, name))
+            for name in CHECK_TIMINGS
+            if getattr(self, name) is not None]
+
+
+@dataclasses.dataclass(frozen=True)
+class Cache:
+    """Cache of responses to GET requests of a backend in http mode."""
+
+    # Size of the cache in megabytes.
+    size: int
+    # Largest response cached in bytes, None lets haproxy use a 256th of
+    # the cache size.
+    max_object_size: Optional[int]
+    # Seconds a response is served from the cache at most.
+    max_age: int
+    # Paths cached, matching exactly or, ending in *, by prefix. Any path
+    # is cached when empty.
+    paths: Tuple[str, ...] = ()
+
+    def exact_paths(self):
+        return [path for path in self.paths if not path.endswith('*')]
+
+    def path_prefixes(self):
+        return [path[:-1] for path in self.paths if path.endswith('*')]
+
+
+@dataclasses.dataclass(frozen=True)
+class Member:
+    """A unit serving a backend."""
+
+    unit_name: str
+    backend_ip: str
+    backend_port: int
+    params: ServerParams = ServerParams()
+    # Network proximity to this unit, see RANK_SUBNET and friends.
+    rank: int = RANK_SUBNET
+    # Weight a remote member is raised to while too few local members
+    # are up.
+    promoted_weight: Optional[int] = None
+
+
+@dataclasses.dataclass(frozen=True)
+class RateLimit:
+    """Limits on what a single client address may do on a frontend.
+
+    Rates are counted over period milliseconds, None leaves a limit unset.
+    """
+
+    conn_rate: Optional[int] = None
+    conn_cur: Optional[int] = None
+    http_req_rate: Optional[int] = None
+    period: int = 10000
+    action: str = 'deny'
+    table_size: int = RATE_LIMIT_TABLE_SIZE
+
+
+@dataclasses.dataclass(frozen=True)
+class Frontend:
+    """A listener accepting traffic for a service."""
+
+    service: str
+    port: int
+    timeouts: Timeouts = Timeouts()
+    mode: str = 'tcp'
+    # Whether TLS is terminated by the frontend.
+    tls: bool = False
+    rate_limit: Optional[RateLimit] = None
+    # Most verbose level logged, off or None to use the global logging.
+    log_level: Optional[str] = None
+
+    @property
+    def name(self):
+        return '{}_front'.format(self.service)
+
+
+@dataclasses.dataclass(frozen=True)
+class Backend:
+    """The pool of members serving a service."""
+
+    service: str
+    check_type: Optional[str]
+    members: Tuple[Member, ...]
+    balance: str = 'roundrobin'
+    hash_type: Optional[str] = None
+    # Settings of members which do not override them, also used for
+    # spare server slots.
+    server_defaults: ServerParams = ServerParams()
+    timeouts: Timeouts = Timeouts()
+    mode: str = 'tcp'
+    # Connection reuse policy of backends in http mode.
+    http_reuse: Optional[str] = None
+    # Whether members expect TLS, used by backends in http mode.
+    backend_tls: bool = True
+    health_check: HealthCheck = HealthCheck()
+    # Milliseconds over which a member coming up ramps up to full weight.
+    slowstart: Optional[int] = None
+    cache: Optional[Cache] = None
+    # Policy for members far from this unit, None when not ranked.
+    locality: Optional[str] = None
+    # Local members which need to be up for remote members not to be
+    # promoted.
+    min_local: int = 1
+
+    @property
+    def name(self):
+        return '{}_back'.format(self.service)
+
+    @property
+    def cache_name(self):
+        return '{}_cache'.format(self.service)
+
+    def default_server(self):
+        """Settings shared by all server lines of the backend.
+
+        :returns: List of (haproxy server keyword, value) tuples
+        :rtype: List[Tuple[str, int]]
+        """
+        settings = self.health_check.timings()
+        if self.slowstart:
+            settings.append(('slowstart', self.slowstart))
+        return settings
+
+
+@dataclasses.dataclass(frozen=True)
+class Locality:
+    """Where this unit sits, for ranking members by proximity."""
+
+    subnets: Tuple[str, ...] = ()
+    zone: Optional[str] = None
+
+    def rank(self, address, zone=None):
+        """Rank of a member, lower is closer.
+
+        :param address: Address of the member
+        :type address: str
+        :param zone: Availability zone of the member
+        :type zone: Optional[str]
+        :returns: RANK_SUBNET, RANK_ZONE or RANK_REMOTE
+        :rtype: int
+        """
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return RANK_REMOTE
+        for subnet in self.subnets:
+            network = ipaddress.ip_network(subnet, strict=False)
+            if address.version == network.version and address in network:
+                return RANK_SUBNET
+        if zone and zone == self.zone:
+            return RANK_ZONE
+        return RANK_REMOTE
+
+
+@dataclasses.dataclass(frozen=True)
+class Sizing:
+    """Process, thread and connection limits of haproxy."""
+
+    nbthread: int
+    cpu_map: Optional[str]
+    maxconn: int
+    frontend_maxconn: int
+    bufsize: int
+    maxrewrite: int
+
+
+@dataclasses.dataclass(frozen=True)
+class TLSSettings:
+    """Settings for terminating TLS on frontends."""
+
+    # Path of the PEM bundle and the digest of its content.
+    certificate: str
+    certificate_digest: str
+    cachesize: int
+    lifetime: int
+    ciphers: str
+    ciphersuites: str
+    min_version: str
+
+
+@dataclasses.dataclass(frozen=True)
+class Metrics:
+    """Frontend serving haproxy statistics and Prometheus metrics."""
+
+    address: str
+    port: int
+    # Path of the Prometheus exporter and of the stats page.
+    path: str = '/metrics'
+    stats_path: str = '/stats'
+
+
+@dataclasses.dataclass(frozen=True)
+class LogSettings:
+    """Where traffic is logged to and how much of it."""
+
+    target: str = 'local'
+    # host[:port] of the syslog server of the udp target.
+    server: Optional[str] = None
+    # Log one in every sample connections.
+    sample: int = 1
+    health_checks: bool = True
+    # Bytes of memory the ring target keeps logs in.
+    ring_size: int = 2**20
+
+    @property
+    def ring(self):
+        return LOG_RING
+
+    @property
+    def destination(self):
+        """Log target as given to haproxy log lines."""
+        if self.target == 'ring':
+            return 'ring@{}'.format(self.ring)
+        if self.target == 'udp':
+            return self.server
+        return '/dev/log'
+
+
+@dataclasses.dataclass(frozen=True)
+class LoadbalancerModel:
+    """Everything the haproxy configuration is rendered from."""
+
+    frontends: Tuple[Frontend, ...]
+    backends: Tuple[Backend, ...]
+    vips: Tuple[str, ...]
+    spare_slots: int
+    sizing: Optional[Sizing] = None
+    # Timeouts of all frontends and backends, endpoints may override them.
+    timeouts: Timeouts = Timeouts()
+    tls: Optional[TLSSettings] = None
+    metrics: Optional[Metrics] = None
+    # Percentage of random jitter added to check intervals.
+    spread_checks: int = 0
+    log_settings: LogSettings = LogSettings()
+    # Milliseconds old processes may finish their sessions in after a
+    # reload.
+    hard_stop_after: Optional[int] = None
+
+    def services(self):
+        """Frontends paired with the backend of the same service.
+
+        :returns: List of (frontend, backend) tuples
+        :rtype: List[Tuple[Frontend, Backend]]
+        """
+        return list(zip(self.frontends, self.backends))
+
+    def as_dict(self):
+        return dataclasses.asdict(self)
+
+    def layout(self):
+        """Parts of the model which can only be changed with a reload.
+
+        :returns: The model without backend members.
+        :rtype: Dict
+        """
+        layout = self.as_dict()
+        del layout['vips']
+        for backend in layout['backends']:
+            del backend['members']
+        return layout
+
+    def digest(self):
+        """Stable digest of the model.
+
+        :returns: Hex digest
+        :rtype: str
+        """
+        return hashlib.sha256(
+            json.dumps(self.as_dict(), sort_keys=True).encode()).hexdigest()
+
+
+def _get_int(options, key, default, minimum=0):
+    value = options.get(key)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = None
+    if value is None or value < minimum:
+        logger.warning("Ignoring invalid %s: %s", key, options[key])
+        return default
+    return value
+
+
+def _get_choice(options, key, choices, default):
+    value = options.get(key)
+    if value is None:
+        return default
+    if value not in choices:
+        logger.warning("Ignoring invalid %s: %s", key, value)
+        return default
+    return value
+
+
+def _get_bool(options, key, default):
+    value = options.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('true', 'yes', '1'):
+        return True
+    if str(value).lower() in ('false', 'no', '0'):
+        return False
+    logger.warning("Ignoring invalid %s: %s", key, value)
+    return default
+
+
+def _build_server_params(options, defaults):
+    return ServerParams(
+        weight=_get_int(options, 'weight', defaults.weight),
+        maxconn=_get_int(options, 'maxconn', defaults.maxconn, minimum=1),
+        maxqueue=_get_int(options, 'maxqueue', defaults.maxqueue))
+
+
+def _build_timeouts(config, names):
+    """Timeouts requested by an endpoint as timeout-<name> keys."""
+    return Timeouts(**{
+        name: _get_int(config, 'timeout_{}'.format(name), None, minimum=1)
+        for name in names})
+
+
+def _build_rate_limit(service, config, defaults, mode):
+    """Rate limit requested by an endpoint as rate-limit-<name> keys."""
+    # A limit of 0 turns it off.
+    limits = {
+        name: _get_int(
+            config,
+            'rate_limit_{}'.format(name),
+            defaults['rate_limit_{}'.format(name)]) or None
+        for name in RATE_LIMITS}
+    if mode != 'http' and limits['http_req_rate']:
+        logger.warning(
+            "Request rate limit needs http mode, ignoring it for %s",
+            service)
+        limits['http_req_rate'] = None
+    if not any(limits.values()):
+        return None
+    action = _get_choice(
+        config,
+        'rate_limit_action',
+        RATE_LIMIT_ACTIONS,
+        defaults['rate_limit_action'])
+    if mode != 'http' and action == 'tarpit':
+        logger.warning(
+            "Tarpit needs http mode, using deny for %s", service)
+        action = 'deny'
+    # Traffic only queues once servers reach their connection limit.
+    server_maxconn = _get_int(
+        config, 'server_maxconn', defaults['maxconn'], minimum=1)
+    if action == 'queue' and server_maxconn is None:
+        logger.warning(
+            "Queueing needs a server maxconn, using deny for %s", service)
+        action = 'deny'
+    return RateLimit(
+        period=_get_int(
+            config,
+            'rate_limit_period',
+            defaults['rate_limit_period'],
+            minimum=1),
+        action=action,
+        **limits)
+
+
+def _build_frontend(service, config, defaults):
+    mode = _get_choice(config, 'mode', MODES, defaults['mode'])
+    return Frontend(
+        service=service,
+        port=int(config['frontend_port']),
+        timeouts=_build_timeouts(config, FRONTEND_TIMEOUTS),
+        mode=mode,
+        tls=defaults['tls_available'] and _get_bool(
+            config, 'tls_termination', defaults['tls_termination']),
+        rate_limit=_build_rate_limit(service, config, defaults, mode),
+        log_level=_get_choice(
+            config,
+            'log_level',
+            LOG_LEVELS + ('off',),
+            defaults['log_level']))
+
+
+def _build_health_check(service, config, defaults):
+    """Health check requested by an endpoint as check-<name> keys.
+
+    The method defaults to an http check for endpoints with a check-type of
+    http and to a TCP connect check otherwise.
+    """
+    default_method = 'http' if config.get('check_type') == 'http' else 'tcp'
+    method = _get_choice(config, 'check_method', CHECK_METHODS, default_method)
+    agent_port = _get_int(config, 'check_agent_port', None, minimum=1)
+    if method == 'agent' and agent_port is None:
+        logger.warning(
+            "Agent check needs check-agent-port, using %s for %s",
+            default_method, service)
+        method = default_method
+    path = config.get('check_path') or defaults['check_path']
+    if not path.startswith('/') or ' ' in path:
+        logger.warning("Ignoring invalid check_path: %s", path)
+        path = defaults['check_path']
+    return HealthCheck(
+        method=method,
+        path=path,
+        agent_port=agent_port if method == 'agent' else None,
+        **{
+            name: _get_int(
+                config, 'check_{}'.format(name), defaults[name], minimum=1)
+            for name in CHECK_TIMINGS})
+
+
+def _build_cache(service, config, defaults, mode):
+    """Cache requested by an endpoint as cache-<name> keys."""
+    if not _get_bool(config, 'cache', defaults['cache']):
+        return None
+    if mode != 'http':
+        logger.warning("Cache needs http mode, not caching %s", service)
+        return None
+    paths = config.get('cache_paths')
+    if paths is None:
+        paths = defaults['cache_paths']
+    return Cache(
+        # haproxy caches are at most 4095 megabytes.
+        size=min(
+            _get_int(config, 'cache_size', defaults['cache_size'], 1),
+            4095),
+        max_object_size=_get_int(
+            config,
+            'cache_max_object_size',
+            defaults['cache_max_object_size'],
+            minimum=1),
+        max_age=_get_int(
+            config, 'cache_max_age', defaults['cache_max_age'], 1),
+        paths=tuple(
+            path for path in str(paths).split() if path.startswith('/')))
+
+
+def _rank_members(requests, members, site, policy, remote_weight):
+    """Rank members by proximity and demote those furthest away.
+
+    The closest members present are local, members further away are made
+    backup servers or have their weight cut to remote_weight percent.
+    """
+    zones = {
+        request['unit_name']: request.get('availability_zone')
+        for request in requests}
+    ranks = [site.rank(m.backend_ip, zones.get(m.unit_name)) for m in members]
+    local_rank = min(ranks, default=RANK_SUBNET)
+    ranked = []
+    for member, rank in zip(members, ranks):
+        params = member.params
+        promoted_weight = None
+        if policy == 'weight':
+            weight = params.weight or LOCALITY_WEIGHT
+            params = dataclasses.replace(params, weight=weight)
+            if rank > local_rank:
+                promoted_weight = weight
+                params = dataclasses.replace(
+                    params,
+                    weight=max(1, weight * remote_weight // 100))
+        elif rank > local_rank:
+            params = dataclasses.replace(params, backup=True)
+        ranked.append(dataclasses.replace(
+            member,
+            params=params,
+            rank=rank,
+            promoted_weight=promoted_weight))
+    return ranked
+
+
+def _build_backend(service, config, defaults):
+    server_defaults = _build_server_params(
+        {
+            'weight': config.get('server_weight'),
+            'maxconn': config.get('server_maxconn'),
+            'maxqueue': config.get('server_maxqueue')},
+        ServerParams(
+            weight=defaults['weight'],
+            maxconn=defaults['maxconn'],
+            maxqueue=defaults['maxqueue']))
+    members = sorted(
+        (
+            Member(
+                unit_name=member['unit_name'],
+                backend_ip=member['backend_ip'],
+                backend_port=int(member['backend_port']),
+                params=_build_server_params(member, server_defaults))
+            for member in config.get('members', [])),
+        key=lambda m: m.unit_name)
+    policy = _get_choice(
+        config, 'locality', LOCALITY_POLICIES, defaults['locality'])
+    if policy == 'off' or defaults['locality_site'] is None:
+        policy = None
+    else:
+        members = _rank_members(
+            config.get('members', []),
+            members,
+            defaults['locality_site'],
+            policy,
+            _get_int(
+                config,
+                'locality_remote_weight',
+                defaults['locality_remote_weight'],
+                minimum=1))
+    mode = _get_choice(config, 'mode', MODES, defaults['mode'])
+    balance = _get_choice(
+        config, 'balance', BALANCE_ALGORITHMS, defaults['balance'])
+    if mode != 'http' and balance in HTTP_BALANCE_ALGORITHMS:
+        logger.warning(
+            "Balance %s needs http mode, using %s for %s",
+            balance, DEFAULTS['balance'], service)
+        balance = DEFAULTS['balance']
+    http_reuse = None
+    if mode == 'http':
+        http_reuse = _get_choice(
+            config, 'http_reuse', HTTP_REUSE, defaults['http_reuse'])
+    hash_type = None
+    if balance in HASH_BALANCE_ALGORITHMS:
+        hash_type = _get_choice(
+            config, 'hash_type', HASH_TYPES, defaults['hash_type'])
+    return Backend(
+        service=service,
+        check_type=config.get('check_type'),
+        members=tuple(members),
+        balance=balance,
+        hash_type=hash_type,
+        server_defaults=server_defaults,
+        timeouts=_build_timeouts(config, BACKEND_TIMEOUTS),
+        mode=mode,
+        http_reuse=http_reuse,
+        backend_tls=_get_bool(
+            config, 'backend_tls', defaults['backend_tls']),
+        health_check=_build_health_check(service, config, defaults),
+        slowstart=_get_int(
+            config, 'slowstart', defaults['slowstart'], minimum=1),
+        cache=_build_cache(service, config, defaults, mode),
+        locality=policy,
+        min_local=_get_int(
+            config, 'locality_min_local', defaults['locality_min_local']))
+
+
+def build_model(endpoints, vips, spare_slots=0, sizing=None, defaults=None,
+                timeouts=None, tls=None, metrics=None, spread_checks=0,
+                log_settings=None, locality=None, hard_stop_after=None):
+    """Build a normalized model from the requested endpoints.
+
+    Options missing from, or invalid in, an endpoint request are taken from
+    the defaults.
+
+    :param endpoints: Endpoints as presented by LoadbalancerAdapter.endpoints
+    :type endpoints: Dict[str, Dict]
+    :param vips: Configured VIPs
+    :type vips: List[str]
+    :param spare_slots: Number of empty server slots per backend
+    :type spare_slots: int
+    :param sizing: Process, thread and connection limits
+    :type sizing: Optional[Sizing]
+    :param defaults: Defaults for endpoint options, overriding DEFAULTS
+    :type defaults: Optional[Dict]
+    :param timeouts: Timeouts of frontends and backends
+    :type timeouts: Optional[Timeouts]
+    :param tls: Settings for terminating TLS, None if no certificate is set
+    :type tls: Optional[TLSSettings]
+    :param metrics: Metrics frontend, None if disabled
+    :type metrics: Optional[Metrics]
+    :param spread_checks: Percentage of jitter added to check intervals
+    :type spread_checks: int
+    :param log_settings: Where traffic is logged to, locally if None
+    :type log_settings: Optional[LogSettings]
+    :param locality: Where this unit sits, members are not ranked if None
+    :type locality: Optional[Locality]
+    :param hard_stop_after: Milliseconds old processes are given after a
+                            reload, None to let them finish their sessions
+    :type hard_stop_after: Optional[int]
+    :returns: The loadbalancer model
+    :rtype: LoadbalancerModel
+    """
+    defaults = dict(DEFAULTS, **(defaults or {}))
+    defaults['tls_available'] = tls is not None
+    defaults['locality_site'] = locality
+    frontends = []
+    backends = []
+    for service in sorted(endpoints):
+        config = endpoints[service]
+        frontends.append(_build_frontend(service, config, defaults))
+        backends.append(_build_backend(service, config, defaults))
+    return LoadbalancerModel(
+        frontends=tuple(frontends),
+        backends=tuple(backends),
+        vips=tuple(sorted(vips)),
+        spare_slots=spare_slots,
+        sizing=sizing,
+        timeouts=timeouts or Timeouts(),
+        tls=tls,
+        metrics=metrics,
+        spread_checks=spread_checks,
+        log_settings=log_settings or LogSettings(),
+        hard_stop_after=hard_stop_after)
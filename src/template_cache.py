@@ -0,0 +1,85 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keep compiled templates on disk between hooks."""
+
+import logging
+
+import jinja2
+
+logger = logging.getLogger(__name__)
+
+
+class CachingLoader(jinja2.FileSystemLoader):
+    """Load templates, reusing the code compiled by earlier hooks.
+
+    Every hook runs in a new process so without a cache each render parses
+    and compiles the template again. A template is compiled again when its
+    source changes.
+    """
+
+    def __init__(self, searchpath, cache_dir):
+        """Setup loader.
+
+        :param searchpath: Directory of the templates
+        :type searchpath: str
+        :param cache_dir: Directory of the compiled templates
+        :type cache_dir: pathlib.Path
+        """
+        super().__init__(searchpath)
+        self.cache_dir = cache_dir
+
+    def get_bytecode_cache(self):
+        """Cache of compiled templates, None if it cannot be created.
+
+        :rtype: Optional[jinja2.FileSystemBytecodeCache]
+        """
+        try:
+            self.cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        except OSError as e:
+            logger.warning("Not caching templates in %s: %s",
+                           self.cache_dir, e)
+            return None
+        return jinja2.FileSystemBytecodeCache(str(self.cache_dir))
+
+    def load(self, environment, name, globals=None):
+        # charmhelpers creates the environment, so the cache is set on the
+        # first load.
+        if environment.bytecode_cache is None:
+            environment.bytecode_cache = self.get_bytecode_cache()
+        return super().load(environment, name, globals)
+
+
+def precompile(searchpath, cache_dir):
+    """Compile every template, replacing what is cached.
+
+    :param searchpath: Directory of the templates
+    :type searchpath: str
+    :param cache_dir: Directory of the compiled templates
+    :type cache_dir: pathlib.Path
+    :returns: Names of the compiled templates
+    :rtype: List[str]
+    """
+    loader = CachingLoader(searchpath, cache_dir)
+    bytecode_cache = loader.get_bytecode_cache()
+    if bytecode_cache is None:
+        return []
+    bytecode_cache.clear()
+    environment = jinja2.Environment(
+        loader=loader,
+        bytecode_cache=bytecode_cache)
+    names = environment.list_templates()
+    for name in names:
+        environment.get_template(name)
+    return names
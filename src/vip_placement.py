@@ -0,0 +1,138 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Placement of VIPs in the network spaces and on the loadbalancer units."""
+
+import hashlib
+import ipaddress
+import itertools
+
+# Score of a VIP for the unit it is assigned to. Finite so that the VIP
+# fails over to another unit.
+PREFERENCE_SCORE = 100
+# Score keeping VIPs apart. Finite so that VIPs share a unit when there
+# are fewer units than VIPs.
+ANTI_AFFINITY_SCORE = -1000
+
+
+def vip_resource_name(app_name, vip):
+    """Name of the pacemaker resource of a VIP.
+
+    Matches the name interface_hacluster gives the VIPs it adds.
+
+    :param app_name: Name of the application
+    :type app_name: str
+    :param vip: The VIP
+    :type vip: str
+    :returns: Resource name
+    :rtype: str
+    """
+    return 'res_{}_{}_vip'.format(
+        app_name,
+        hashlib.sha1(vip.encode('UTF-8')).hexdigest()[:7])
+
+
+def assign_vips(vips, hostnames):
+    """Assign each VIP a preferred unit, round robin.
+
+    Every unit works out the same assignment as it only depends on the
+    sorted VIPs and hostnames.
+
+    :param vips: The VIPs
+    :type vips: List[str]
+    :param hostnames: Hostnames of the loadbalancer units
+    :type hostnames: List[str]
+    :returns: Preferred hostname keyed on VIP
+    :rtype: Dict[str, str]
+    """
+    hostnames = sorted(set(hostnames))
+    if not hostnames:
+        return {}
+    return {
+        vip: hostnames[idx % len(hostnames)]
+        for idx, vip in enumerate(sorted(vips))}
+
+
+def plan_constraints(app_name, vips, hostnames, service_clone):
+    """Pacemaker constraints which spread the VIPs over the units.
+
+    Each VIP runs only where haproxy runs, prefers its assigned unit and
+    avoids units carrying another VIP.
+
+    :param app_name: Name of the application
+    :type app_name: str
+    :param vips: The VIPs
+    :type vips: List[str]
+    :param hostnames: Hostnames of the loadbalancer units
+    :type hostnames: List[str]
+    :param service_clone: Name of the clone resource running haproxy
+    :type service_clone: str
+    :returns: Colocations and locations in the format of the json_colocations
+              and json_locations keys of the ha relation
+    :rtype: Tuple[Dict[str, str], Dict[str, str]]
+    """
+    resources = {vip: vip_resource_name(app_name, vip) for vip in vips}
+    colocations = {}
+    for vip in sorted(vips):
+        colocations['co_{}_haproxy'.format(resources[vip])] = (
+            'inf: {} {}'.format(resources[vip], service_clone))
+    for vip_a, vip_b in itertools.combinations(sorted(vips), 2):
+        colocations['co_{}_{}'.format(resources[vip_a], resources[vip_b])] = (
+            '{}: {} {}'.format(
+                ANTI_AFFINITY_SCORE, resources[vip_a], resources[vip_b]))
+    locations = {
+        'loc_{}'.format(resources[vip]): '{} {}: {}'.format(
+            resources[vip], PREFERENCE_SCORE, hostname)
+        for vip, hostname in assign_vips(vips, hostnames).items()}
+    return colocations, locations
+
+
+def build_space_index(binding_subnets, vips):
+    """Resolve the bindings, and so network spaces, each VIP lands in.
+
+    Subnets are parsed once and held longest prefix first, so the bindings
+    of a VIP are listed from the most specific subnet.
+
+    :param binding_subnets: Subnets of each binding
+    :type binding_subnets: Dict[str, List[str]]
+    :param vips: The VIPs
+    :type vips: List[str]
+    :returns: Dict with the VIPs of each binding, and the VIPs which land in
+              no binding or in more than one
+    :rtype: Dict[str, Union[Dict[str, List[str]], List[str]]]
+    """
+    networks = sorted(
+        (
+            (ipaddress.ip_network(subnet, strict=False), binding)
+            for binding, subnets in binding_subnets.items()
+            for subnet in subnets),
+        key=lambda n: (n[0].version, -n[0].prefixlen))
+    index = {
+        'bindings': {binding: [] for binding in binding_subnets},
+        'unmatched': [],
+        'ambiguous': []}
+    for vip in vips:
+        address = ipaddress.ip_address(vip)
+        bindings = []
+        for network, binding in networks:
+            if address.version == network.version and address in network:
+                if binding not in bindings:
+                    bindings.append(binding)
+        for binding in bindings:
+            index['bindings'][binding].append(vip)
+        if not bindings:
+            index['unmatched'].append(vip)
+        elif len(bindings) > 1:
+            index['ambiguous'].append(vip)
+    return index
@@ -0,0 +1,199 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import socketserver
+import tempfile
+import threading
+
+
+class FakeHAProxy(object):
+    """Stand in for the runtime API on the haproxy admin socket.
+
+    Keeps a minimal model of backends and servers which the supported
+    commands act on. Every command received is recorded in `commands`.
+    """
+
+    SERVERS_STATE_FIELDS = (
+        'be_id be_name srv_id srv_name srv_addr srv_op_state '
+        'srv_admin_state srv_uweight srv_iweight srv_time_since_last_change '
+        'srv_check_status srv_check_result srv_check_health srv_check_state '
+        'srv_agent_state bk_f_forced_id srv_f_forced_id srv_fqdn srv_port')
+
+    STAT_FIELDS = (
+        'pxname', 'svname', 'qcur', 'qmax', 'scur', 'smax', 'stot', 'econ',
+        'eresp', 'wretr', 'status', 'rate', 'check_status', 'qtime', 'ctime',
+        'rtime', 'cache_lookups', 'cache_hits')
+
+    def __init__(self, backends=None):
+        self.backends = backends or {}
+        self.commands = []
+        self.responses = {}
+        # Stat counters keyed on (backend, server or BACKEND).
+        self.counters = {}
+        self.info = {'Name': 'HAProxy', 'Version': '2.4.22', 'Uptime_sec': 60}
+        # Stick table entries keyed on table name, then on client address.
+        self.tables = {}
+        # Messages of the ring buffers keyed on ring name.
+        self.events = {}
+        # Processes listed by the master CLI, as (section, pid, reloads).
+        self.processes = [('master', 1000, 0), ('workers', 1001, 0)]
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self._tmpdir.name, 'admin.sock')
+        fake = self
+
+        class _Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                command = self.rfile.readline().decode().strip()
+                fake.commands.append(command)
+                self.wfile.write(fake.respond(command).encode())
+
+        self._server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path,
+            _Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+        self._tmpdir.cleanup()
+
+    def add_server(self, backend, server, addr, port, state='ready'):
+        self.backends.setdefault(backend, {})[server] = {
+            'addr': addr,
+            'port': port,
+            'state': state}
+
+    def _get_server(self, name):
+        if '/' not in name:
+            return None, "Require 'backend/server'.\n"
+        backend, server = name.split('/', 1)
+        if backend not in self.backends:
+            return None, 'No such backend.\n'
+        if server not in self.backends[backend]:
+            return None, 'No such server.\n'
+        return self.backends[backend][server], None
+
+    def respond(self, command):
+        if command in self.responses:
+            return self.responses[command]
+        args = command.split()
+        if args[:2] == ['set', 'server'] and len(args) > 3:
+            server, error = self._get_server(args[2])
+            if error:
+                return error
+            if args[3] == 'addr':
+                old = (server['addr'], server['port'])
+                server['addr'] = args[4]
+                if len(args) > 6 and args[5] == 'port':
+                    server['port'] = int(args[6])
+                return (
+                    "IP changed from '{}' to '{}', port changed from '{}' "
+                    "to '{}' by 'stats socket command'\n".format(
+                        old[0], server['addr'], old[1], server['port']))
+            if args[3] == 'state':
+                server['state'] = args[4]
+                return '\n'
+        if args[:2] == ['set', 'weight'] and len(args) == 4:
+            server, error = self._get_server(args[2])
+            if error:
+                return error
+            server['weight'] = int(args[3])
+            return '\n'
+        if args[:3] == ['show', 'servers', 'state']:
+            lines = ['1', '# {}'.format(self.SERVERS_STATE_FIELDS)]
+            for be_id, (backend, servers) in enumerate(
+                    sorted(self.backends.items()), start=1):
+                if len(args) > 3 and args[3] != backend:
+                    continue
+                for srv_id, (name, server) in enumerate(
+                        sorted(servers.items()), start=1):
+                    admin_state = {'ready': 0, 'maint': 1, 'drain': 8}
+                    lines.append(' '.join(str(f) for f in [
+                        be_id, backend, srv_id, name, server['addr'], 2,
+                        admin_state[server['state']], 1, 1, 10, 6, 3, 4, 6,
+                        0, 0, 0, '-', server['port']]))
+            return '\n'.join(lines) + '\n\n'
+        if args == ['show', 'stat']:
+            lines = ['# {},'.format(','.join(self.STAT_FIELDS))]
+            for backend, servers in sorted(self.backends.items()):
+                status = {'ready': 'UP', 'maint': 'MAINT', 'drain': 'DRAIN'}
+                rows = [
+                    (name, status[server['state']])
+                    for name, server in sorted(servers.items())]
+                rows.append(('BACKEND', 'UP'))
+                for name, state in rows:
+                    stat = dict(
+                        {field: 0 for field in self.STAT_FIELDS},
+                        pxname=backend,
+                        svname=name,
+                        status=state,
+                        check_status='L7OK' if name != 'BACKEND' else '')
+                    stat.update(self.counters.get((backend, name), {}))
+                    lines.append('{},'.format(','.join(
+                        str(stat[field]) for field in self.STAT_FIELDS)))
+            return '\n'.join(lines) + '\n\n'
+        if args == ['show', 'table']:
+            return ''.join(
+                '# table: {}, type: ipv6, size:100000, used:{}\n'.format(
+                    table, len(entries))
+                for table, entries in sorted(self.tables.items()))
+        if args[:2] == ['show', 'table'] and len(args) == 3:
+            if args[2] not in self.tables:
+                return 'No such table\n'
+            entries = self.tables[args[2]]
+            lines = ['# table: {}, type: ipv6, size:100000, used:{}'.format(
+                args[2], len(entries))]
+            for idx, (key, counters) in enumerate(sorted(entries.items())):
+                lines.append('0x{:x}: key={} use=0 exp=19000 {}'.format(
+                    idx,
+                    key,
+                    ' '.join(
+                        '{}={}'.format(name, value)
+                        for name, value in counters.items())))
+            return '\n'.join(lines) + '\n\n'
+        if args[:2] == ['show', 'events'] and len(args) == 3:
+            if args[2] not in self.events:
+                return 'No such event sink\n'
+            return ''.join(
+                '{}\n'.format(message) for message in self.events[args[2]])
+        if args == ['show', 'proc']:
+            lines = [
+                '#<PID>          <type>          <reloads>       <uptime>'
+                '        <version>']
+            section = 'master'
+            for process_section, pid, reloads in self.processes:
+                if process_section != section:
+                    section = process_section
+                    lines.append('# {}'.format(section))
+                lines.append('{:<16}{:<16}{:<16}{:<16}{}'.format(
+                    pid,
+                    'master' if section == 'master' else 'worker',
+                    reloads,
+                    '0d00h01m00s',
+                    self.info['Version']))
+            return '\n'.join(lines) + '\n'
+        if args == ['show', 'info']:
+            return ''.join(
+                '{}: {}\n'.format(key, value)
+                for key, value in self.info.items())
+        return 'Unknown command. Please enter one of the following ' \
+               'commands only :\n'
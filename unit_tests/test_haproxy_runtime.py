@@ -0,0 +1,487 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import unittest
+
+sys.path.append('src')  # noqa
+
+import haproxy_runtime
+import lb_model
+from unit_tests.fake_haproxy import FakeHAProxy
+
+
+def _member(unit_name, ip, port=9292, params=None):
+    return {
+        'unit_name': unit_name,
+        'backend_ip': ip,
+        'backend_port': port,
+        'params': params or {}}
+
+
+class TestHAProxyRuntimeAPI(unittest.TestCase):
+
+    def test_set_server_addr(self):
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '127.0.0.1', 9292)
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            api.set_server_addr('glance_api_back', 'srv1', '10.0.0.51', 9293)
+            self.assertEqual(
+                fake.commands,
+                ['set server glance_api_back/srv1 addr 10.0.0.51 port 9293'])
+            self.assertEqual(
+                fake.backends['glance_api_back']['srv1'],
+                {'addr': '10.0.0.51', 'port': 9293, 'state': 'ready'})
+
+    def test_set_server_weight(self):
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            api.set_server_weight('glance_api_back', 'srv1', 100)
+            self.assertEqual(
+                fake.commands,
+                ['set weight glance_api_back/srv1 100'])
+            self.assertEqual(
+                fake.backends['glance_api_back']['srv1']['weight'],
+                100)
+
+    def test_set_server_state(self):
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            api.set_server_state('glance_api_back', 'srv1', 'maint')
+            self.assertEqual(
+                fake.backends['glance_api_back']['srv1']['state'],
+                'maint')
+
+    def test_unknown_server(self):
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            with self.assertRaises(haproxy_runtime.HAProxyRuntimeError):
+                api.set_server_state('glance_api_back', 'srv9', 'ready')
+            with self.assertRaises(haproxy_runtime.HAProxyRuntimeError):
+                api.set_server_state('nova_api_back', 'srv1', 'ready')
+
+    def test_missing_socket(self):
+        api = haproxy_runtime.HAProxyRuntimeAPI('/nonexistent/admin.sock')
+        with self.assertRaises(OSError):
+            api.set_server_state('glance_api_back', 'srv1', 'ready')
+
+    def test_show_servers_state(self):
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            fake.add_server('glance_api_back', 'srv2', '127.0.0.1', 9292,
+                            state='maint')
+            fake.add_server('nova_api_back', 'srv1', '10.0.0.60', 8774)
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            servers = api.show_servers_state('glance_api_back')
+            self.assertEqual(
+                [(s['srv_name'], s['srv_addr'], s['srv_admin_state'])
+                 for s in servers],
+                [('srv1', '10.0.0.50', '0'), ('srv2', '127.0.0.1', '1')])
+            self.assertEqual(len(api.show_servers_state()), 3)
+
+    def test_show_stat(self):
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            fake.counters[('glance_api_back', 'BACKEND')] = {'qcur': 3}
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            stats = api.show_stat()
+            self.assertEqual(
+                [(s['pxname'], s['svname'], s['qcur']) for s in stats],
+                [
+                    ('glance_api_back', 'srv1', '0'),
+                    ('glance_api_back', 'BACKEND', '3')])
+
+    def test_show_info(self):
+        with FakeHAProxy() as fake:
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            self.assertEqual(api.show_info()['Version'], '2.4.22')
+
+    def test_show_table(self):
+        with FakeHAProxy() as fake:
+            fake.tables['glance_api_front'] = {
+                '::ffff:10.0.0.9': {
+                    'conn_cur': 2,
+                    'conn_rate(10000)': 30,
+                    'http_req_rate(10000)': 120}}
+            fake.tables['ceph_dashboard_front'] = {}
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            self.assertEqual(
+                api.show_tables(),
+                ['ceph_dashboard_front', 'glance_api_front'])
+            entry, = api.show_table('glance_api_front')
+            self.assertEqual(entry['key'], '::ffff:10.0.0.9')
+            self.assertEqual(entry['conn_rate'], '30')
+            self.assertEqual(entry['http_req_rate'], '120')
+            self.assertEqual(api.show_table('ceph_dashboard_front'), [])
+            with self.assertRaises(haproxy_runtime.HAProxyRuntimeError):
+                api.show_table('keystone_front')
+
+    def test_show_proc(self):
+        with FakeHAProxy() as fake:
+            fake.processes = [
+                ('master', 1000, 2),
+                ('workers', 1003, 0),
+                ('old workers', 1002, 1),
+                ('old workers', 1001, 2)]
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            processes = api.show_proc()
+        self.assertEqual(
+            [(p['section'], p['pid'], p['type']) for p in processes],
+            [
+                ('master', '1000', 'master'),
+                ('workers', '1003', 'worker'),
+                ('old workers', '1002', 'worker'),
+                ('old workers', '1001', 'worker')])
+        self.assertEqual(processes[0]['version'], '2.4.22')
+
+    def test_show_events(self):
+        with FakeHAProxy() as fake:
+            fake.events['haproxy-logs'] = ['first', 'second']
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            self.assertEqual(
+                api.show_events('haproxy-logs'),
+                ['first', 'second'])
+            with self.assertRaises(haproxy_runtime.HAProxyRuntimeError):
+                api.show_events('other')
+
+
+class TestStats(unittest.TestCase):
+
+    def _sample(self, fake):
+        api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+        return api.show_stat(), api.show_servers_state()
+
+    def test_summarize_stats(self):
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            fake.add_server('glance_api_back', 'srv2', '10.0.0.51', 9292,
+                            state='maint')
+            fake.add_server('glance_api_back', 'srv3', '127.0.0.1', 9292,
+                            state='maint')
+            fake.counters[('glance_api_back', 'BACKEND')] = {
+                'qcur': 2, 'qmax': 10, 'scur': 5, 'rate': 7, 'stot': 100,
+                'econ': 1, 'eresp': 2, 'wretr': 4, 'rtime': 25,
+                'cache_lookups': 50, 'cache_hits': 40}
+            summary, = haproxy_runtime.summarize_stats(*self._sample(fake))
+        self.assertEqual(summary['service'], 'glance_api')
+        self.assertEqual(summary['current-sessions'], 5)
+        self.assertEqual(summary['queue'], 2)
+        self.assertEqual(summary['queue-max'], 10)
+        self.assertEqual(summary['response-time'], 25)
+        self.assertEqual(summary['sessions'], 100)
+        self.assertEqual(summary['errors'], 3)
+        self.assertEqual(summary['retries'], 4)
+        self.assertEqual(summary['cache-lookups'], 50)
+        self.assertEqual(summary['cache-hits'], 40)
+        # Spare slots are left out.
+        self.assertEqual(summary['servers-up'], '1/2')
+        self.assertEqual(
+            summary['servers'],
+            [
+                {'name': 'srv1', 'address': '10.0.0.50', 'status': 'UP',
+                 'check': 'L7OK'},
+                {'name': 'srv2', 'address': '10.0.0.51', 'status': 'MAINT',
+                 'check': 'L7OK'}])
+
+    def test_summarize_stats_zero(self):
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            fake.counters[('glance_api_back', 'BACKEND')] = {
+                'qcur': 0, 'scur': 0, 'stot': 0}
+            summary, = haproxy_runtime.summarize_stats(*self._sample(fake))
+        self.assertEqual(summary['queue'], 0)
+        self.assertEqual(summary['current-sessions'], 0)
+        self.assertEqual(summary['sessions'], 0)
+        header, row = haproxy_runtime.format_stats_table(
+            [summary]).splitlines()
+        self.assertEqual(
+            len(row.split()),
+            len(header.split()))
+
+    def test_summarize_stats_window(self):
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            fake.counters[('glance_api_back', 'BACKEND')] = {
+                'stot': 100, 'econ': 1}
+            previous, _ = self._sample(fake)
+            fake.counters[('glance_api_back', 'BACKEND')] = {
+                'stot': 150, 'econ': 3}
+            stats, servers_state = self._sample(fake)
+        summary, = haproxy_runtime.summarize_stats(
+            stats, servers_state, previous=previous, window=10)
+        self.assertEqual(summary['sessions-per-s'], 5.0)
+        self.assertEqual(summary['errors-per-s'], 0.2)
+        self.assertEqual(summary['retries-per-s'], 0.0)
+        self.assertNotIn('sessions', summary)
+        table = haproxy_runtime.format_stats_table([summary]).splitlines()
+        self.assertEqual(len(table), 2)
+        self.assertEqual(
+            table[0].split(),
+            list(haproxy_runtime.STATS_TABLE_COLUMNS) + [
+                'sessions-per-s', 'errors-per-s', 'retries-per-s',
+                'cache-lookups-per-s', 'cache-hits-per-s'])
+        self.assertEqual(table[1].split()[0], 'glance_api')
+
+    def test_top_clients(self):
+        tables = {
+            'glance_api_front': [
+                {'key': '10.0.0.1', 'conn_cur': '1', 'conn_rate': '5',
+                 'http_req_rate': '10'},
+                {'key': '10.0.0.2', 'conn_cur': '4', 'conn_rate': '50',
+                 'http_req_rate': '900'},
+                {'key': '10.0.0.3', 'conn_cur': '0', 'conn_rate': '1',
+                 'http_req_rate': '1'}],
+            'ceph_dashboard_front': [
+                {'key': '10.0.0.4', 'conn_cur': '3', 'conn_rate': '7'}]}
+        clients = haproxy_runtime.top_clients(tables, limit=2)
+        self.assertEqual(
+            [(c['frontend'], c['client']) for c in clients],
+            [
+                ('ceph_dashboard', '10.0.0.4'),
+                ('glance_api', '10.0.0.2'),
+                ('glance_api', '10.0.0.1')])
+        self.assertEqual(clients[0]['http-req-rate'], 0)
+        table = haproxy_runtime.format_clients_table(clients).splitlines()
+        self.assertEqual(
+            table[0].split(), list(haproxy_runtime.CLIENTS_TABLE_COLUMNS))
+        self.assertEqual(
+            table[2].split(), ['glance_api', '10.0.0.2', '4', '50', '900'])
+
+
+class TestServerSlots(unittest.TestCase):
+
+    def test_allocate_server_slots(self):
+        self.assertEqual(
+            haproxy_runtime.allocate_server_slots(
+                [_member('glance_0', '10.0.0.50')],
+                2,
+                9292),
+            [
+                {'name': 'srv1', 'unit': 'glance_0', 'ip': '10.0.0.50',
+                 'port': 9292, 'params': {}},
+                {'name': 'srv2', 'unit': None, 'ip': '127.0.0.1',
+                 'port': 9292, 'params': {}},
+                {'name': 'srv3', 'unit': None, 'ip': '127.0.0.1',
+                 'port': 9292, 'params': {}}])
+
+    def test_allocate_model_servers(self):
+        model = lb_model.build_model(
+            {
+                'glance_api': {
+                    'frontend_port': 9292,
+                    'check_type': 'http',
+                    'server_maxconn': '50',
+                    'members': [
+                        {
+                            'unit_name': 'glance_0',
+                            'backend_port': 9393,
+                            'backend_ip': '10.0.0.50'}]}},
+            [],
+            spare_slots=1)
+        params = {
+            'weight': None, 'maxconn': 50, 'maxqueue': None, 'backup': False}
+        self.assertEqual(
+            haproxy_runtime.allocate_model_servers(model),
+            {
+                'glance_api': [
+                    {'name': 'srv1', 'unit': 'glance_0', 'ip': '10.0.0.50',
+                     'port': 9393, 'params': params},
+                    {'name': 'srv2', 'unit': None, 'ip': '127.0.0.1',
+                     'port': 9292, 'params': params}]})
+
+    def test_plan_server_updates_noop(self):
+        slots = haproxy_runtime.allocate_server_slots(
+            [_member('glance_0', '10.0.0.50')], 1, 9292)
+        self.assertEqual(
+            haproxy_runtime.plan_server_updates(
+                slots,
+                [_member('glance_0', '10.0.0.50')]),
+            (slots, []))
+
+    def test_plan_server_updates(self):
+        slots = haproxy_runtime.allocate_server_slots(
+            [
+                _member('glance_0', '10.0.0.50'),
+                _member('glance_1', '10.0.0.51')],
+            1,
+            9292)
+        new_slots, calls = haproxy_runtime.plan_server_updates(
+            slots,
+            [
+                _member('glance_0', '10.0.0.60'),
+                _member('glance_2', '10.0.0.52')])
+        self.assertEqual(
+            calls,
+            [
+                ('set_server_addr', 'srv1', ('10.0.0.60', 9292)),
+                ('set_server_state', 'srv2', ('maint',)),
+                ('set_server_addr', 'srv2', ('10.0.0.52', 9292)),
+                ('set_server_state', 'srv2', ('ready',))])
+        self.assertEqual(
+            [(s['name'], s['unit']) for s in new_slots],
+            [('srv1', 'glance_0'), ('srv2', 'glance_2'), ('srv3', None)])
+        # The original slots are left untouched.
+        self.assertEqual(slots[1]['unit'], 'glance_1')
+
+    def test_plan_server_updates_no_free_slots(self):
+        slots = haproxy_runtime.allocate_server_slots(
+            [_member('glance_0', '10.0.0.50')], 0, 9292)
+        self.assertIsNone(
+            haproxy_runtime.plan_server_updates(
+                slots,
+                [
+                    _member('glance_0', '10.0.0.50'),
+                    _member('glance_1', '10.0.0.51')]))
+
+    def test_plan_server_updates_params(self):
+        slots = haproxy_runtime.allocate_server_slots(
+            [_member('glance_0', '10.0.0.50', params={'weight': 10})],
+            1,
+            9292,
+            spare_params={'weight': 10})
+        # A new member with the params of the spare slot is added live.
+        new_slots, calls = haproxy_runtime.plan_server_updates(
+            slots,
+            [
+                _member('glance_0', '10.0.0.50', params={'weight': 10}),
+                _member('glance_1', '10.0.0.51', params={'weight': 10})])
+        self.assertEqual(new_slots[1]['unit'], 'glance_1')
+        # Other params can only be rendered.
+        self.assertIsNone(
+            haproxy_runtime.plan_server_updates(
+                slots,
+                [
+                    _member('glance_0', '10.0.0.50', params={'weight': 10}),
+                    _member('glance_1', '10.0.0.51', params={'weight': 5})]))
+        self.assertIsNone(
+            haproxy_runtime.plan_server_updates(
+                slots,
+                [_member('glance_0', '10.0.0.50', params={'weight': 5})]))
+
+    def test_plan_server_updates_drain(self):
+        slots = haproxy_runtime.allocate_server_slots(
+            [
+                _member('glance_0', '10.0.0.50'),
+                _member('glance_1', '10.0.0.51')],
+            0,
+            9292)
+        new_slots, calls = haproxy_runtime.plan_server_updates(
+            slots,
+            [_member('glance_0', '10.0.0.50')],
+            drain_since=100)
+        self.assertEqual(calls, [('set_server_state', 'srv2', ('drain',))])
+        self.assertEqual(new_slots[1]['unit'], 'glance_1')
+        self.assertEqual(new_slots[1]['draining'], 100)
+        # A draining slot is not free.
+        self.assertIsNone(
+            haproxy_runtime.plan_server_updates(
+                new_slots,
+                [
+                    _member('glance_0', '10.0.0.50'),
+                    _member('glance_2', '10.0.0.52')],
+                drain_since=200))
+        # A member coming back is made ready.
+        _, calls = haproxy_runtime.plan_server_updates(
+            new_slots,
+            [
+                _member('glance_0', '10.0.0.50'),
+                _member('glance_1', '10.0.0.51')],
+            drain_since=200)
+        self.assertEqual(calls, [('set_server_state', 'srv2', ('ready',))])
+
+    def test_complete_drains(self):
+        slots = haproxy_runtime.allocate_server_slots(
+            [
+                _member('glance_0', '10.0.0.50'),
+                _member('glance_1', '10.0.0.51'),
+                _member('glance_2', '10.0.0.52')],
+            0,
+            9292)
+        slots, _ = haproxy_runtime.plan_server_updates(
+            slots, [_member('glance_0', '10.0.0.50')], drain_since=100)
+        new_slots, calls = haproxy_runtime.complete_drains(
+            slots, {'srv2': 0, 'srv3': 4}, 150, 300)
+        self.assertEqual(calls, [('set_server_state', 'srv2', ('maint',))])
+        self.assertEqual(
+            [(s['unit'], 'draining' in s) for s in new_slots],
+            [('glance_0', False), (None, False), ('glance_2', True)])
+        # Members with sessions left are removed after the timeout.
+        _, calls = haproxy_runtime.complete_drains(
+            new_slots, {'srv3': 4}, 400, 300)
+        self.assertEqual(calls, [('set_server_state', 'srv3', ('maint',))])
+
+    def test_plan_promotions(self):
+        remote = dict(
+            _member('glance_2', '10.1.0.52', params={'weight': 10}),
+            promoted_weight=100)
+        slots = haproxy_runtime.allocate_server_slots(
+            [
+                _member('glance_0', '10.0.0.50', params={'weight': 100}),
+                _member('glance_1', '10.0.0.51', params={'weight': 100}),
+                remote],
+            1,
+            9292)
+        self.assertEqual(slots[2]['promoted_weight'], 100)
+        self.assertNotIn('promoted_weight', slots[0])
+        statuses = {'srv1': 'UP', 'srv2': 'DOWN', 'srv3': 'UP'}
+        _, calls = haproxy_runtime.plan_promotions(slots, statuses, 1)
+        self.assertEqual(calls, [])
+        # Too few local members are up.
+        slots, calls = haproxy_runtime.plan_promotions(slots, statuses, 2)
+        self.assertEqual(calls, [('set_server_weight', 'srv3', (100,))])
+        self.assertTrue(slots[2]['promoted'])
+        _, calls = haproxy_runtime.plan_promotions(slots, statuses, 2)
+        self.assertEqual(calls, [])
+        statuses['srv2'] = 'UP 1/3'
+        slots, calls = haproxy_runtime.plan_promotions(slots, statuses, 2)
+        self.assertEqual(calls, [('set_server_weight', 'srv3', (10,))])
+        self.assertNotIn('promoted', slots[2])
+        # The slot follows the locality of the member it is given to.
+        slots, _ = haproxy_runtime.plan_server_updates(
+            slots,
+            [
+                _member('glance_0', '10.0.0.50', params={'weight': 100}),
+                _member('glance_1', '10.0.0.51', params={'weight': 100}),
+                dict(remote, backend_ip='10.1.0.53')])
+        self.assertEqual(slots[2]['promoted_weight'], 100)
+
+    def test_plan_applied_through_socket(self):
+        slots = haproxy_runtime.allocate_server_slots(
+            [_member('glance_0', '10.0.0.50')], 1, 9292)
+        with FakeHAProxy() as fake:
+            for slot in slots:
+                fake.add_server(
+                    'glance_api_back',
+                    slot['name'],
+                    slot['ip'],
+                    slot['port'],
+                    state='ready' if slot['unit'] else 'maint')
+            _, calls = haproxy_runtime.plan_server_updates(
+                slots,
+                [
+                    _member('glance_0', '10.0.0.50'),
+                    _member('glance_1', '10.0.0.51')])
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            for method, server, args in calls:
+                getattr(api, method)('glance_api_back', server, *args)
+            self.assertEqual(
+                fake.backends['glance_api_back'],
+                {
+                    'srv1': {'addr': '10.0.0.50', 'port': 9292,
+                             'state': 'ready'},
+                    'srv2': {'addr': '10.0.0.51', 'port': 9292,
+                             'state': 'ready'}})
@@ -0,0 +1,327 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import sys
+import unittest
+
+sys.path.append('src')  # noqa
+
+import jinja2
+
+import haproxy_runtime
+import lb_model
+
+TEMPLATES = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'))
+
+TLS = lb_model.TLSSettings(
+    certificate='/etc/haproxy/certs/openstack-loadbalancer.pem',
+    certificate_digest='0123',
+    cachesize=20000,
+    lifetime=300,
+    ciphers='ECDHE-RSA-AES128-GCM-SHA256',
+    ciphersuites='TLS_AES_128_GCM_SHA256',
+    min_version='TLSv1.2')
+
+ENDPOINTS = {
+    'glance_api': {
+        'frontend_port': 9292,
+        'check_type': 'http',
+        'members': [
+            {
+                'unit_name': 'glance_0',
+                'backend_port': 9292,
+                'backend_ip': '10.0.0.50'},
+            {
+                'unit_name': 'glance_1',
+                'backend_port': 9292,
+                'backend_ip': '10.30.0.51'}]}}
+
+
+def render(endpoints, **kwargs):
+    """Render templates/haproxy.cfg as the charm does.
+
+    :returns: The rendered config
+    :rtype: str
+    """
+    model = lb_model.build_model(endpoints, ['10.10.0.100'], **kwargs)
+    return TEMPLATES.get_template('haproxy.cfg').render(
+        model=model,
+        servers=haproxy_runtime.allocate_model_servers(model))
+
+
+def get_section(config, header):
+    """Lines of a section of the config, without indentation.
+
+    :returns: Lines following header up to the next section
+    :rtype: List[str]
+    """
+    lines = []
+    in_section = False
+    for line in config.splitlines():
+        if not line.startswith(' '):
+            in_section = line == header
+        elif in_section:
+            lines.append(line.strip())
+    return lines
+
+
+class TestHAProxyTemplate(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.endpoints = copy.deepcopy(ENDPOINTS)
+        self.glance = self.endpoints['glance_api']
+
+    def test_balance_weights_and_limits(self):
+        self.glance.update({
+            'balance': 'source',
+            'server_maxconn': '50',
+            'server_maxqueue': '10'})
+        self.glance['members'][1]['weight'] = '5'
+        backend = get_section(
+            render(self.endpoints, spare_slots=1),
+            'backend glance_api_back')
+        self.assertIn('balance source', backend)
+        self.assertIn('hash-type consistent', backend)
+        self.assertEqual(
+            [line for line in backend if line.startswith('server ')],
+            [
+                'server srv1 10.0.0.50:9292 check-ssl verify none check '
+                'maxconn 50 maxqueue 10',
+                'server srv2 10.30.0.51:9292 check-ssl verify none check '
+                'weight 5 maxconn 50 maxqueue 10',
+                'server srv3 127.0.0.1:9292 check-ssl verify none check '
+                'maxconn 50 maxqueue 10 disabled'])
+
+    def test_timeouts(self):
+        self.glance.update({
+            'timeout_client': '60000',
+            'timeout_server': '90000'})
+        config = render(
+            self.endpoints,
+            timeouts=lb_model.Timeouts(connect=5000, queue=10000))
+        defaults = get_section(config, 'defaults')
+        self.assertIn('timeout connect 5000', defaults)
+        self.assertIn('timeout queue 10000', defaults)
+        self.assertIn(
+            'timeout client 60000',
+            get_section(config, 'frontend glance_api_front'))
+        self.assertIn(
+            'timeout server 90000',
+            get_section(config, 'backend glance_api_back'))
+
+    def test_http_mode(self):
+        self.glance.update({'mode': 'http', 'http_reuse': 'aggressive'})
+        config = render(self.endpoints)
+        frontend = get_section(config, 'frontend glance_api_front')
+        self.assertIn('mode http', frontend)
+        self.assertIn('option httplog', frontend)
+        self.assertIn('option forwardfor', frontend)
+        backend = get_section(config, 'backend glance_api_back')
+        self.assertIn('http-reuse aggressive', backend)
+        self.assertIn('option httpchk GET /', backend)
+        # Members serve TLS unless backend-tls is turned off.
+        self.assertIn(
+            'server srv1 10.0.0.50:9292 ssl verify none check',
+            backend)
+        self.glance['backend_tls'] = 'false'
+        self.assertIn(
+            'server srv1 10.0.0.50:9292 check',
+            get_section(render(self.endpoints), 'backend glance_api_back'))
+
+    def test_tls_termination(self):
+        self.endpoints['ceph_dashboard'] = {
+            'frontend_port': 8443,
+            'check_type': 'https',
+            'tls_termination': 'false',
+            'members': [
+                {
+                    'unit_name': 'ceph-dashboard_0',
+                    'backend_port': 8443,
+                    'backend_ip': '10.0.0.10'}]}
+        self.glance['mode'] = 'http'
+        config = render(self.endpoints, tls=TLS)
+        self.assertIn(
+            'ssl-default-bind-options ssl-min-ver TLSv1.2',
+            get_section(config, 'global'))
+        self.assertIn(
+            'tune.ssl.cachesize 20000',
+            get_section(config, 'global'))
+        self.assertIn(
+            'bind *:9292 ssl crt '
+            '/etc/haproxy/certs/openstack-loadbalancer.pem '
+            'alpn h2,http/1.1',
+            get_section(config, 'frontend glance_api_front'))
+        # Passed through untouched.
+        self.assertIn(
+            'bind *:8443',
+            get_section(config, 'frontend ceph_dashboard_front'))
+        self.glance['mode'] = 'tcp'
+        self.assertIn(
+            'bind *:9292 ssl crt '
+            '/etc/haproxy/certs/openstack-loadbalancer.pem alpn http/1.1',
+            get_section(
+                render(self.endpoints, tls=TLS),
+                'frontend glance_api_front'))
+
+    def test_metrics(self):
+        config = render(self.endpoints)
+        self.assertNotIn('frontend metrics', config)
+        config = render(
+            self.endpoints,
+            metrics=lb_model.Metrics(address='10.40.0.10', port=8405))
+        frontend = get_section(config, 'frontend metrics')
+        self.assertIn('bind 10.40.0.10:8405', frontend)
+        self.assertIn(
+            'http-request use-service prometheus-exporter '
+            'if { path /metrics }',
+            frontend)
+        self.assertIn('stats uri /stats', frontend)
+
+    def test_agent_check(self):
+        self.glance.update({
+            'check_method': 'agent',
+            'check_agent_port': '9999'})
+        backend = get_section(
+            render(self.endpoints),
+            'backend glance_api_back')
+        self.assertNotIn('option httpchk GET /', backend)
+        # The agent only reports the weight and state, the connect check
+        # marks members down.
+        self.assertIn(
+            'server srv1 10.0.0.50:9292 check agent-check agent-port 9999',
+            backend)
+        self.glance['mode'] = 'http'
+        self.assertIn(
+            'server srv1 10.0.0.50:9292 ssl verify none no-check-ssl check '
+            'agent-check agent-port 9999',
+            get_section(render(self.endpoints), 'backend glance_api_back'))
+
+    def test_locality_backup(self):
+        self.glance['locality'] = 'backup'
+        locality = lb_model.Locality(subnets=('10.30.0.0/24',))
+        backend = get_section(
+            render(self.endpoints, locality=locality),
+            'backend glance_api_back')
+        self.assertIn('option allbackups', backend)
+        self.assertEqual(
+            [line for line in backend if line.startswith('server ')],
+            [
+                'server srv1 10.0.0.50:9292 check-ssl verify none check '
+                'backup',
+                'server srv2 10.30.0.51:9292 check-ssl verify none check'])
+        # Not ranked without knowing where this unit sits.
+        backend = get_section(
+            render(self.endpoints),
+            'backend glance_api_back')
+        self.assertNotIn('option allbackups', backend)
+        self.assertNotIn('backup', ' '.join(backend))
+
+    def test_cache(self):
+        self.glance.update({
+            'mode': 'http',
+            'cache': 'true',
+            'cache_size': '128',
+            'cache_paths': '/v2/images /v2/schemas/*'})
+        config = render(self.endpoints)
+        backend = get_section(config, 'backend glance_api_back')
+        self.assertIn('acl cacheable path /v2/images', backend)
+        self.assertIn('acl cacheable path_beg /v2/schemas/', backend)
+        self.assertIn(
+            'http-request cache-use glance_api_cache if cacheable',
+            backend)
+        self.assertEqual(
+            get_section(config, 'cache glance_api_cache'),
+            ['total-max-size 128', 'max-age 60'])
+        # Only in http mode.
+        self.glance['mode'] = 'tcp'
+        self.assertNotIn('cache-use', render(self.endpoints))
+
+    def test_rate_limit(self):
+        self.glance.update({
+            'mode': 'http',
+            'rate_limit_conn_cur': '20',
+            'rate_limit_http_req_rate': '200'})
+        frontend = get_section(
+            render(self.endpoints),
+            'frontend glance_api_front')
+        self.assertIn(
+            'stick-table type ipv6 size 100000 expire 20000 '
+            'store conn_cur,conn_rate(10000),http_req_rate(10000)',
+            frontend)
+        self.assertIn('tcp-request connection track-sc0 src', frontend)
+        self.assertIn(
+            'tcp-request connection reject if { sc0_conn_cur gt 20 }',
+            frontend)
+        self.assertIn(
+            'http-request deny deny_status 429 '
+            'if { sc0_http_req_rate gt 200 }',
+            frontend)
+        self.glance.update({
+            'rate_limit_action': 'queue',
+            'server_maxconn': '50'})
+        frontend = get_section(
+            render(self.endpoints),
+            'frontend glance_api_front')
+        self.assertIn(
+            'http-request set-priority-class int(100) '
+            'if { sc0_conn_cur gt 20 }',
+            frontend)
+        self.assertNotIn('tcp-request connection reject', ' '.join(frontend))
+
+    def test_log_level(self):
+        self.glance['log_level'] = 'err'
+        frontend = get_section(
+            render(self.endpoints),
+            'frontend glance_api_front')
+        # The loggers of the defaults section are replaced, not added to.
+        self.assertEqual(
+            frontend[frontend.index('no log'):][:3],
+            [
+                'no log',
+                'log /dev/log local0 err',
+                'option log-separate-errors'])
+        self.glance['log_level'] = 'off'
+        frontend = get_section(
+            render(self.endpoints),
+            'frontend glance_api_front')
+        self.assertIn('no log', frontend)
+        self.assertFalse(any(line.startswith('log ') for line in frontend))
+
+    def test_logging(self):
+        config = render(self.endpoints)
+        self.assertEqual(
+            get_section(config, 'defaults')[:2],
+            ['log global', 'option log-health-checks'])
+        config = render(
+            self.endpoints,
+            log_settings=lb_model.LogSettings(
+                target='ring',
+                health_checks=False,
+                ring_size=2**20))
+        self.assertIn('size 1048576', get_section(config, 'ring haproxy-logs'))
+        defaults = get_section(config, 'defaults')
+        self.assertIn('log ring@haproxy-logs local0', defaults)
+        self.assertNotIn('option log-health-checks', defaults)
+        config = render(
+            self.endpoints,
+            log_settings=lb_model.LogSettings(
+                target='udp',
+                server='10.0.0.5:514',
+                sample=10))
+        self.assertNotIn('ring haproxy-logs', config)
+        self.assertIn(
+            'log 10.0.0.5:514 sample 1:10 local0',
+            get_section(config, 'defaults'))
@@ -0,0 +1,141 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('src')  # noqa
+
+from mock import patch
+
+import host_tuning
+
+GiB = 2**30
+
+
+class TestHostTuning(unittest.TestCase):
+
+    def test_compute_sizing_small(self):
+        sizing = host_tuning.compute_sizing([0, 1], 2 * GiB, 3)
+        self.assertEqual(sizing.nbthread, 2)
+        self.assertEqual(sizing.cpu_map, 'auto:1/1-2 0-1')
+        # 1GiB of buffers at 48KiB per connection.
+        self.assertEqual(sizing.maxconn, 21845)
+        self.assertEqual(sizing.frontend_maxconn, 10922)
+        self.assertEqual(sizing.bufsize, 16384)
+        self.assertEqual(sizing.maxrewrite, 1024)
+
+    def test_compute_sizing_single_cpu(self):
+        sizing = host_tuning.compute_sizing([3], 256 * 2**20, 1)
+        self.assertEqual(sizing.nbthread, 1)
+        self.assertIsNone(sizing.cpu_map)
+        self.assertEqual(sizing.frontend_maxconn, sizing.maxconn)
+
+    def test_compute_sizing_large(self):
+        cpus = list(range(0, 48)) + list(range(64, 96))
+        sizing = host_tuning.compute_sizing(cpus, 512 * GiB, 40)
+        self.assertEqual(sizing.nbthread, 64)
+        self.assertEqual(sizing.cpu_map, 'auto:1/1-64 0-47 64-79')
+        # Capped well below what the memory allows.
+        self.assertEqual(sizing.maxconn, host_tuning.MAX_MAXCONN)
+
+    def test_compute_sizing_overrides(self):
+        sizing = host_tuning.compute_sizing(
+            [0, 1, 2, 3],
+            8 * GiB,
+            5,
+            nbthread=2,
+            cpu_pinning=False,
+            maxconn=1000,
+            frontend_maxconn=100,
+            bufsize=32768,
+            maxrewrite=4096)
+        self.assertEqual(sizing.nbthread, 2)
+        self.assertIsNone(sizing.cpu_map)
+        self.assertEqual(sizing.maxconn, 1000)
+        self.assertEqual(sizing.frontend_maxconn, 100)
+        self.assertEqual(sizing.bufsize, 32768)
+        self.assertEqual(sizing.maxrewrite, 4096)
+
+    def test_compute_ssl_cachesize(self):
+        self.assertEqual(host_tuning.compute_ssl_cachesize(1000), 20000)
+        self.assertEqual(host_tuning.compute_ssl_cachesize(50000), 50000)
+        self.assertEqual(host_tuning.compute_ssl_cachesize(50000, 100), 100)
+
+    def test_compute_sysctl(self):
+        profile = host_tuning.compute_sysctl(2000, reserved_ports=[9292])
+        self.assertEqual(profile['net.core.somaxconn'], 4096)
+        self.assertEqual(
+            profile['net.ipv4.ip_local_port_range'],
+            '32768 65535')
+        self.assertEqual(profile['net.netfilter.nf_conntrack_max'], 262144)
+        self.assertEqual(
+            profile['net.ipv4.ip_local_reserved_ports'],
+            '9292')
+        profile = host_tuning.compute_sysctl(
+            200000,
+            reserved_ports=[8405, 9292, 9293, 9294, 8443],
+            overrides={
+                'net.core.somaxconn': 1024,
+                'net.ipv4.tcp_tw_reuse': None})
+        self.assertEqual(profile['net.core.somaxconn'], 1024)
+        self.assertEqual(profile['net.ipv4.tcp_max_syn_backlog'], 65535)
+        self.assertEqual(
+            profile['net.ipv4.ip_local_port_range'],
+            '10000 65535')
+        self.assertEqual(profile['net.netfilter.nf_conntrack_max'], 800000)
+        self.assertEqual(
+            profile['net.ipv4.ip_local_reserved_ports'],
+            '8405,8443,9292-9294')
+        self.assertNotIn('net.ipv4.tcp_tw_reuse', profile)
+
+    def test_unapplied_sysctl(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'net', 'ipv4'))
+            with open(os.path.join(
+                    tmpdir, 'net', 'ipv4', 'ip_local_port_range'), 'w') as f:
+                f.write('1024\t65535\n')
+            with open(os.path.join(
+                    tmpdir, 'net', 'ipv4', 'tcp_tw_reuse'), 'w') as f:
+                f.write('2\n')
+            with patch.object(host_tuning, 'PROC_SYS', tmpdir):
+                self.assertEqual(
+                    host_tuning.read_sysctl('net.ipv4.ip_local_port_range'),
+                    '1024 65535')
+                self.assertIsNone(
+                    host_tuning.read_sysctl('net.core.somaxconn'))
+                self.assertEqual(
+                    host_tuning.unapplied_sysctl({
+                        'net.ipv4.ip_local_port_range': '1024 65535',
+                        'net.ipv4.tcp_tw_reuse': 1,
+                        'net.core.somaxconn': 4096}),
+                    ['net.core.somaxconn', 'net.ipv4.tcp_tw_reuse'])
+
+    def test_get_memory(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            meminfo = os.path.join(tmpdir, 'meminfo')
+            with open(meminfo, 'w') as f:
+                f.write('MemTotal:       16384000 kB\nMemFree: 1 kB\n')
+            limit = os.path.join(tmpdir, 'memory.max')
+            with open(limit, 'w') as f:
+                f.write('max\n')
+            with patch.object(host_tuning, 'MEMINFO', meminfo), \
+                    patch.object(host_tuning, 'CGROUP_MEMORY_LIMITS',
+                                 (limit,)):
+                self.assertEqual(host_tuning.get_memory(), 16384000 * 1024)
+                with open(limit, 'w') as f:
+                    f.write('{}\n'.format(2 * GiB))
+                self.assertEqual(host_tuning.get_memory(), 2 * GiB)
@@ -0,0 +1,400 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import sys
+import unittest
+
+sys.path.append('src')  # noqa
+
+import lb_model
+
+TLS = lb_model.TLSSettings(
+    certificate='/etc/haproxy/certs/openstack-loadbalancer.pem',
+    certificate_digest='0123',
+    cachesize=20000,
+    lifetime=300,
+    ciphers='ECDHE-RSA-AES128-GCM-SHA256',
+    ciphersuites='TLS_AES_128_GCM_SHA256',
+    min_version='TLSv1.2')
+
+ENDPOINTS = {
+    'glance_api': {
+        'frontend_port': 9292,
+        'check_type': 'http',
+        'members': [
+            {
+                'unit_name': 'glance_1',
+                'backend_port': 9292,
+                'backend_ip': '10.0.0.51'},
+            {
+                'unit_name': 'glance_0',
+                'backend_port': '9292',
+                'backend_ip': '10.0.0.50'}]},
+    'ceph_dashboard': {
+        'frontend_port': 8443,
+        'check_type': 'https',
+        'members': [
+            {
+                'unit_name': 'ceph-dashboard_0',
+                'backend_port': 8443,
+                'backend_ip': '10.0.0.10'}]}}
+
+
+class TestLoadbalancerModel(unittest.TestCase):
+
+    def test_build_model(self):
+        model = lb_model.build_model(
+            ENDPOINTS,
+            ['10.20.0.100', '10.10.0.100'],
+            spare_slots=2)
+        self.assertEqual(
+            [(f.name, f.port) for f in model.frontends],
+            [('ceph_dashboard_front', 8443), ('glance_api_front', 9292)])
+        self.assertEqual(
+            [b.name for b in model.backends],
+            ['ceph_dashboard_back', 'glance_api_back'])
+        self.assertEqual(
+            model.backends[1].members,
+            (
+                lb_model.Member('glance_0', '10.0.0.50', 9292),
+                lb_model.Member('glance_1', '10.0.0.51', 9292)))
+        self.assertEqual(model.vips, ('10.10.0.100', '10.20.0.100'))
+        self.assertEqual(
+            [(f.service, b.service) for f, b in model.services()],
+            [
+                ('ceph_dashboard', 'ceph_dashboard'),
+                ('glance_api', 'glance_api')])
+
+    def test_digest(self):
+        model = lb_model.build_model(ENDPOINTS, ['10.10.0.100'])
+        # Ordering of the input does not change the digest.
+        reordered = copy.deepcopy(ENDPOINTS)
+        reordered['glance_api']['members'].reverse()
+        self.assertEqual(
+            model.digest(),
+            lb_model.build_model(reordered, ['10.10.0.100']).digest())
+        changed = copy.deepcopy(ENDPOINTS)
+        changed['glance_api']['members'][0]['backend_ip'] = '10.0.0.52'
+        self.assertNotEqual(
+            model.digest(),
+            lb_model.build_model(changed, ['10.10.0.100']).digest())
+        self.assertNotEqual(
+            model.digest(),
+            lb_model.build_model(ENDPOINTS, ['10.10.0.101']).digest())
+
+    def test_layout(self):
+        model = lb_model.build_model(ENDPOINTS, ['10.10.0.100'])
+        changed = copy.deepcopy(ENDPOINTS)
+        changed['glance_api']['members'].pop()
+        self.assertEqual(
+            model.layout(),
+            lb_model.build_model(changed, ['10.10.0.101']).layout())
+        changed['glance_api']['frontend_port'] = 9293
+        self.assertNotEqual(
+            model.layout(),
+            lb_model.build_model(changed, ['10.10.0.100']).layout())
+
+    def test_build_model_options(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['glance_api']['balance'] = 'source'
+        endpoints['glance_api']['server_maxconn'] = '20'
+        endpoints['glance_api']['members'][0]['weight'] = 5
+        endpoints['glance_api']['members'][1]['maxconn'] = 10
+        endpoints['ceph_dashboard']['balance'] = 'bogus'
+        endpoints['ceph_dashboard']['members'][0]['maxconn'] = 'bogus'
+        model = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'balance': 'leastconn', 'weight': 50})
+        dashboard, glance = model.backends
+        self.assertEqual(dashboard.balance, 'leastconn')
+        self.assertIsNone(dashboard.hash_type)
+        self.assertEqual(
+            dashboard.members[0].params,
+            lb_model.ServerParams(weight=50, maxconn=None))
+        self.assertEqual(glance.balance, 'source')
+        self.assertEqual(glance.hash_type, 'consistent')
+        self.assertEqual(
+            glance.server_defaults,
+            lb_model.ServerParams(weight=50, maxconn=20))
+        self.assertEqual(
+            [m.params for m in glance.members],
+            [
+                lb_model.ServerParams(weight=50, maxconn=10),
+                lb_model.ServerParams(weight=5, maxconn=20)])
+
+    def test_build_model_timeouts(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['glance_api']['timeout_server'] = '3600000'
+        endpoints['glance_api']['timeout_client'] = 3600000
+        endpoints['glance_api']['timeout_queue'] = 'bogus'
+        endpoints['glance_api']['server_maxqueue'] = 16
+        model = lb_model.build_model(
+            endpoints,
+            [],
+            timeouts=lb_model.Timeouts(connect=5000, server=450000))
+        self.assertEqual(
+            model.timeouts.items(),
+            [('connect', 5000), ('server', 450000)])
+        dashboard, glance = model.services()
+        self.assertEqual(dashboard[0].timeouts.items(), [])
+        self.assertEqual(dashboard[1].timeouts.items(), [])
+        self.assertEqual(glance[0].timeouts.items(), [('client', 3600000)])
+        self.assertEqual(glance[1].timeouts.items(), [('server', 3600000)])
+        self.assertEqual(glance[1].server_defaults.maxqueue, 16)
+        self.assertEqual(
+            [m.params.maxqueue for m in glance[1].members],
+            [16, 16])
+
+    def test_build_model_http_mode(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['glance_api']['mode'] = 'http'
+        endpoints['glance_api']['balance'] = 'uri'
+        endpoints['glance_api']['backend_tls'] = 'false'
+        endpoints['ceph_dashboard']['balance'] = 'uri'
+        model = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'http_reuse': 'aggressive'})
+        dashboard, glance = model.services()
+        self.assertEqual(dashboard[0].mode, 'tcp')
+        self.assertEqual(dashboard[1].mode, 'tcp')
+        # uri balancing needs http mode.
+        self.assertEqual(dashboard[1].balance, 'roundrobin')
+        self.assertIsNone(dashboard[1].http_reuse)
+        self.assertEqual(glance[0].mode, 'http')
+        self.assertEqual(glance[1].mode, 'http')
+        self.assertEqual(glance[1].balance, 'uri')
+        self.assertEqual(glance[1].http_reuse, 'aggressive')
+        self.assertFalse(glance[1].backend_tls)
+
+    def test_build_model_tls(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['ceph_dashboard']['tls_termination'] = 'false'
+        model = lb_model.build_model(endpoints, [])
+        self.assertEqual([f.tls for f in model.frontends], [False, False])
+        model = lb_model.build_model(endpoints, [], tls=TLS)
+        self.assertEqual([f.tls for f in model.frontends], [False, True])
+        self.assertEqual(model.tls, TLS)
+        # A new certificate changes the layout, forcing a reload.
+        self.assertNotEqual(
+            model.layout(),
+            lb_model.build_model(
+                endpoints,
+                [],
+                tls=lb_model.TLSSettings(
+                    **dict(TLS.__dict__, certificate_digest='4567'))).layout())
+
+    def test_build_model_health_check(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['glance_api'].update({
+            'check_path': '/healthcheck',
+            'check_inter': '5000',
+            'check_rise': 'x'})
+        endpoints['ceph_dashboard']['check_method'] = 'agent'
+        model = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'inter': 10000, 'rise': 3, 'fall': 2})
+        dashboard, glance = model.backends
+        # Agent checks need a port.
+        self.assertEqual(dashboard.health_check.method, 'tcp')
+        self.assertEqual(
+            glance.health_check,
+            lb_model.HealthCheck(
+                method='http',
+                path='/healthcheck',
+                inter=5000,
+                rise=3,
+                fall=2))
+        self.assertEqual(
+            glance.health_check.timings(),
+            [('inter', 5000), ('rise', 3), ('fall', 2)])
+        endpoints['glance_api']['slowstart'] = '30000'
+        glance = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'inter': 10000}).backends[1]
+        self.assertEqual(
+            glance.default_server(),
+            [('inter', 5000), ('slowstart', 30000)])
+        endpoints['ceph_dashboard']['check_agent_port'] = '9999'
+        endpoints['glance_api']['check_method'] = 'tcp'
+        dashboard, glance = lb_model.build_model(endpoints, []).backends
+        self.assertEqual(dashboard.health_check.method, 'agent')
+        self.assertEqual(dashboard.health_check.agent_port, 9999)
+        self.assertEqual(glance.health_check.method, 'tcp')
+
+    def test_build_model_cache(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['glance_api'].update({
+            'mode': 'http',
+            'cache': 'true',
+            'cache_size': '8192',
+            'cache_paths': '/ /v2 /static/* images'})
+        endpoints['ceph_dashboard']['cache'] = 'true'
+        dashboard, glance = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'cache_max_age': 10}).backends
+        # Only backends in http mode are cached.
+        self.assertIsNone(dashboard.cache)
+        self.assertEqual(
+            glance.cache,
+            lb_model.Cache(
+                size=4095,
+                max_object_size=None,
+                max_age=10,
+                paths=('/', '/v2', '/static/*')))
+        self.assertEqual(glance.cache.exact_paths(), ['/', '/v2'])
+        self.assertEqual(glance.cache.path_prefixes(), ['/static/'])
+        self.assertEqual(glance.cache_name, 'glance_api_cache')
+        glance = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'cache': True, 'cache_paths': '/v3'}).backends[1]
+        self.assertEqual(glance.cache.paths, ('/', '/v2', '/static/*'))
+        del endpoints['glance_api']['cache']
+        del endpoints['glance_api']['cache_paths']
+        glance = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'cache': True, 'cache_paths': '/v3'}).backends[1]
+        self.assertEqual(glance.cache.paths, ('/v3',))
+
+    def test_build_model_rate_limit(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['glance_api'].update({
+            'mode': 'http',
+            'rate_limit_http_req_rate': '200',
+            'rate_limit_action': 'tarpit'})
+        endpoints['ceph_dashboard'].update({
+            'rate_limit_http_req_rate': '200',
+            'rate_limit_conn_cur': '20',
+            'rate_limit_action': 'tarpit'})
+        dashboard, glance = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'rate_limit_conn_rate': 100}).frontends
+        self.assertEqual(
+            glance.rate_limit,
+            lb_model.RateLimit(
+                conn_rate=100,
+                http_req_rate=200,
+                action='tarpit'))
+        # Request rates and tarpits need http mode.
+        self.assertEqual(
+            dashboard.rate_limit,
+            lb_model.RateLimit(conn_rate=100, conn_cur=20, action='deny'))
+        endpoints['glance_api']['rate_limit_http_req_rate'] = '0'
+        del endpoints['ceph_dashboard']['rate_limit_conn_cur']
+        for frontend in lb_model.build_model(endpoints, []).frontends:
+            self.assertIsNone(frontend.rate_limit)
+
+    def test_build_model_rate_limit_queue(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['glance_api'].update({
+            'rate_limit_conn_rate': '100',
+            'rate_limit_action': 'queue',
+            'server_maxconn': '50'})
+        endpoints['ceph_dashboard'].update({
+            'rate_limit_conn_rate': '100',
+            'rate_limit_action': 'queue'})
+        with self.assertLogs(lb_model.logger, level='WARNING'):
+            dashboard, glance = lb_model.build_model(
+                endpoints,
+                []).frontends
+        self.assertEqual(glance.rate_limit.action, 'queue')
+        # Nothing queues without a server connection limit.
+        self.assertEqual(dashboard.rate_limit.action, 'deny')
+        dashboard, _ = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'maxconn': 20}).frontends
+        self.assertEqual(dashboard.rate_limit.action, 'queue')
+
+    def test_build_model_logging(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['glance_api']['log_level'] = 'err'
+        endpoints['ceph_dashboard']['log_level'] = 'loud'
+        model = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'log_level': 'off'})
+        dashboard, glance = model.frontends
+        self.assertEqual(glance.log_level, 'err')
+        self.assertEqual(dashboard.log_level, 'off')
+        self.assertEqual(model.log_settings.destination, '/dev/log')
+        self.assertEqual(
+            lb_model.LogSettings(target='ring').destination,
+            'ring@haproxy-logs')
+        self.assertEqual(
+            lb_model.LogSettings(
+                target='udp',
+                server='10.0.0.5:514').destination,
+            '10.0.0.5:514')
+
+    def test_build_model_locality(self):
+        endpoints = copy.deepcopy(ENDPOINTS)
+        endpoints['glance_api']['members'].append({
+            'unit_name': 'glance_2',
+            'backend_port': 9292,
+            'backend_ip': '10.1.0.52',
+            'availability_zone': 'zone1'})
+        endpoints['glance_api']['members'].append({
+            'unit_name': 'glance_3',
+            'backend_port': 9292,
+            'backend_ip': '10.2.0.53',
+            'availability_zone': 'zone2'})
+        locality = lb_model.Locality(subnets=('10.0.0.0/24',), zone='zone1')
+        self.assertEqual(locality.rank('10.0.0.50'), lb_model.RANK_SUBNET)
+        self.assertEqual(locality.rank('10.1.0.52', 'zone1'),
+                         lb_model.RANK_ZONE)
+        self.assertEqual(locality.rank('10.2.0.53', 'zone2'),
+                         lb_model.RANK_REMOTE)
+        glance = lb_model.build_model(
+            endpoints,
+            [],
+            defaults={'locality': 'backup'},
+            locality=locality).backends[1]
+        self.assertEqual(glance.locality, 'backup')
+        self.assertEqual(
+            [(m.unit_name, m.rank, m.params.backup) for m in glance.members],
+            [
+                ('glance_0', 0, False),
+                ('glance_1', 0, False),
+                ('glance_2', 1, True),
+                ('glance_3', 2, True)])
+        endpoints['glance_api'].update({
+            'locality': 'weight',
+            'locality_remote_weight': '20',
+            'server_weight': '50'})
+        glance = lb_model.build_model(
+            endpoints,
+            [],
+            locality=lb_model.Locality(zone='zone1')).backends[1]
+        # Without members in the subnets, the same zone is local.
+        self.assertEqual(
+            [
+                (m.unit_name, m.params.weight, m.promoted_weight)
+                for m in glance.members],
+            [
+                ('glance_0', 10, 50),
+                ('glance_1', 10, 50),
+                ('glance_2', 50, None),
+                ('glance_3', 10, 50)])
+        glance = lb_model.build_model(endpoints, []).backends[1]
+        self.assertIsNone(glance.locality)
+        self.assertEqual(glance.members[3].params.weight, 50)
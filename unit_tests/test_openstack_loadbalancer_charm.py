@@ -14,28 +14,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
 import ipaddress
 import json
 import os
 import re
+import subprocess
 import sys
+import tempfile
 import unittest
+from pathlib import Path
 
 sys.path.append('lib')  # noqa
 sys.path.append('src')  # noqa
 
-from mock import patch
+from mock import call, patch
 
 from ops._private.harness import _TestingModelBackend
 from ops.jujucontext import _JujuContext
-from ops.testing import Harness
+from ops.testing import ActionFailed, Harness
 from ops import framework, model
+from ops.model import ActiveStatus
 import charm
+import haproxy_runtime
+from unit_tests.fake_haproxy import FakeHAProxy
 from unit_tests.manage_test_relations import (
     add_requesting_dash_relation,
     add_requesting_glance_relation,
 )
 
+SERVER_PARAMS = {
+    'weight': None, 'maxconn': None, 'maxqueue': None, 'backup': False}
+
 
 class CharmTestCase(unittest.TestCase):
 
@@ -66,11 +76,21 @@ class TestOpenstackLoadbalancerCharmBase(CharmTestCase):
 
     PATCHES = [
         'ch_host',
+        'ch_sysctl',
+        'ch_templating',
         'subprocess',
+        'template_cache',
     ]
 
     def setUp(self):
         super().setUp(charm, self.PATCHES)
+        # Do not compare the profile with the kernel running the tests.
+        patcher = patch.object(
+            charm.host_tuning,
+            'unapplied_sysctl',
+            return_value=[])
+        self.unapplied_sysctl = patcher.start()
+        self.addCleanup(patcher.stop)
         self.harness = self.get_harness()
 
     def get_harness(self):
@@ -85,9 +105,15 @@ extra-bindings:
   public:
   admin:
   internal:
+  metrics:
 provides:
   loadbalancer:
     interface: api-endpoints
+  prometheus-target:
+    interface: http
+peers:
+  cluster:
+    interface: openstack-loadbalancer-peer
 requires:
   ha:
     interface: hacluster
@@ -123,7 +149,15 @@ requires:
                                 'cidr': '10.30.0.0/24',
                                 'value': '10.30.0.10'}]}],
                         'ingress-addresses': ['10.30.0.10'],
-                        'egress-subnets': ['10.30.0.0/24']}}
+                        'egress-subnets': ['10.30.0.0/24']},
+                    'metrics': {
+                        'bind-addresses': [{
+                            'interface-name': 'eth4',
+                            'addresses': [{
+                                'cidr': '10.40.0.0/24',
+                                'value': '10.40.0.10'}]}],
+                        'ingress-addresses': ['10.40.0.10'],
+                        'egress-subnets': ['10.40.0.0/24']}}
                 return network_data[endpoint_name]
 
         _harness._backend = _TestingOPSModelBackend(
@@ -175,6 +209,47 @@ requires:
                 'internal': ['10.30.0.100'],
                 'public': ['10.20.0.100']})
 
+    def test__get_space_vip_mapping_cached(self):
+        self.harness.begin()
+        self.harness.update_config({'vip': '10.10.0.100 10.50.0.100'})
+        with patch.object(self.harness.charm.model, 'get_binding',
+                          wraps=self.harness.charm.model.get_binding) as gb:
+            self.harness.charm._get_space_vip_mapping()
+            self.assertTrue(gb.called)
+            gb.reset_mock()
+            self.assertEqual(
+                self.harness.charm._get_space_vip_mapping(),
+                {'admin': ['10.10.0.100'], 'internal': [], 'public': []})
+            self.assertFalse(gb.called)
+            self.harness.update_config({'vip': '10.20.0.100'})
+            self.assertEqual(
+                self.harness.charm._get_space_vip_mapping()['public'],
+                ['10.20.0.100'])
+        self.harness.update_config({'vip': '10.10.0.100 10.50.0.100'})
+        self.harness.charm._get_space_vip_mapping()
+        self.assertIn(
+            'VIPs not in exactly one space: 10.50.0.100',
+            self.harness.charm._get_status_messages())
+
+    def test__get_locality(self):
+        self.harness.begin()
+        add_requesting_glance_relation(self.harness)
+        endpoints = self.harness.charm.adapters.loadbalancer.endpoints
+        with patch.object(self.harness.charm.model, 'get_binding',
+                          wraps=self.harness.charm.model.get_binding) as gb:
+            self.assertIsNone(self.harness.charm._get_locality(endpoints))
+            self.assertFalse(gb.called)
+            self.harness.update_config({'locality': 'backup'})
+            self.assertEqual(
+                self.harness.charm._get_locality(endpoints).subnets,
+                ('10.10.0.0/24', '10.20.0.0/24', '10.30.0.0/24'))
+            self.assertTrue(gb.called)
+            gb.reset_mock()
+            # The subnets are kept with the VIPs of each binding.
+            self.harness.charm._get_loadbalancer_model()
+            self.harness.charm._get_loadbalancer_model()
+            self.assertFalse(gb.called)
+
     def test__send_loadbalancer_response(self):
         self.harness.begin()
         self.harness.set_leader()
@@ -235,6 +310,75 @@ requires:
                         'port': 9443,
                         'protocol': 'http'}}})
 
+    def test__send_loadbalancer_response_unchanged(self):
+        self.harness.begin()
+        self.harness.set_leader()
+        self.harness.update_config({
+            'vip': '10.10.0.100 10.20.0.100 10.30.0.100'})
+        glance_rel_id = add_requesting_glance_relation(self.harness)
+        self.harness.charm._send_loadbalancer_response()
+        with patch.object(self.harness.charm.api_eps,
+                          'advertise_loadbalancers') as advertise, \
+                patch.object(self.harness.charm.api_eps,
+                             'loadbalancer_ready') as ready:
+            self.harness.charm._send_loadbalancer_response()
+            self.assertFalse(ready.called)
+            self.assertFalse(advertise.called)
+            self.harness.update_config({
+                'vip': '10.10.0.101 10.20.0.100 10.30.0.100'})
+            self.harness.charm._send_loadbalancer_response()
+            ready.assert_any_call(
+                'glance-api',
+                'admin',
+                ['10.10.0.101'],
+                9292,
+                'http')
+            advertise.assert_called_once_with()
+        self.assertEqual(
+            json.loads(self.harness.charm._stored.lb_advertised)[
+                str(glance_rel_id)]['glance-api']['admin'],
+            {'ip': ['10.10.0.101'], 'port': 9292, 'protocol': 'http'})
+
+    def test__send_loadbalancer_response_not_leader(self):
+        self.harness.begin()
+        add_requesting_glance_relation(self.harness)
+        with patch.object(self.harness.charm,
+                          '_get_loadbalancer_responses') as responses, \
+                patch.object(self.harness.charm.api_eps,
+                             'advertise_loadbalancers') as advertise:
+            self.harness.charm._send_loadbalancer_response()
+        self.assertFalse(responses.called)
+        self.assertFalse(advertise.called)
+        self.assertEqual(
+            json.loads(self.harness.charm._stored.lb_advertised),
+            {})
+
+    def test__send_loadbalancer_response_relation_readded(self):
+        self.harness.begin()
+        self.harness.set_leader()
+        self.harness.update_config({
+            'vip': '10.10.0.100 10.20.0.100 10.30.0.100'})
+        glance_rel_id = add_requesting_glance_relation(self.harness)
+        self.harness.charm._send_loadbalancer_response()
+        self.harness.remove_relation(glance_rel_id)
+        self.harness.charm._send_loadbalancer_response()
+        self.assertEqual(
+            json.loads(self.harness.charm._stored.lb_advertised),
+            {})
+        # The endpoints are the same as before, but the new relation has not
+        # been told about them.
+        glance_rel_id = add_requesting_glance_relation(self.harness)
+        self.harness.charm._send_loadbalancer_response()
+        glance_rel_data = self.harness.get_relation_data(
+            glance_rel_id,
+            'my-charm')
+        self.assertEqual(
+            json.loads(glance_rel_data['frontends'])['glance-api']['public'],
+            {'ip': ['10.20.0.100'], 'port': 9292, 'protocol': 'http'})
+        self.assertEqual(
+            list(json.loads(self.harness.charm._stored.lb_advertised)),
+            [str(glance_rel_id)])
+
     def test__configure_hacluster(self):
         self.harness.begin()
         self.harness.set_leader()
@@ -267,6 +411,49 @@ requires:
         self.assertTrue(all(
             [v == 'ocf:heartbeat:IPaddr2' for v in vip_resources.values()]))
 
+    @patch.object(charm.socket, 'gethostname')
+    def test__configure_hacluster_spread(self, gethostname):
+        gethostname.return_value = 'node-a'
+        self.harness.begin()
+        self.harness.set_leader()
+        self.harness.update_config({
+            'vip': '10.10.0.100 10.10.0.101',
+            'vip-distribution': 'spread'})
+        cluster_rel_id = self.harness.add_relation('cluster', 'my-charm')
+        self.harness.add_relation_unit(cluster_rel_id, 'my-charm/1')
+        self.harness.update_relation_data(
+            cluster_rel_id,
+            'my-charm/1',
+            {'hostname': 'node-b'})
+        rel_id = self.harness.add_relation('ha', 'hacluster')
+        self.harness.add_relation_unit(rel_id, 'hacluster/0')
+        self.harness.charm._configure_hacluster(None)
+        rel_data = self.harness.get_relation_data(rel_id, 'my-charm/0')
+        res_100 = charm.vip_placement.vip_resource_name(
+            'my-charm', '10.10.0.100')
+        res_101 = charm.vip_placement.vip_resource_name(
+            'my-charm', '10.10.0.101')
+        # The VIPs are not grouped on one unit.
+        self.assertNotIn(
+            res_100,
+            ' '.join(json.loads(rel_data['json_groups']).values()))
+        self.assertEqual(
+            json.loads(rel_data['json_locations']),
+            {
+                'loc_{}'.format(res_100): '{} 100: node-a'.format(res_100),
+                'loc_{}'.format(res_101): '{} 100: node-b'.format(res_101)})
+        self.assertEqual(
+            json.loads(rel_data['json_colocations'])[
+                'co_{}_{}'.format(res_100, res_101)],
+            '-1000: {} {}'.format(res_100, res_101))
+        # Going back to a single unit removes the constraints again.
+        self.harness.update_config({'vip-distribution': 'single'})
+        rel_data = self.harness.get_relation_data(rel_id, 'my-charm/0')
+        self.assertEqual(json.loads(rel_data['json_locations']), {})
+        self.assertIn(
+            'loc_{}'.format(res_100),
+            json.loads(rel_data['json_delete_resources']))
+
     def test_LoadbalancerAdapter(self):
         self.harness.begin()
         self.harness.set_leader()
@@ -309,3 +496,735 @@ requires:
                             'unit_name': 'glance_0',
                             'backend_port': 9292,
                             'backend_ip': '10.0.0.50'}]}})
+
+    def test__configure_haproxy(self):
+        self.harness.begin()
+        self.harness.update_config({'backend-spare-slots': 1})
+        add_requesting_glance_relation(self.harness)
+        self.harness.charm._stored.haproxy_layout = json.dumps(None)
+        self.harness.charm._stored.haproxy_model_digest = None
+        self.ch_host.restart_on_change.reset_mock()
+        self.harness.charm._configure_haproxy()
+        self.assertTrue(self.ch_host.restart_on_change.called)
+        self.assertEqual(
+            json.loads(self.harness.charm._stored.haproxy_servers),
+            {
+                'glance_api': [
+                    {'name': 'srv1', 'unit': 'glance_0', 'ip': '10.0.0.50',
+                     'port': 9292, 'params': SERVER_PARAMS},
+                    {'name': 'srv2', 'unit': None, 'ip': '127.0.0.1',
+                     'port': 9292, 'params': SERVER_PARAMS}]})
+        layout = json.loads(self.harness.charm._stored.haproxy_layout)
+        self.assertEqual(
+            [(f['service'], f['port'], f['tls'])
+             for f in layout['frontends']],
+            [('glance_api', 9292, False)])
+        self.assertEqual(
+            [(b['service'], b['check_type']) for b in layout['backends']],
+            [('glance_api', 'http')])
+        self.assertEqual(layout['spare_slots'], 1)
+
+    def test__configure_haproxy_rejected(self):
+        self.harness.begin()
+        add_requesting_glance_relation(self.harness)
+        self.harness.charm._stored.haproxy_model_digest = None
+        self.ch_templating.render.return_value = 'global\n'
+        self.subprocess.CalledProcessError = subprocess.CalledProcessError
+        self.subprocess.check_output.side_effect = (
+            subprocess.CalledProcessError(1, 'haproxy', output='[ALERT]'))
+        self.ch_host.write_file.reset_mock()
+        self.harness.charm._render_haproxy_config(
+            self.harness.charm._get_loadbalancer_model(),
+            {})
+        self.subprocess.check_output.assert_called_once_with(
+            ['haproxy', '-c', '-q', '-f', '/etc/haproxy/haproxy.cfg.new'],
+            stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        # Only the candidate is written.
+        self.ch_host.write_file.assert_called_once_with(
+            '/etc/haproxy/haproxy.cfg.new',
+            b'global\n')
+        self.assertIn(
+            'haproxy -c rejected the config, see log',
+            self.harness.charm._get_status_messages())
+        self.subprocess.check_output.side_effect = None
+        self.harness.charm._render_haproxy_config(
+            self.harness.charm._get_loadbalancer_model(),
+            {})
+        self.ch_host.write_file.assert_called_with(
+            '/etc/haproxy/haproxy.cfg',
+            b'global\n')
+        self.assertFalse(self.harness.charm._stored.haproxy_config_rejected)
+        self.template_cache.CachingLoader.assert_called_with(
+            str(self.harness.charm.charm_dir / 'templates'),
+            charm.OpenstackLoadbalancerCharm.TEMPLATE_CACHE)
+        self.assertEqual(
+            self.ch_templating.render.call_args[1]['template_loader'],
+            self.template_cache.CachingLoader.return_value)
+
+    def test__render_haproxy_config_removes_candidates(self):
+        self.harness.begin()
+        add_requesting_glance_relation(self.harness)
+        self.harness.update_config({
+            'ssl_cert': base64.b64encode(b'CERT').decode(),
+            'ssl_key': base64.b64encode(b'KEY').decode()})
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        conf = Path(tmpdir.name) / 'haproxy.cfg'
+        cert = Path(tmpdir.name) / 'certs' / 'openstack-loadbalancer.pem'
+        cert.parent.mkdir()
+        self.ch_host.write_file.side_effect = (
+            lambda path, content, **kwargs: Path(path).write_bytes(content))
+        self.ch_templating.render.return_value = 'global\n'
+        self.subprocess.CalledProcessError = subprocess.CalledProcessError
+        with patch.object(charm.OpenstackLoadbalancerCharm, 'HAPROXY_CONF',
+                          conf), \
+                patch.object(charm.OpenstackLoadbalancerCharm, 'HAPROXY_CERT',
+                             cert):
+            model = self.harness.charm._get_loadbalancer_model()
+            self.assertTrue(self.harness.charm._render_haproxy_config(
+                model, {}))
+            self.assertEqual(
+                sorted(p.name for p in Path(tmpdir.name).rglob('*')),
+                ['certs', 'haproxy.cfg', 'openstack-loadbalancer.pem'])
+            conf.unlink()
+            cert.unlink()
+            self.subprocess.check_output.side_effect = (
+                subprocess.CalledProcessError(1, 'haproxy', output='[ALERT]'))
+            self.assertFalse(self.harness.charm._render_haproxy_config(
+                model, {}))
+            self.assertEqual(
+                [p.name for p in Path(tmpdir.name).rglob('*')],
+                ['certs'])
+
+    def test__render_haproxy_config_unchecked(self):
+        self.harness.begin()
+        self.ch_templating.render.return_value = 'global\n'
+        self.subprocess.CalledProcessError = subprocess.CalledProcessError
+        self.subprocess.check_output.side_effect = FileNotFoundError
+        self.assertTrue(self.harness.charm._render_haproxy_config(
+            self.harness.charm._get_loadbalancer_model(),
+            {}))
+        self.ch_host.write_file.assert_called_with(
+            '/etc/haproxy/haproxy.cfg',
+            b'global\n')
+        self.assertIn(
+            'config not checked, haproxy not installed',
+            self.harness.charm._get_status_messages())
+        self.subprocess.check_output.side_effect = None
+        self.harness.charm._render_haproxy_config(
+            self.harness.charm._get_loadbalancer_model(),
+            {})
+        self.assertNotIn(
+            'config not checked, haproxy not installed',
+            self.harness.charm._get_status_messages())
+
+    def test_upgrade_charm_precompiles_templates(self):
+        self.harness.begin()
+        self.harness.charm.on.upgrade_charm.emit()
+        self.template_cache.precompile.assert_called_once_with(
+            str(self.harness.charm.charm_dir / 'templates'),
+            charm.OpenstackLoadbalancerCharm.TEMPLATE_CACHE)
+
+    def test__reload_haproxy(self):
+        self.harness.begin()
+        with FakeHAProxy() as fake:
+            fake.processes.append(('old workers', 999, 1))
+            with patch.object(charm.haproxy_runtime, 'MASTER_SOCKET',
+                              fake.socket_path):
+                self.harness.charm._reload_haproxy('haproxy')
+        self.subprocess.check_call.assert_called_once_with(
+            ['systemctl', 'reload', 'haproxy'])
+        self.assertEqual(self.harness.charm._stored.haproxy_reloads, 1)
+        self.assertIsNotNone(
+            json.loads(self.harness.charm._stored.haproxy_last_reload))
+        self.assertIn(
+            'reloads=1 old-workers=1',
+            self.harness.charm._get_status_messages())
+
+    def test__configure_haproxy_unchanged(self):
+        self.harness.begin()
+        add_requesting_glance_relation(self.harness)
+        self.harness.charm._configure_haproxy()
+        self.ch_host.restart_on_change.reset_mock()
+        self.ch_templating.render.reset_mock()
+        self.harness.charm._configure_haproxy()
+        self.assertFalse(self.ch_host.restart_on_change.called)
+        self.assertFalse(self.ch_templating.render.called)
+        # A change to the vips changes the model.
+        self.harness.update_config({'vip': '10.10.0.100'})
+        self.harness.framework.commit()
+        self.assertTrue(self.ch_templating.render.called)
+
+    def test__configure_haproxy_live_update(self):
+        self.harness.begin()
+        self.harness.update_config({'backend-spare-slots': 1})
+        glance_rel_id = add_requesting_glance_relation(self.harness)
+        self.harness.charm._configure_haproxy()
+        with FakeHAProxy() as fake:
+            for slot in json.loads(
+                    self.harness.charm._stored.haproxy_servers)['glance_api']:
+                fake.add_server(
+                    'glance_api_back',
+                    slot['name'],
+                    slot['ip'],
+                    slot['port'],
+                    state='ready' if slot['unit'] else 'maint')
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            with patch.object(charm.haproxy_runtime, 'HAProxyRuntimeAPI',
+                              return_value=api):
+                self.ch_host.restart_on_change.reset_mock()
+                self.harness.add_relation_unit(glance_rel_id, 'glance/1')
+                self.harness.update_relation_data(
+                    glance_rel_id,
+                    'glance/1',
+                    {
+                        'endpoints': json.dumps([
+                            {
+                                'service-name': 'glance-api',
+                                'backend-port': 9292,
+                                'backend-ip': '10.0.0.51'}])})
+                self.harness.charm._configure_haproxy()
+            self.assertFalse(self.ch_host.restart_on_change.called)
+            self.assertTrue(self.ch_templating.render.called)
+            self.assertEqual(
+                fake.backends['glance_api_back']['srv2'],
+                {'addr': '10.0.0.51', 'port': 9292, 'state': 'ready'})
+
+    def test__configure_haproxy_live_update_rejected(self):
+        self.harness.begin()
+        self.harness.update_config({'backend-spare-slots': 1})
+        glance_rel_id = add_requesting_glance_relation(self.harness)
+        self.harness.charm._configure_haproxy()
+        self.subprocess.CalledProcessError = subprocess.CalledProcessError
+        self.subprocess.check_output.side_effect = (
+            subprocess.CalledProcessError(1, 'haproxy', output='[ALERT]'))
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            fake.add_server('glance_api_back', 'srv2', '127.0.0.1', 9292,
+                            state='maint')
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            with patch.object(charm.haproxy_runtime, 'HAProxyRuntimeAPI',
+                              return_value=api):
+                self.harness.add_relation_unit(glance_rel_id, 'glance/1')
+                self.harness.update_relation_data(
+                    glance_rel_id,
+                    'glance/1',
+                    {
+                        'endpoints': json.dumps([
+                            {
+                                'service-name': 'glance-api',
+                                'backend-port': 9292,
+                                'backend-ip': '10.0.0.51'}])})
+                self.harness.charm._configure_haproxy()
+            # The running haproxy is left as it is.
+            self.assertEqual(
+                fake.backends['glance_api_back']['srv2'],
+                {'addr': '127.0.0.1', 'port': 9292, 'state': 'maint'})
+        self.assertEqual(
+            [slot['unit'] for slot in json.loads(
+                self.harness.charm._stored.haproxy_servers)['glance_api']],
+            ['glance_0', None])
+
+    def test_locality_promotion(self):
+        self.harness.begin()
+        self.harness.update_config({'locality': 'weight'})
+        glance_rel_id = add_requesting_glance_relation(self.harness)
+        self.harness.add_relation_unit(glance_rel_id, 'glance/1')
+        self.harness.update_relation_data(
+            glance_rel_id,
+            'glance/1',
+            {
+                'endpoints': json.dumps([
+                    {
+                        'service-name': 'glance-api',
+                        'backend-port': 9292,
+                        'backend-ip': '10.30.0.51'}])})
+        self.harness.charm._configure_haproxy()
+        slots = json.loads(
+            self.harness.charm._stored.haproxy_servers)['glance_api']
+        # glance/1 is in the subnet of the internal binding.
+        self.assertEqual(
+            [(s['unit'], s['params']['weight']) for s in slots],
+            [('glance_0', 10), ('glance_1', 100)])
+        self.assertEqual(slots[0]['promoted_weight'], 100)
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            fake.add_server('glance_api_back', 'srv2', '10.30.0.51', 9292,
+                            state='maint')
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            with patch.object(charm.haproxy_runtime, 'HAProxyRuntimeAPI',
+                              return_value=api):
+                self.harness.charm.on.update_status.emit()
+                self.assertEqual(
+                    fake.backends['glance_api_back']['srv1']['weight'],
+                    100)
+                self.assertIn(
+                    'remote members promoted: glance_api',
+                    self.harness.charm._get_status_messages())
+                fake.backends['glance_api_back']['srv2']['state'] = 'ready'
+                self.harness.charm.on.update_status.emit()
+                self.assertEqual(
+                    fake.backends['glance_api_back']['srv1']['weight'],
+                    10)
+        self.assertNotIn(
+            'remote members promoted: glance_api',
+            self.harness.charm._get_status_messages())
+
+    def test__configure_haproxy_live_update_fails(self):
+        self.harness.begin()
+        glance_rel_id = add_requesting_glance_relation(self.harness)
+        self.harness.charm._configure_haproxy()
+        api = haproxy_runtime.HAProxyRuntimeAPI('/nonexistent/admin.sock')
+        with patch.object(charm.haproxy_runtime, 'HAProxyRuntimeAPI',
+                          return_value=api):
+            self.ch_host.restart_on_change.reset_mock()
+            self.harness.update_relation_data(
+                glance_rel_id,
+                'glance/0',
+                {
+                    'endpoints': json.dumps([
+                        {
+                            'service-name': 'glance-api',
+                            'backend-port': 9292,
+                            'backend-ip': '10.0.0.51'}])})
+            self.harness.charm._configure_haproxy()
+        self.assertTrue(self.ch_host.restart_on_change.called)
+
+    def test__apply_lb_requests(self):
+        self.harness.begin()
+        add_requesting_glance_relation(self.harness)
+        self.harness.charm._stored.lb_pending_events = 0
+        self.harness.charm._stored.lb_pending_since = None
+        with patch.object(self.harness.charm, '_configure_haproxy') as conf, \
+                patch.object(self.harness.charm,
+                             '_send_loadbalancer_response') as send:
+            self.harness.charm._process_lb_requests(None)
+            self.harness.charm._process_lb_requests(None)
+            self.harness.charm._process_lb_requests(None)
+            self.assertFalse(conf.called)
+            self.harness.framework.commit()
+            conf.assert_called_once_with()
+            send.assert_called_once_with(conf.return_value)
+            # Nothing pending so nothing to do.
+            self.harness.framework.commit()
+            conf.assert_called_once_with()
+        self.assertEqual(self.harness.charm._stored.lb_last_folded_events, 3)
+        self.assertEqual(self.harness.charm._stored.lb_pending_events, 0)
+
+    def test__apply_lb_requests_builds_model_once(self):
+        self.harness.begin()
+        self.harness.set_leader()
+        add_requesting_glance_relation(self.harness)
+        self.harness.charm._stored.haproxy_model_digest = None
+        with patch.object(
+                self.harness.charm,
+                '_get_loadbalancer_model',
+                wraps=self.harness.charm._get_loadbalancer_model) as build:
+            self.harness.charm._process_lb_requests(None)
+            self.harness.framework.commit()
+        build.assert_called_once_with()
+
+    def test__apply_lb_requests_rejected(self):
+        self.harness.begin()
+        add_requesting_glance_relation(self.harness)
+        self.harness.charm._stored.haproxy_model_digest = None
+        self.harness.charm._stored.lb_pending_events = 0
+        self.harness.charm._stored.lb_pending_since = None
+        self.ch_host.restart_on_change.side_effect = (
+            lambda *args, **kwargs: lambda f: f)
+        self.subprocess.CalledProcessError = subprocess.CalledProcessError
+        self.subprocess.check_output.side_effect = (
+            subprocess.CalledProcessError(1, 'haproxy', output='[ALERT]'))
+        with patch.object(self.harness.charm,
+                          '_send_loadbalancer_response') as send:
+            self.harness.charm._process_lb_requests(None)
+            self.harness.framework.commit()
+            self.assertFalse(send.called)
+            self.assertEqual(self.harness.charm._stored.lb_pending_events, 1)
+            self.assertIsNone(self.harness.charm._stored.haproxy_model_digest)
+            # Retried on the next dispatch.
+            self.subprocess.check_output.side_effect = None
+            self.harness.framework.commit()
+            self.assertTrue(send.called)
+        self.assertEqual(self.harness.charm._stored.lb_pending_events, 0)
+        self.assertFalse(self.harness.charm._stored.haproxy_config_rejected)
+        self.assertIsNotNone(self.harness.charm._stored.haproxy_model_digest)
+
+    @patch.object(charm.time, 'time')
+    def test__apply_lb_requests_window(self, _time):
+        _time.return_value = 1000
+        self.harness.begin()
+        self.harness.update_config({'lb-coalesce-window': 30})
+        self.harness.charm._stored.lb_pending_events = 0
+        self.harness.charm._stored.lb_pending_since = None
+        with patch.object(self.harness.charm, '_configure_haproxy') as conf, \
+                patch.object(self.harness.charm,
+                             '_send_loadbalancer_response'):
+            self.harness.charm._process_lb_requests(None)
+            _time.return_value = 1020
+            self.harness.charm._process_lb_requests(None)
+            self.harness.framework.commit()
+            self.assertFalse(conf.called)
+            _time.return_value = 1031
+            self.harness.charm._process_lb_requests(None)
+            self.harness.framework.commit()
+            conf.assert_called_once_with()
+        self.assertEqual(self.harness.charm._stored.lb_last_folded_events, 3)
+
+    @patch.object(charm.time, 'time')
+    def test__apply_lb_requests_window_quiet_dispatch(self, _time):
+        _time.return_value = 1000
+        self.harness.begin()
+        self.harness.update_config({'lb-coalesce-window': 30})
+        self.harness.charm._stored.lb_pending_events = 0
+        self.harness.charm._stored.lb_pending_since = None
+        with patch.object(self.harness.charm, '_configure_haproxy') as conf, \
+                patch.object(self.harness.charm,
+                             '_send_loadbalancer_response'):
+            self.harness.charm._process_lb_requests(None)
+            self.harness.framework.commit()
+            self.assertFalse(conf.called)
+            # A dispatch without loadbalancer events ends the burst.
+            _time.return_value = 1005
+            self.harness.framework.commit()
+            conf.assert_called_once_with()
+        self.assertEqual(self.harness.charm._stored.lb_pending_events, 0)
+
+    @patch.object(charm.time, 'time')
+    def test__apply_lb_requests_window_action(self, _time):
+        _time.return_value = 1000
+        self.harness.begin()
+        self.harness.update_config({'lb-coalesce-window': 30})
+        self.harness.charm._stored.lb_pending_events = 0
+        self.harness.charm._stored.lb_pending_since = None
+        with patch.object(self.harness.charm, '_configure_haproxy') as conf, \
+                patch.object(self.harness.charm,
+                             '_send_loadbalancer_response'):
+            self.harness.charm._process_lb_requests(None)
+            self.harness.framework.commit()
+            _time.return_value = 1005
+            # Actions and the stop hook leave held back events pending.
+            for dispatch_path in ('actions/show-stats', 'hooks/stop'):
+                with patch.dict(os.environ,
+                                {'JUJU_DISPATCH_PATH': dispatch_path}):
+                    self.harness.framework.commit()
+            self.assertFalse(conf.called)
+            with patch.dict(os.environ,
+                            {'JUJU_DISPATCH_PATH': 'hooks/update-status'}):
+                self.harness.framework.commit()
+            conf.assert_called_once_with()
+        self.assertEqual(self.harness.charm._stored.lb_pending_events, 0)
+
+    @patch.object(charm.host_tuning, 'get_memory')
+    @patch.object(charm.host_tuning, 'get_cpus')
+    def test_haproxy_sizing(self, get_cpus, get_memory):
+        get_cpus.return_value = [0, 1, 2, 3]
+        get_memory.return_value = 8 * 2**30
+        self.harness.begin()
+        self.harness.update_config({'haproxy-maxconn': 20000})
+        add_requesting_glance_relation(self.harness)
+        add_requesting_dash_relation(self.harness)
+        model = self.harness.charm._get_loadbalancer_model()
+        self.assertEqual(model.sizing.nbthread, 4)
+        self.assertEqual(model.sizing.cpu_map, 'auto:1/1-4 0-3')
+        self.assertEqual(model.sizing.maxconn, 20000)
+        self.assertEqual(model.sizing.frontend_maxconn, 10000)
+        self.harness.charm._configure_haproxy()
+        self.harness.charm.unit.status = ActiveStatus('Unit is ready')
+        self.harness.framework.commit()
+        self.assertEqual(
+            self.harness.charm.unit.status.message,
+            'Unit is ready (nbthread=4 maxconn=20000)')
+        results = self.harness.run_action('show-sizing').results
+        self.assertEqual(results['cpus'], 4)
+        self.assertEqual(results['memory-mb'], 8192)
+        self.assertEqual(results['frontend-maxconn'], 10000)
+        self.assertTrue(results['rendered'])
+        self.assertIn('net.core.somaxconn=20000', results['sysctl'])
+
+    def test_LoadbalancerAdapter_options(self):
+        self.harness.begin()
+        self.harness.update_config({'haproxy-balance': 'leastconn'})
+        rel_id = add_requesting_glance_relation(self.harness)
+        self.harness.update_relation_data(
+            rel_id,
+            'glance',
+            {
+                'endpoints': json.dumps([
+                    {
+                        'service-name': 'glance-api',
+                        'frontend-port': 9292,
+                        'check-type': 'http',
+                        'balance': 'source',
+                        'server-maxconn': 100}])})
+        self.harness.update_relation_data(
+            rel_id,
+            'glance/0',
+            {
+                'endpoints': json.dumps([
+                    {
+                        'service-name': 'glance-api',
+                        'backend-port': 9292,
+                        'backend-ip': '10.0.0.50',
+                        'weight': 10}])})
+        endpoints = self.harness.charm.adapters.loadbalancer.endpoints
+        self.assertEqual(endpoints['glance_api']['balance'], 'source')
+        self.assertEqual(endpoints['glance_api']['server_maxconn'], 100)
+        self.assertEqual(
+            endpoints['glance_api']['members'],
+            [
+                {
+                    'unit_name': 'glance_0',
+                    'backend_port': 9292,
+                    'backend_ip': '10.0.0.50',
+                    'weight': 10}])
+        backend = self.harness.charm._get_loadbalancer_model().backends[0]
+        self.assertEqual(backend.balance, 'source')
+        self.assertEqual(
+            backend.members[0].params,
+            charm.lb_model.ServerParams(weight=10, maxconn=100))
+
+    def test__get_haproxy_timeouts(self):
+        self.harness.begin()
+        self.harness.update_config({
+            'haproxy-queue-timeout': 10000,
+            'haproxy-connect-timeout': 0})
+        self.assertEqual(
+            self.harness.charm._get_haproxy_timeouts(),
+            charm.lb_model.Timeouts(
+                client=50000,
+                server=450000,
+                queue=10000))
+
+    def test_tls_termination(self):
+        self.harness.begin()
+        self.harness.set_leader()
+        self.harness.update_config({
+            'vip': '10.20.0.100',
+            'haproxy-maxconn': 1000})
+        add_requesting_glance_relation(self.harness)
+        self.assertIsNone(self.harness.charm._get_certificate_bundle())
+        self.harness.update_config({
+            'ssl_cert': base64.b64encode(b'CERT').decode(),
+            'ssl_key': base64.b64encode(b'KEY\n').decode(),
+            'ssl_ca': base64.b64encode(b'CA').decode()})
+        self.assertEqual(
+            self.harness.charm._get_certificate_bundle(),
+            b'CERT\nCA\nKEY\n')
+        model = self.harness.charm._get_loadbalancer_model()
+        self.ch_templating.render.return_value = 'global\n'
+        self.subprocess.CalledProcessError = subprocess.CalledProcessError
+        self.subprocess.check_output.side_effect = (
+            subprocess.CalledProcessError(1, 'haproxy', output='[ALERT]'))
+        self.ch_host.write_file.reset_mock()
+        self.harness.charm._render_haproxy_config(model, {})
+        # haproxy -c checks the config against a candidate certificate, the
+        # installed one is left alone.
+        self.assertEqual(
+            self.ch_templating.render.call_args[0][2]['model'].tls.certificate,
+            '/etc/haproxy/certs/openstack-loadbalancer.pem.new')
+        self.assertEqual(
+            self.ch_host.write_file.call_args_list,
+            [
+                call(
+                    '/etc/haproxy/certs/openstack-loadbalancer.pem.new',
+                    b'CERT\nCA\nKEY\n',
+                    perms=0o600),
+                call('/etc/haproxy/haproxy.cfg.new', b'global\n')])
+        self.subprocess.check_output.side_effect = None
+        self.ch_host.write_file.reset_mock()
+        self.harness.charm._render_haproxy_config(model, {})
+        self.ch_host.write_file.assert_has_calls([
+            call(
+                '/etc/haproxy/certs/openstack-loadbalancer.pem',
+                b'CERT\nCA\nKEY\n',
+                perms=0o600),
+            call('/etc/haproxy/haproxy.cfg', b'global\n')])
+        self.assertTrue(model.frontends[0].tls)
+        self.assertEqual(model.tls.cachesize, 20000)
+        self.assertEqual(
+            self.harness.charm._get_loadbalancer_responses(),
+            {
+                'glance-api': {
+                    'public': {
+                        'ip': ['10.20.0.100'],
+                        'port': 9292,
+                        'protocol': 'https'},
+                    'admin': {'ip': [], 'port': 9292, 'protocol': 'https'},
+                    'internal': {
+                        'ip': [],
+                        'port': 9292,
+                        'protocol': 'https'}}})
+
+    def test_tls_termination_invalid_certificate(self):
+        self.harness.begin()
+        add_requesting_glance_relation(self.harness)
+        self.harness.update_config({
+            'ssl_cert': base64.b64encode(b'CERT').decode(),
+            'ssl_key': 'not base64!'})
+        with self.assertLogs(charm.logger, level='ERROR'):
+            self.assertIsNone(self.harness.charm._get_certificate_bundle())
+        model = self.harness.charm._get_loadbalancer_model()
+        self.assertIsNone(model.tls)
+        self.assertFalse(model.frontends[0].tls)
+        self.assertIn(
+            'invalid base64 in ssl_key, TLS disabled',
+            self.harness.charm._get_status_messages())
+        # Line wrapped base64 is fine.
+        self.harness.update_config({
+            'ssl_key': base64.encodebytes(b'KEY' * 30).decode()})
+        self.assertEqual(
+            self.harness.charm._get_certificate_bundle(),
+            b'CERT\n' + b'KEY' * 30 + b'\n')
+
+    def test_metrics(self):
+        self.harness.begin()
+        # Disabled by default.
+        self.assertIsNone(self.harness.charm._get_loadbalancer_model().metrics)
+        self.harness.update_config({'metrics-port': 8405})
+        model = self.harness.charm._get_loadbalancer_model()
+        self.assertEqual(
+            model.metrics,
+            charm.lb_model.Metrics(address='10.40.0.10', port=8405))
+        rel_id = self.harness.add_relation('prometheus-target', 'prometheus')
+        self.harness.add_relation_unit(rel_id, 'prometheus/0')
+        self.assertEqual(
+            self.harness.get_relation_data(rel_id, 'my-charm/0'),
+            {
+                'hostname': '10.40.0.10',
+                'port': '8405',
+                'metrics_path': '/metrics'})
+        self.harness.update_config({'metrics-port': 0})
+        self.assertIsNone(self.harness.charm._get_loadbalancer_model().metrics)
+        self.assertEqual(
+            self.harness.get_relation_data(rel_id, 'my-charm/0'),
+            {})
+
+    def test_log_settings(self):
+        self.harness.begin()
+        self.assertEqual(
+            self.harness.charm._get_loadbalancer_model().log_settings,
+            charm.lb_model.LogSettings())
+        self.harness.update_config({
+            'haproxy-log-target': 'udp',
+            'haproxy-log-sample': 10,
+            'haproxy-log-health-checks': False})
+        # The udp target needs a server.
+        self.assertEqual(
+            self.harness.charm._get_log_settings(),
+            charm.lb_model.LogSettings(sample=10, health_checks=False))
+        self.harness.update_config({'haproxy-log-server': '10.0.0.5:514'})
+        self.assertEqual(
+            self.harness.charm._get_log_settings(),
+            charm.lb_model.LogSettings(
+                target='udp',
+                server='10.0.0.5:514',
+                sample=10,
+                health_checks=False))
+
+    def test_show_logs_action(self):
+        self.harness.begin()
+        with self.assertRaises(ActionFailed):
+            self.harness.run_action('show-logs')
+        self.harness.update_config({'haproxy-log-target': 'ring'})
+        with FakeHAProxy() as fake:
+            fake.events['haproxy-logs'] = ['first', 'second', 'third']
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            with patch.object(charm.haproxy_runtime, 'HAProxyRuntimeAPI',
+                              return_value=api):
+                results = self.harness.run_action(
+                    'show-logs',
+                    {'lines': 2}).results
+        self.assertEqual(results['logs'], 'second\nthird')
+
+    def test__configure_sysctl(self):
+        self.unapplied_sysctl.return_value = [
+            'net.netfilter.nf_conntrack_max']
+        self.harness.begin()
+        self.harness.update_config({
+            'haproxy-maxconn': 1000,
+            'metrics-port': 8405,
+            'sysctl': '{ net.core.somaxconn: 8192, net.ipv4.tcp_tw_reuse: }'})
+        add_requesting_glance_relation(self.harness)
+        self.harness.charm._stored.sysctl_profile = json.dumps(None)
+        self.ch_sysctl.create.reset_mock()
+        self.harness.charm._configure_haproxy()
+        self.harness.charm._stored.haproxy_model_digest = None
+        self.harness.charm._configure_haproxy()
+        profile, path = self.ch_sysctl.create.call_args[0]
+        # Applied once while unchanged.
+        self.ch_sysctl.create.assert_called_once_with(
+            profile,
+            '/etc/sysctl.d/50-openstack-loadbalancer.conf',
+            ignore=True)
+        self.assertEqual(profile['net.core.somaxconn'], 8192)
+        self.assertEqual(profile['net.ipv4.tcp_max_syn_backlog'], 4096)
+        self.assertNotIn('net.ipv4.tcp_tw_reuse', profile)
+        self.assertEqual(
+            profile['net.ipv4.ip_local_reserved_ports'],
+            '8405,9292')
+        self.assertIn(
+            'sysctl not applied: net.netfilter.nf_conntrack_max',
+            self.harness.charm._get_status_messages())
+        self.harness.update_config({'sysctl': 'invalid'})
+        self.assertEqual(self.harness.charm._get_sysctl_overrides(), {})
+
+    def test_show_stats_action(self):
+        self.harness.begin()
+        with FakeHAProxy() as fake:
+            fake.add_server('glance_api_back', 'srv1', '10.0.0.50', 9292)
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            with patch.object(charm.haproxy_runtime, 'HAProxyRuntimeAPI',
+                              return_value=api):
+                results = self.harness.run_action('show-stats').results
+                self.assertEqual(results['version'], '2.4.22')
+                self.assertEqual(results['reloads'], 0)
+                self.assertEqual(results['old-workers'], 0)
+                self.assertNotIn('current-connections', results)
+                self.assertEqual(
+                    results['stats'].splitlines()[1].split()[0],
+                    'glance_api')
+                results = self.harness.run_action(
+                    'show-stats',
+                    {'format': 'json'}).results
+                self.assertEqual(
+                    json.loads(results['stats'])[0]['servers-up'],
+                    '1/1')
+        api = haproxy_runtime.HAProxyRuntimeAPI('/nonexistent/admin.sock')
+        with patch.object(charm.haproxy_runtime, 'HAProxyRuntimeAPI',
+                          return_value=api):
+            with self.assertRaises(ActionFailed):
+                self.harness.run_action('show-stats')
+
+    def test_show_clients_action(self):
+        self.harness.begin()
+        with FakeHAProxy() as fake:
+            fake.tables['glance_api_front'] = {
+                '10.0.0.9': {'conn_cur': 1, 'conn_rate(10000)': 3}}
+            api = haproxy_runtime.HAProxyRuntimeAPI(fake.socket_path)
+            with patch.object(charm.haproxy_runtime, 'HAProxyRuntimeAPI',
+                              return_value=api):
+                results = self.harness.run_action('show-clients').results
+                self.assertEqual(
+                    results['clients'].splitlines()[1].split(),
+                    ['glance_api', '10.0.0.9', '1', '3', '0'])
+                results = self.harness.run_action(
+                    'show-clients',
+                    {'format': 'json'}).results
+                self.assertEqual(
+                    json.loads(results['clients'])[0]['client'],
+                    '10.0.0.9')
+
+
+class TestLazyModule(unittest.TestCase):
+
+    @patch.object(charm.importlib, 'import_module')
+    def test_imported_on_use(self, import_module):
+        module = charm._LazyModule('template_cache')
+        self.assertFalse(import_module.called)
+        self.assertEqual(
+            module.precompile,
+            import_module.return_value.precompile)
+        module.CachingLoader
+        import_module.assert_called_once_with('template_cache')
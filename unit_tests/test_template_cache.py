@@ -0,0 +1,75 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.append('src')  # noqa
+
+import jinja2
+from mock import patch
+
+import template_cache
+
+
+class TestTemplateCache(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.templates = Path(tmpdir.name) / 'templates'
+        self.templates.mkdir()
+        (self.templates / 'haproxy.cfg').write_text('maxconn {{ maxconn }}')
+        self.cache_dir = Path(tmpdir.name) / 'cache' / 'templates'
+
+    def _render(self):
+        environment = jinja2.Environment(
+            loader=template_cache.CachingLoader(
+                str(self.templates),
+                self.cache_dir))
+        return environment.get_template('haproxy.cfg').render(maxconn=10)
+
+    def test_reuses_compiled_template(self):
+        self.assertEqual(self._render(), 'maxconn 10')
+        self.assertEqual(len(list(self.cache_dir.iterdir())), 1)
+        with patch.object(jinja2.Environment, 'compile') as compile_:
+            self.assertEqual(self._render(), 'maxconn 10')
+        self.assertFalse(compile_.called)
+
+    def test_recompiles_changed_template(self):
+        self._render()
+        (self.templates / 'haproxy.cfg').write_text('maxconn {{ maxconn }}0')
+        self.assertEqual(self._render(), 'maxconn 100')
+
+    def test_cache_not_writable(self):
+        self.cache_dir.parent.write_text('')
+        with self.assertLogs(template_cache.logger, level='WARNING'):
+            self.assertEqual(self._render(), 'maxconn 10')
+
+    def test_precompile(self):
+        self.assertEqual(
+            template_cache.precompile(str(self.templates), self.cache_dir),
+            ['haproxy.cfg'])
+        self.assertEqual(self.cache_dir.stat().st_mode & 0o777, 0o700)
+        with patch.object(jinja2.Environment, 'compile') as compile_:
+            self.assertEqual(self._render(), 'maxconn 10')
+        self.assertFalse(compile_.called)
+
+    def test_precompile_repo_templates(self):
+        self.assertEqual(
+            template_cache.precompile('templates', self.cache_dir),
+            ['haproxy.cfg'])
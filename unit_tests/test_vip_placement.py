@@ -0,0 +1,78 @@
+# Copyright 2021 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import unittest
+
+sys.path.append('src')  # noqa
+
+import vip_placement
+
+
+class TestVIPPlacement(unittest.TestCase):
+
+    def test_vip_resource_name(self):
+        self.assertRegex(
+            vip_placement.vip_resource_name('my-charm', '10.10.0.100'),
+            '^res_my-charm_[0-9a-f]{7}_vip$')
+
+    def test_assign_vips(self):
+        self.assertEqual(
+            vip_placement.assign_vips(
+                ['10.0.0.3', '10.0.0.1', '10.0.0.2'],
+                ['node-b', 'node-a', 'node-b']),
+            {
+                '10.0.0.1': 'node-a',
+                '10.0.0.2': 'node-b',
+                '10.0.0.3': 'node-a'})
+        self.assertEqual(vip_placement.assign_vips(['10.0.0.1'], []), {})
+
+    def test_plan_constraints(self):
+        res_1 = vip_placement.vip_resource_name('lb', '10.0.0.1')
+        res_2 = vip_placement.vip_resource_name('lb', '10.0.0.2')
+        colocations, locations = vip_placement.plan_constraints(
+            'lb',
+            ['10.0.0.2', '10.0.0.1'],
+            ['node-a', 'node-b'],
+            'cl_res_lb_haproxy')
+        self.assertEqual(
+            colocations,
+            {
+                'co_{}_haproxy'.format(res_1):
+                    'inf: {} cl_res_lb_haproxy'.format(res_1),
+                'co_{}_haproxy'.format(res_2):
+                    'inf: {} cl_res_lb_haproxy'.format(res_2),
+                'co_{}_{}'.format(res_1, res_2):
+                    '-1000: {} {}'.format(res_1, res_2)})
+        self.assertEqual(
+            locations,
+            {
+                'loc_{}'.format(res_1): '{} 100: node-a'.format(res_1),
+                'loc_{}'.format(res_2): '{} 100: node-b'.format(res_2)})
+
+    def test_build_space_index(self):
+        index = vip_placement.build_space_index(
+            {
+                'admin': ['10.10.0.0/24'],
+                'public': ['10.20.0.0/24', '10.0.0.0/8'],
+                'internal': ['10.30.0.0/24', 'fd00::/64']},
+            ['10.10.0.100', '10.20.0.100', 'fd00::100', '192.168.0.1'])
+        self.assertEqual(
+            index['bindings'],
+            {
+                'admin': ['10.10.0.100'],
+                'public': ['10.10.0.100', '10.20.0.100'],
+                'internal': ['fd00::100']})
+        self.assertEqual(index['unmatched'], ['192.168.0.1'])
+        self.assertEqual(index['ambiguous'], ['10.10.0.100'])